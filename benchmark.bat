@@ -0,0 +1,3 @@
+@echo off
+
+python src/SCBenchmark.py %*
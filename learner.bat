@@ -0,0 +1,3 @@
+@echo off
+
+python src/SurfChan.py l
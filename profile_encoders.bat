@@ -0,0 +1,3 @@
+@echo off
+
+python src/sc_encoders.py %*
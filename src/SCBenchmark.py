@@ -0,0 +1,413 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+import platform
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+import torch
+import gymnasium as gym
+from torchrl.collectors import SyncDataCollector
+from sc_config import get_config
+from sc_model_utils import create_models, add_model_transforms, create_fake_observation, create_fake_rollout, SCStats
+from sc_utils import run_async
+from sc_preprocess import create_preprocess
+from SCEnv import SCEnv, create_torchrl_env, create_specs, decode_actions
+from SCFakeGame import SCFakeGame
+from SCGame import Message, MESSAGE_TYPE, PlayerState
+from SCTrain import SCTrain
+
+BENCHMARK_ENV_NAME = "SurfChanBenchmark"
+_CODEC_MESSAGE_COUNT = 1000
+# Imports what SurfChan imports for a mode, then reports whether torch was loaded
+_STARTUP_SCRIPT = """
+import sys
+import SurfChan
+mode = SurfChan.MODE[sys.argv[1]]
+if mode in SurfChan.MODE_CLASSES:
+    SurfChan.load_mode_class(mode)
+print("torch" in sys.modules)
+"""
+
+def get_case_key(scenario, **params):
+    return "/".join([scenario] + [f"{key}={val}" for key, val in params.items()])
+
+def summarize(times, items):
+    times = np.array(times)
+    median = float(np.median(times))
+    return {
+        "median": median,
+        "mean": float(times.mean()),
+        "p90": float(np.percentile(times, 90)),
+        "min": float(times.min()),
+        "repeats": len(times),
+        "items_per_second": items / median if median > 0 else 0.0,
+    }
+
+def compare(results, baseline, tolerance):
+    """Returns {case key: median / baseline median} and the keys that got slower than tolerance allows."""
+    ratios = {}
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        baseline_median = baseline[key]["median"]
+        ratios[key] = result["median"] / baseline_median if baseline_median > 0 else 1.0
+        if ratios[key] > 1.0 + tolerance:
+            regressions.append(key)
+
+    return ratios, regressions
+
+class SCBenchmark():
+    """Times the hot paths against a local stand-in for the game and capture, so it runs headless.
+
+    Every scenario is run for each combination of the benchmark image sizes, batch sizes, devices and
+    recurrent options it depends on. The median of each case is compared against a stored baseline.
+    """
+
+    def __init__(self, scenario_names=None):
+        self.config = get_config()
+        self.conf = self.config.benchmark
+        self.scenario_names = scenario_names
+        self.results = {}
+
+        self.devices = [torch.device(device) for device in self.conf.devices
+            if not device.startswith("cuda") or torch.cuda.is_available()]
+
+        # The benchmark never saves results of the trainer it creates
+        self.config.train.should_save = False
+
+        gym.register(BENCHMARK_ENV_NAME, lambda: SCEnv(SCFakeGame))
+
+    def get_scenarios(self):
+        return {
+            "startup": self.bench_startup,
+            "codec": self.bench_codec,
+            "action_decode": self.bench_action_decode,
+            "socket_round_trip": self.bench_socket_round_trip,
+            "capture": self.bench_capture,
+            "env_step": self.bench_env_step,
+            "preprocess": self.bench_preprocess,
+            "policy_forward": self.bench_policy_forward,
+            "ppo_update": self.bench_ppo_update,
+            "collect_train": self.bench_collect_train,
+            "data_parallel": self.bench_data_parallel,
+        }
+
+    def run(self):
+        start_img_size = self.config.model.img_size
+        start_recurrent = self.config.model.recurrent.enabled
+        try:
+            for name, scenario in self.get_scenarios().items():
+                if self.scenario_names and name not in self.scenario_names:
+                    continue
+
+                print(f"{name}:")
+                scenario()
+        finally:
+            self.config.model.img_size = start_img_size
+            self.config.model.recurrent.enabled = start_recurrent
+
+        return self.results
+
+    def measure(self, key, fn, items=1, repeats=None, device=None):
+        repeats = repeats or self.conf.repeats
+        is_cuda = device is not None and device.type == "cuda"
+
+        for _ in range(self.conf.warmup):
+            fn()
+
+        times = []
+        for _ in range(repeats):
+            start_time = perf_counter()
+            fn()
+            if is_cuda:
+                torch.cuda.synchronize(device)
+            times.append(perf_counter() - start_time)
+
+        result = summarize(times, items)
+        self.results[key] = result
+        print(f"  {key}: median={result['median'] * 1000:.3f}ms, p90={result['p90'] * 1000:.3f}ms, " \
+            f"{result['items_per_second']:.1f}/s")
+
+    def bench_startup(self):
+        # A new interpreter per repeat, run from the repo root like the .bat files
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join([src_dir] + [path for path in [env.get("PYTHONPATH")] if path])
+
+        for mode_name in ["PLAY", "FAKE_INFER", "TRAIN", "INFER", "LEARNER", "WORKER", "EVAL"]:
+            output = None
+            def startup():
+                nonlocal output
+                output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, mode_name], cwd=os.path.dirname(src_dir),
+                    env=env, check=True, capture_output=True, text=True).stdout
+
+            key = get_case_key("startup", mode=mode_name.lower())
+            self.measure(key, startup, repeats=self.conf.startup_repeats)
+            self.results[key]["imports_torch"] = output.strip().endswith("True")
+            print(f"  {key}: imports torch: {self.results[key]['imports_torch']}")
+
+    def bench_codec(self):
+        step_data = "-128.00,512.50,372.00,90.00,1.50,300.25,-20.00,301.00,0,10.50,1234"
+
+        def codec():
+            for _ in range(_CODEC_MESSAGE_COUNT):
+                message = Message.decode(Message(MESSAGE_TYPE.STEP, step_data).encode().decode())
+                PlayerState.decode(message.data)
+
+        self.measure(get_case_key("codec"), codec, items=_CODEC_MESSAGE_COUNT)
+
+    def bench_action_decode(self):
+        rng = np.random.default_rng(0)
+        for batch_size in self.conf.batch_sizes:
+            actions = rng.random((batch_size, SCEnv.button_count + SCEnv.mouse_count), dtype=np.float32)
+            self.measure(get_case_key("action_decode", batch_size=batch_size), lambda: decode_actions(actions),
+                items=batch_size)
+
+    def bench_socket_round_trip(self):
+        game = self._create_game()
+        try:
+            async def round_trip():
+                await game.send_message(MESSAGE_TYPE.STEP, "0")
+                await game.wait_for_message(MESSAGE_TYPE.STEP)
+
+            self.measure(get_case_key("socket_round_trip"), lambda: run_async(round_trip()))
+        finally:
+            game.close()
+
+    def bench_capture(self):
+        for img_size in self.conf.img_sizes:
+            self.config.model.img_size = img_size
+            game = self._create_game()
+            try:
+                def capture():
+                    pixels, _ = run_async(game.capture())
+                    game.preprocess(pixels)
+
+                self.measure(get_case_key("capture", img_size=img_size), capture)
+            finally:
+                game.close()
+
+    def bench_env_step(self):
+        for img_size in self.conf.img_sizes:
+            self.config.model.img_size = img_size
+            env = create_torchrl_env(None, self.config.train.map, base_only=True, env_name=BENCHMARK_ENV_NAME)
+            try:
+                action = env.env._fake_action()
+                self.measure(get_case_key("env_step", img_size=img_size), lambda: env.env.step(action))
+            finally:
+                env.close()
+
+    def get_preprocess_pipelines(self):
+        pipelines = {"config": self.config.model.preprocess}
+        pipelines.update({name: ops for name, ops in self.conf.preprocess.__dict__.items() if name != "_depth"})
+        return {name: ops for name, ops in pipelines.items() if ops}
+
+    def bench_preprocess(self):
+        # From host pixels, since the upload is part of what the pipeline saves on when it shrinks the frame
+        for img_size in self.conf.img_sizes:
+            input_shape = (3, img_size, img_size)
+            for device in self.devices:
+                for name, ops in self.get_preprocess_pipelines().items():
+                    module, output_shape = create_preprocess(ops, input_shape, device)
+                    for batch_size in self.conf.batch_sizes:
+                        host_pixels = torch.rand((batch_size, *input_shape))
+
+                        def preprocess():
+                            module(host_pixels.to(device, non_blocking=True))
+
+                        key = get_case_key("preprocess", pipeline=name, img_size=img_size, batch_size=batch_size,
+                            device=device)
+                        self.measure(key, preprocess, items=batch_size, device=device)
+                        self.results[key]["output_shape"] = list(output_shape)
+
+    def get_model_cases(self):
+        """Yields (img_size, device, recurrent) and sets up the config for each."""
+        for img_size in self.conf.img_sizes:
+            self.config.model.img_size = img_size
+            for device in self.devices:
+                for recurrent in self.conf.recurrent:
+                    self.config.model.recurrent.enabled = recurrent
+                    yield img_size, device, recurrent
+
+    def bench_policy_forward(self):
+        for img_size, device, recurrent in self.get_model_cases():
+            observation_spec, action_spec = create_specs(device)
+            models = create_models(observation_spec, action_spec, device)
+
+            for batch_size in self.conf.batch_sizes:
+                td = create_fake_observation(models, observation_spec, batch_size, device)
+
+                def forward():
+                    with torch.no_grad():
+                        models.actor(td.clone(False))
+
+                key = get_case_key("policy_forward", img_size=img_size, batch_size=batch_size, device=device,
+                    recurrent=recurrent)
+                self.measure(key, forward, items=batch_size, device=device)
+
+    def bench_ppo_update(self):
+        for img_size, device, recurrent in self.get_model_cases():
+            observation_spec, action_spec = create_specs(device)
+
+            for batch_size in self.conf.batch_sizes:
+                frames_per_batch = self.get_update_frames(batch_size, recurrent)
+                trainer = self._create_trainer(observation_spec, action_spec, device, frames_per_batch)
+                data = create_fake_rollout(trainer.models, observation_spec, frames_per_batch, device)
+
+                key = get_case_key("ppo_update", img_size=img_size, batch_size=batch_size, device=device,
+                    recurrent=recurrent)
+                self.measure(key, lambda: trainer.train_batch(data.clone()), items=frames_per_batch,
+                    repeats=self.conf.train_repeats, device=device)
+
+    def get_update_frames(self, batch_size, recurrent):
+        # batch_size is the mini batch size, like during training. Recurrent mini batches hold sequences.
+        frames_per_batch = batch_size * self.config.train.loss.mini_batches_per_batch
+        if recurrent:
+            recurrent_conf = self.config.model.recurrent
+            frames_per_batch = frames_per_batch * recurrent_conf.sequence_length + recurrent_conf.burn_in
+        return frames_per_batch
+
+    def bench_data_parallel(self):
+        # ppo_update with every mini batch split across processes, on CPU only. The thread budget of the
+        # trainer's process is changed for each count, so it's restored for the scenarios after this one.
+        data_parallel_conf = self.config.train.data_parallel
+        start_enabled, start_processes = data_parallel_conf.enabled, data_parallel_conf.processes
+        start_threads = torch.get_num_threads()
+        batch_size = self.conf.data_parallel_batch_size
+        try:
+            for img_size, device, recurrent in self.get_model_cases():
+                if device.type != "cpu":
+                    continue
+
+                observation_spec, action_spec = create_specs(device)
+                frames_per_batch = self.get_update_frames(batch_size, recurrent)
+                for processes in self.conf.data_parallel_processes:
+                    data_parallel_conf.enabled, data_parallel_conf.processes = True, processes
+                    trainer = self._create_trainer(observation_spec, action_spec, device, frames_per_batch)
+                    try:
+                        data = create_fake_rollout(trainer.models, observation_spec, frames_per_batch, device)
+
+                        key = get_case_key("data_parallel", img_size=img_size, batch_size=batch_size,
+                            recurrent=recurrent, processes=processes)
+                        self.measure(key, lambda: trainer.train_batch(data.clone()), items=frames_per_batch,
+                            repeats=self.conf.train_repeats, device=device)
+                        # The first batch compared against the single process update
+                        self.results[key]["max_weight_diff"] = trainer.data_parallel.max_weight_diff
+                    finally:
+                        trainer.data_parallel.close()
+        finally:
+            data_parallel_conf.enabled, data_parallel_conf.processes = start_enabled, start_processes
+            torch.set_num_threads(start_threads)
+
+    def bench_collect_train(self):
+        frames_per_batch = self.conf.collect_frames
+        for img_size, device, recurrent in self.get_model_cases():
+            env = create_torchrl_env(None, self.config.train.map, env_name=BENCHMARK_ENV_NAME, device=device)
+            trainer = self._create_trainer(env.observation_spec, env.action_spec, device, frames_per_batch)
+            add_model_transforms(env, trainer.models)
+            collector = SyncDataCollector(
+                create_env_fn=env,
+                policy=trainer.models.actor,
+                frames_per_batch=frames_per_batch,
+                total_frames=-1,
+                device=device,
+                max_frames_per_traj=-1,
+            )
+            try:
+                collector_iter = iter(collector)
+
+                def collect_train():
+                    data = next(collector_iter)
+                    trainer.train_batch(data)
+                    collector.update_policy_weights_()
+
+                key = get_case_key("collect_train", img_size=img_size, device=device, recurrent=recurrent)
+                self.measure(key, collect_train, items=frames_per_batch, repeats=self.conf.train_repeats,
+                    device=device)
+            finally:
+                collector.shutdown()
+
+    def _create_game(self):
+        game = SCFakeGame(None)
+        run_async(game.init(None, self.config.train.map, True))
+        return game
+
+    def _create_trainer(self, observation_spec, action_spec, device, frames_per_batch):
+        trainer = SCTrain(None)
+        trainer.init_config()
+        trainer.device = device
+        trainer.models = create_models(observation_spec, action_spec, device)
+        trainer.stats = SCStats(torch.zeros((), dtype=torch.int64, device=device), [], self.config.env.game_speed)
+
+        # Plenty of updates left, so lr annealing never reaches 0 while timing
+        trainer.init_learner(frames_per_batch, frames_per_batch * 1000)
+        return trainer
+
+    def get_meta(self):
+        return {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump({"meta": self.get_meta(), "results": self.results}, file, indent=1)
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as file:
+        return json.load(file)
+
+def print_comparison(results, baseline, tolerance):
+    ratios, regressions = compare(results, baseline["results"], tolerance)
+
+    print(f"Compared to baseline from {baseline['meta']['date']} (tolerance: {tolerance * 100:.0f}%):")
+    for key in results:
+        if key not in ratios:
+            print(f"  {key}: new")
+            continue
+
+        status = "REGRESSION" if key in regressions else ""
+        print(f"  {key}: {ratios[key]:.2f}x {status}")
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless SurfChan benchmarks")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run. Runs all when empty.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    args = parser.parse_args()
+
+    benchmark = SCBenchmark(args.scenarios)
+    benchmark.run()
+
+    conf = benchmark.conf
+    results_path = os.path.join(conf.results_dir, f"{datetime.now().strftime('%d-%m_%H-%M')}_benchmark.json")
+    benchmark.save(results_path)
+    print(f"Saved results to {results_path}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(conf.baseline_path), exist_ok=True)
+        shutil.copy2(results_path, conf.baseline_path)
+        print(f"Saved baseline to {conf.baseline_path}")
+        sys.exit(0)
+
+    baseline = load_baseline(conf.baseline_path)
+    if baseline is None:
+        print(f"No baseline at {conf.baseline_path}, run with --save-baseline to create one")
+        sys.exit(0)
+
+    regressions = print_comparison(benchmark.results, baseline, conf.tolerance)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,135 @@
+from collections import deque
+import numpy as np
+
+class SCCurriculum():
+    """Picks the map to train on from each map's recent success and learning progress.
+
+    Learning progress is how much the success rate changed between the older and newer half of a
+    map's recent episodes, in either direction. Maps are picked in proportion to it, so time goes to
+    maps that are still being learned or forgotten instead of ones that are mastered or out of reach.
+    Maps without episodes are picked first.
+
+    A map is kept for episodes_per_switch episodes. The next one is picked prefetch_episodes before
+    the switch, so its files can be read ahead while the current map finishes.
+    """
+
+    def __init__(self, conf, maps_conf, start_map, rng=None):
+        self.conf = conf
+        self.maps = list(conf.maps)
+        unknown_maps = [map_name for map_name in self.maps if not hasattr(maps_conf, map_name)]
+        if not self.maps or unknown_maps:
+            raise ValueError(f"Curriculum maps must be listed in maps, unknown: {', '.join(unknown_maps) or 'none given'}")
+
+        self.rng = rng or np.random.default_rng()
+        self.current_map = start_map if start_map in self.maps else self.maps[0]
+        self.next_map = None
+        self.should_prefetch = False
+        self.episodes_left = conf.episodes_per_switch
+        self.switches = 0
+        self.last_switch_time = 0.0
+
+        self.results = {map_name: deque(maxlen=conf.window) for map_name in self.maps}
+        self.steps = {map_name: 0 for map_name in self.maps}
+        self.times = {map_name: 0.0 for map_name in self.maps}
+
+    def record_episode(self, success, steps, duration):
+        self.results[self.current_map].append(float(success))
+        self.steps[self.current_map] += steps
+        self.times[self.current_map] += duration
+
+        self.episodes_left -= 1
+        if self.next_map is None and self.episodes_left <= self.conf.prefetch_episodes:
+            self.next_map = self.pick_map()
+            self.should_prefetch = self.next_map != self.current_map
+
+    def pop_prefetch(self):
+        """Returns the picked next map once, if it has to be loaded."""
+        if not self.should_prefetch:
+            return None
+
+        self.should_prefetch = False
+        return self.next_map
+
+    def should_switch(self):
+        return self.episodes_left <= 0
+
+    def switch(self):
+        """Moves on to the picked map and returns it. It may be the current one."""
+        map_name = self.next_map or self.pick_map()
+        if map_name != self.current_map:
+            print(f"Curriculum: {self.current_map} -> {map_name}")
+            self.switches += 1
+
+        self.current_map = map_name
+        self.next_map = None
+        self.should_prefetch = False
+        self.episodes_left = self.conf.episodes_per_switch
+        return map_name
+
+    def record_switch_time(self, switch_time):
+        self.last_switch_time = switch_time
+
+    def pick_map(self):
+        unplayed_maps = [map_name for map_name in self.maps if not self.results[map_name]]
+        if unplayed_maps:
+            return unplayed_maps[0]
+
+        if self.rng.random() < self.conf.exploration:
+            return self.maps[self.rng.integers(len(self.maps))]
+
+        progress = np.array([self.get_learning_progress(map_name) for map_name in self.maps])
+        if progress.sum() <= 0.0:
+            return self.maps[self.rng.integers(len(self.maps))]
+
+        return self.maps[self.rng.choice(len(self.maps), p=progress / progress.sum())]
+
+    def get_success_rate(self, map_name):
+        results = self.results[map_name]
+        return sum(results) / len(results) if results else 0.0
+
+    def get_learning_progress(self, map_name):
+        results = list(self.results[map_name])
+        if len(results) < 2:
+            return 0.0
+
+        half = len(results) // 2
+        older_rate = sum(results[:half]) / half
+        newer_rate = sum(results[half:]) / (len(results) - half)
+        return abs(newer_rate - older_rate)
+
+    def get_metrics(self, prefix=""):
+        metrics = {
+            f"{prefix}map_index": self.maps.index(self.current_map),
+            f"{prefix}switches": self.switches,
+            f"{prefix}switch_time": self.last_switch_time,
+        }
+        for map_name in self.maps:
+            map_time = self.times[map_name]
+            metrics.update({
+                f"{prefix}{map_name}/success_rate": self.get_success_rate(map_name),
+                f"{prefix}{map_name}/learning_progress": self.get_learning_progress(map_name),
+                f"{prefix}{map_name}/steps_per_second": self.steps[map_name] / map_time if map_time > 0.0 else 0.0,
+                f"{prefix}{map_name}/episodes": len(self.results[map_name]),
+            })
+
+        return metrics
+
+if __name__ == "__main__":
+    from types import SimpleNamespace
+
+    # Map a is mastered, b is being learned and c is out of reach. b should be picked most.
+    conf = SimpleNamespace(maps=["a", "b", "c"], episodes_per_switch=5, prefetch_episodes=1, window=40, exploration=0.1)
+    maps_conf = SimpleNamespace(a=None, b=None, c=None)
+    curriculum = SCCurriculum(conf, maps_conf, "a", np.random.default_rng(0))
+    success_chances = {"a": lambda episode: 1.0, "b": lambda episode: min(episode / 200, 1.0), "c": lambda episode: 0.0}
+
+    rng = np.random.default_rng(1)
+    episodes = {map_name: 0 for map_name in conf.maps}
+    for _ in range(300):
+        map_name = curriculum.current_map
+        episodes[map_name] += 1
+        curriculum.record_episode(rng.random() < success_chances[map_name](episodes[map_name]), 100, 1.0)
+        if curriculum.should_switch():
+            curriculum.switch()
+
+    print(f"Episodes per map: {episodes}, switches: {curriculum.switches}")
@@ -0,0 +1,285 @@
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from tensordict import TensorDict
+from torchrl._utils import _standardize
+from torchrl.modules import set_recurrent_mode
+import sc_config
+
+# Separator used to flatten nested tensordict keys for the queue
+KEY_SEP = "."
+
+# Control message from rank 0: command, mini batch rows, lr, clip epsilon, entropy coefficient
+_COMMAND_STOP = 0
+_COMMAND_UPDATE = 1
+_COMMAND_SYNC = 2
+_CONTROL_SIZE = 5
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def get_thread_budget(conf):
+    """(intra-op, inter-op) threads of each process. null intra-op threads split the cores evenly."""
+    intra_op_threads = conf.intra_op_threads or max((os.cpu_count() or 1) // conf.processes, 1)
+    return intra_op_threads, conf.interop_threads
+
+def set_thread_budget(intra_op_threads, interop_threads):
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # Only possible before the first inter-op parallel work, which rank 0 may have done already
+        print(f"Data parallel: inter-op threads stay at {torch.get_num_interop_threads()}")
+
+def get_shard(rows, rank, world_size):
+    return rows * rank // world_size, rows * (rank + 1) // world_size
+
+def get_parameters(models):
+    return list(models.loss_module.parameters())
+
+def get_optimizer_tensors(models):
+    tensors = []
+    for param in get_parameters(models):
+        param_state = models.optimizer.state.get(param, {})
+        tensors += [param_state[key] for key in sorted(param_state) if isinstance(param_state[key], torch.Tensor)]
+    return tensors
+
+def all_reduce_gradients(params):
+    # One flat all-reduce instead of one per parameter
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in params]
+    flat_grads = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat_grads)
+    for param, grad in zip(params, flat_grads.split([grad.numel() for grad in grads])):
+        param.grad = grad.view_as(param)
+
+def shard_backward(models, batch, rows, rank, world_size):
+    """Loss and backward of this rank's shard of the rows of batch, with the gradients summed over all
+    ranks. Every loss term is a mean, so each shard's is weighted by its share of rows and the sum is
+    the gradient of the whole mini batch."""
+    start, end = get_shard(rows, rank, world_size)
+    params = get_parameters(models)
+    loss = None
+    loss_terms = torch.zeros(3)
+    if end > start:
+        with set_recurrent_mode(models.is_recurrent() or None):
+            loss = models.loss_module(batch[start:end])
+        weight = (end - start) / rows
+        loss_sum = (loss["loss_critic"] + loss["loss_objective"] + loss["loss_entropy"]) * weight
+        loss_sum.backward()
+        loss_terms = torch.stack([loss["loss_critic"], loss["loss_objective"], loss["loss_entropy"]]).detach() * weight
+
+    all_reduce_gradients(params)
+    # The logged losses are the whole mini batch's too
+    dist.all_reduce(loss_terms)
+    return loss, loss_terms
+
+class SCDataParallel():
+    """Splits every PPO mini batch across train.data_parallel.processes CPU processes.
+
+    The trainer's process is rank 0, the others are replicas started with the same config, weights
+    and optimizer state. Rank 0 copies each mini batch into shared memory and broadcasts the lr,
+    clip epsilon and entropy coefficient over gloo. Every rank computes the loss of its rows and
+    backpropagates, the gradients are all-reduced and every rank clips and steps its own optimizer
+    with them, so the weights stay the same everywhere without being sent.
+
+    Advantage normalization needs the statistics of the whole mini batch, so rank 0 normalizes
+    before splitting and the loss modules don't.
+    """
+
+    shared_batch = None
+    max_weight_diff = None
+
+    def __init__(self, models, conf, device):
+        if device.type != "cpu":
+            raise ValueError(f"train.data_parallel runs on CPU processes, the trainer is on {device}")
+
+        self.models = models
+        self.conf = conf
+        self.world_size = conf.processes
+        self.should_check = conf.check
+        self.intra_op_threads, self.interop_threads = get_thread_budget(conf)
+        set_thread_budget(self.intra_op_threads, self.interop_threads)
+
+        self.normalize_advantage = models.loss_module.normalize_advantage
+        models.loss_module.normalize_advantage = False
+
+        port = get_free_port()
+        state = {
+            "actor": models.actor.state_dict(),
+            "critic": models.critic.state_dict(),
+            "optimizer": models.optimizer.state_dict(),
+        }
+        context = mp.get_context("spawn")
+        self.batch_queues = []
+        self.processes = []
+        for rank in range(1, self.world_size):
+            batch_queue = context.Queue()
+            process = context.Process(target=_run_replica, args=(rank, self.world_size, port, sc_config.get_config(),
+                state, batch_queue), daemon=True)
+            process.start()
+            self.batch_queues.append(batch_queue)
+            self.processes.append(process)
+
+        dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=0, world_size=self.world_size)
+        print(f"Data parallel: {self.world_size} processes, {self.intra_op_threads} intra-op and " \
+            f"{self.interop_threads} inter-op threads each")
+
+    def get_shared_batch(self, batch, capacity):
+        if self.shared_batch is None:
+            # Sized for the largest mini batch and sent once, later mini batches are copied into it
+            self.shared_batch = batch[:1].expand(capacity, *batch.shape[1:]).clone().share_memory_()
+            tensors = {key: value for key, value in self.shared_batch.flatten_keys(KEY_SEP).items()}
+            for batch_queue in self.batch_queues:
+                batch_queue.put((tensors, self.shared_batch.batch_size))
+
+        rows = batch.shape[0]
+        if rows > self.shared_batch.shape[0]:
+            raise ValueError(f"Mini batch of {rows} rows is larger than the first one of {self.shared_batch.shape[0]}")
+        return self.shared_batch
+
+    def backward(self, batch, capacity):
+        """Fills the gradients of the loss module with those of batch. Returns the loss of rank 0's rows
+        with the loss terms of the whole batch."""
+        if self.normalize_advantage and batch["advantage"].numel() > 1:
+            batch.set("advantage", _standardize(batch["advantage"]))
+
+        rows = batch.shape[0]
+        if rows < self.world_size:
+            raise ValueError(f"Mini batch of {rows} rows can't be split across {self.world_size} processes")
+        shared_batch = self.get_shared_batch(batch, capacity)
+        shared_batch[:rows].update_(batch)
+
+        loss_module = self.models.loss_module
+        # Annealing makes lr a tensor, Adam uses it as a float
+        lr = float(self.models.optimizer.param_groups[0]["lr"])
+        self._broadcast_control(_COMMAND_UPDATE, rows, lr, loss_module.clip_epsilon.item(),
+            loss_module.entropy_coef.item())
+
+        loss, loss_terms = shard_backward(self.models, shared_batch, rows, 0, self.world_size)
+        loss.set("loss_critic", loss_terms[0])
+        loss.set("loss_objective", loss_terms[1])
+        return loss.set("loss_entropy", loss_terms[2])
+
+    def sync(self):
+        """Sends rank 0's weights and optimizer state to the replicas, after they were changed outside of
+        updates, e.g. restored."""
+        self._broadcast_control(_COMMAND_SYNC)
+        _broadcast_state(self.models)
+
+    def check(self, trainer, batch):
+        """Runs one update on batch with and without data parallel from the same state and returns the
+        largest difference between the resulting weights. The entropy term is left out, since its mouse
+        part is a one sample estimate that differs between the runs. The trainer and replicas are back
+        in their starting state afterwards."""
+        self.should_check = False
+        loss_module = self.models.loss_module
+        state = trainer.get_warmup_state()
+        entropy_coef = loss_module.entropy_coef.clone()
+        loss_module.entropy_coef.zero_()
+        try:
+            trainer.data_parallel = None
+            loss_module.normalize_advantage = self.normalize_advantage
+            trainer.update(batch.clone())
+            single_params = [param.detach().clone() for param in get_parameters(self.models)]
+
+            trainer.restore_warmup_state(state)
+            trainer.data_parallel = self
+            loss_module.normalize_advantage = False
+            trainer.update(batch.clone())
+            parallel_params = [param.detach().clone() for param in get_parameters(self.models)]
+        finally:
+            trainer.data_parallel = self
+            loss_module.normalize_advantage = False
+            loss_module.entropy_coef.copy_(entropy_coef)
+            trainer.restore_warmup_state(state)
+            self.sync()
+
+        self.max_weight_diff = max((single - parallel).abs().max().item()
+            for single, parallel in zip(single_params, parallel_params))
+        print(f"Data parallel: largest weight difference to the single process update {self.max_weight_diff:.3g}")
+        return self.max_weight_diff
+
+    def _broadcast_control(self, command, rows=0, lr=0.0, clip_epsilon=0.0, entropy_coef=0.0):
+        control = torch.tensor([command, rows, lr, clip_epsilon, entropy_coef], dtype=torch.float64)
+        dist.broadcast(control, 0)
+
+    def close(self):
+        if not dist.is_initialized():
+            return
+
+        self._broadcast_control(_COMMAND_STOP)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        dist.destroy_process_group()
+        self.models.loss_module.normalize_advantage = self.normalize_advantage
+
+def _broadcast_state(models):
+    with torch.no_grad():
+        for tensor in get_parameters(models) + get_optimizer_tensors(models):
+            dist.broadcast(tensor, 0)
+
+def _run_replica(rank, world_size, port, config, state, batch_queue):
+    # Imported here, so the parent process doesn't pay for it when data parallel is off
+    from sc_model_utils import create_models
+    from SCEnv import create_specs
+
+    # Replicas build the same models from the same config, including changes made at runtime
+    sc_config._config = config
+    conf = config.train.data_parallel
+    set_thread_budget(*get_thread_budget(conf))
+
+    device = torch.device("cpu")
+    observation_spec, action_spec = create_specs(device)
+    models = create_models(observation_spec, action_spec, device)
+    models.actor.load_state_dict(state["actor"])
+    models.critic.load_state_dict(state["critic"])
+    models.optimizer.load_state_dict(state["optimizer"])
+    models.loss_module.normalize_advantage = False
+    del state
+
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    shared_batch = None
+    control = torch.zeros(_CONTROL_SIZE, dtype=torch.float64)
+    try:
+        while True:
+            dist.broadcast(control, 0)
+            command = int(control[0])
+            if command == _COMMAND_STOP:
+                break
+            if command == _COMMAND_SYNC:
+                _broadcast_state(models)
+                continue
+
+            if shared_batch is None:
+                tensors, batch_size = batch_queue.get()
+                shared_batch = TensorDict(tensors, batch_size=batch_size).unflatten_keys(KEY_SEP)
+
+            # The same steps as SCTrain.update after the loss
+            rows, lr, clip_epsilon, entropy_coef = int(control[1]), *control[2:].tolist()
+            models.optimizer.zero_grad(set_to_none=True)
+            for group in models.optimizer.param_groups:
+                group["lr"] = lr
+            models.loss_module.clip_epsilon.fill_(clip_epsilon)
+            models.loss_module.entropy_coef.fill_(entropy_coef)
+
+            shard_backward(models, shared_batch, rows, rank, world_size)
+            torch.nn.utils.clip_grad_norm_(models.loss_module.parameters(),
+                max_norm=config.train.loss.max_gradient_norm)
+            models.optimizer.step()
+    finally:
+        dist.destroy_process_group()
+
+if __name__ == "__main__":
+    import sys
+    from SCBenchmark import SCBenchmark
+
+    # Parity with the single process update, then scaling over 1..N processes on fake rollouts
+    if len(sys.argv) > 1:
+        sc_config.get_config().benchmark.data_parallel_processes = [int(arg) for arg in sys.argv[1:]]
+    SCBenchmark(["data_parallel"]).run()
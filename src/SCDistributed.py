@@ -0,0 +1,322 @@
+import os
+import asyncio
+import queue
+import socket
+import tqdm
+import torch
+from tensordict import TensorDict
+from torchrl.collectors import SyncDataCollector
+from sc_config import get_config
+from sc_model_utils import get_torch_device, get_models, create_models, add_model_transforms
+from sc_transport import FRAME_TYPE, read_frame, write_frame
+from sc_shared_weights import SCSharedWeightsWriter, SCSharedWeightsReader
+from sc_utils import run_async, run_async_nowait
+from SCEnv import create_torchrl_env, create_specs
+from SCPolicyServer import SCPolicyServer, SCRemotePolicy
+from SCTrain import SCTrain
+from SCTimer import sc_timer
+from SCTelemetry import sc_telemetry
+
+# Separator used to flatten nested tensordict keys for the transport
+KEY_SEP = "."
+
+def tensordict_to_arrays(td):
+    arrays = {}
+    for key, value in td.flatten_keys(KEY_SEP).items():
+        value = value.detach()
+        # Frames are sent as uint8, which is 4x smaller than the float observations
+        if key.endswith("pixels"):
+            value = (value * 255.0).round().to(torch.uint8)
+        arrays[key] = value.cpu().numpy()
+
+    return arrays
+
+def arrays_to_tensordict(arrays, batch_size, device):
+    tensors = {}
+    for key, array in arrays.items():
+        tensor = torch.from_numpy(array).to(device, non_blocking=True)
+        if key.endswith("pixels"):
+            tensor = tensor.float().div_(255.0)
+        tensors[key] = tensor
+
+    return TensorDict(tensors, batch_size=batch_size, device=device).unflatten_keys(KEY_SEP)
+
+def state_dict_to_arrays(state_dict):
+    # Copy, so training can continue while the weights are being sent
+    return {key: value.detach().to("cpu", copy=True).numpy() for key, value in state_dict.items()}
+
+def arrays_to_state_dict(arrays):
+    return {key: torch.from_numpy(array) for key, array in arrays.items()}
+
+def check_policy_server_support(config):
+    # Requests only carry pixels, not the hidden state of a recurrent model
+    if config.model.recurrent.enabled:
+        raise ValueError("The policy server doesn't support recurrent models, disable distributed.policy_server or model.recurrent")
+
+def get_shared_weights_name(config):
+    return f"surfchan_weights_{config.distributed.port}"
+
+class SCLearner(SCTrain):
+    server = None
+    workers = None
+    chunk_queue = None
+    publish_future = None
+    policy_server = None
+    shared_weights = None
+    version = 0
+
+    async def train(self):
+        self.init_config()
+        self.dist_conf = self.config.distributed
+
+        frames_per_batch = self.collector_conf.frames_per_batch
+        total_frames = frames_per_batch * self.collector_conf.batches
+        frames_per_chunk = self.dist_conf.frames_per_chunk
+        if frames_per_batch % frames_per_chunk != 0:
+            raise ValueError(f"frames_per_chunk ({frames_per_chunk}) must divide frames_per_batch ({frames_per_batch})")
+        chunks_per_batch = frames_per_batch // frames_per_chunk
+
+        observation_spec, action_spec = create_specs(self.device)
+        self.models, self.stats = get_models(observation_spec, action_spec, self.device)
+
+        self.init_learner(frames_per_batch, total_frames, frames_per_chunk)
+
+        # Filled from the background loop, so receiving overlaps with training
+        self.workers = {}
+        self.chunk_queue = queue.Queue(maxsize=chunks_per_batch * 2)
+        self.weight_arrays = state_dict_to_arrays(self.models.actor.state_dict())
+        if self.dist_conf.shared_weights:
+            self.shared_weights = SCSharedWeightsWriter(get_shared_weights_name(self.config), self.models.actor.state_dict())
+            self.shared_weights.write(self.models.actor.state_dict(), self.version)
+        self.server = run_async(asyncio.start_server(self.handle_worker, self.dist_conf.host, self.dist_conf.port))
+        print(f"Learner listening on {self.dist_conf.host}:{self.dist_conf.port}")
+
+        policy_server_conf = self.dist_conf.policy_server
+        if policy_server_conf.enabled:
+            check_policy_server_support(self.config)
+            self.policy_server = SCPolicyServer(self.models.actor, self.device,
+                policy_server_conf.max_batch_size, policy_server_conf.max_latency_ms / 1000.0)
+            self.policy_server.start(policy_server_conf.host, policy_server_conf.port)
+
+        collected_frames = 0
+        pbar = tqdm.tqdm(total=total_frames)
+
+        sc_timer.start("training")
+
+        while collected_frames < total_frames:
+            sc_timer.start("collecting", "tb")
+            chunks = []
+            policy_lags = []
+            while len(chunks) < chunks_per_batch:
+                chunk, chunk_version = await asyncio.to_thread(self.chunk_queue.get)
+                chunks.append(chunk)
+                policy_lags.append(self.version - chunk_version)
+            sc_timer.stop("collecting", "tb")
+
+            # One row per chunk, so GAE never crosses trajectories of different workers
+            data = torch.stack(chunks, 0)
+
+            frames_in_batch = data.numel()
+            collected_frames += frames_in_batch
+            pbar.update(frames_in_batch)
+
+            metrics_to_log = self.train_batch(data)
+
+            self.version += 1
+            if self.policy_server is not None:
+                self.policy_server.update_weights(self.models.actor, self.version)
+            elif self.shared_weights is not None:
+                self.shared_weights.write(self.models.actor.state_dict(), self.version)
+            else:
+                self.publish_weights()
+
+            policy_lag = sum(policy_lags) / len(policy_lags)
+            if sc_telemetry.is_running:
+                sc_telemetry.set_values({"distributed/workers": len(self.workers), "distributed/policy_lag": policy_lag,
+                    "distributed/policy_lag_max": max(policy_lags), "distributed/version": self.version})
+
+            if self.logger:
+                metrics_to_log.update(sc_timer.to_dict("tb", "time/"))
+                metrics_to_log["time/speed"] = pbar.format_dict["rate"]
+                metrics_to_log["distributed/workers"] = len(self.workers)
+                metrics_to_log["distributed/policy_lag"] = policy_lag
+                metrics_to_log["distributed/policy_lag_max"] = max(policy_lags)
+                if self.policy_server is not None:
+                    metrics_to_log.update(self.policy_server.get_metrics())
+                self.log_metrics(metrics_to_log, collected_frames)
+
+        pbar.close()
+
+    async def handle_worker(self, reader, writer):
+        worker_id = str(writer.get_extra_info('peername'))
+        try:
+            hello = await read_frame(reader)
+            worker_id = hello.meta.get("worker_id", worker_id)
+            print(f"Connected by rollout worker {worker_id}")
+
+            if self.policy_server is None and self.shared_weights is None:
+                await write_frame(writer, FRAME_TYPE.WEIGHTS, self.version, self.weight_arrays)
+            self.workers[worker_id] = writer
+
+            while True:
+                frame = await read_frame(reader)
+                if frame.type != FRAME_TYPE.TRAJECTORY:
+                    continue
+
+                batch_size = [frame.meta["frames"]]
+                chunk = arrays_to_tensordict(frame.arrays, batch_size, self.device)
+                await asyncio.to_thread(self.chunk_queue.put, (chunk, frame.version))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f"Rollout worker {worker_id} disconnected")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.workers.pop(worker_id, None)
+            writer.close()
+
+    def publish_weights(self):
+        # Only one publish in flight, a slow worker delays the next version instead of piling them up
+        if self.publish_future is not None:
+            self.publish_future.result()
+
+        self.weight_arrays = state_dict_to_arrays(self.models.actor.state_dict())
+        self.publish_future = run_async_nowait(self._publish_weights(self.version, self.weight_arrays))
+
+    async def _publish_weights(self, version, weight_arrays):
+        for worker_id, writer in list(self.workers.items()):
+            try:
+                await write_frame(writer, FRAME_TYPE.WEIGHTS, version, weight_arrays)
+            except ConnectionError:
+                self.workers.pop(worker_id, None)
+
+    def close(self):
+        super().close()
+
+        if self.publish_future is not None:
+            self.publish_future.cancel()
+
+        if self.server is not None:
+            self.server.close()
+
+        if self.policy_server is not None:
+            self.policy_server.close()
+
+        if self.shared_weights is not None:
+            self.shared_weights.close()
+
+class SCRolloutWorker():
+    env = None
+    models = None
+    remote_policy = None
+    shared_weights = None
+    collector = None
+    writer = None
+    receive_future = None
+    latest_weights = None
+    policy_version = 0
+
+    def __init__(self, surfchan):
+        self.surfchan = surfchan
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    async def run(self):
+        self.config = get_config()
+        self.dist_conf = self.config.distributed
+
+        self.device = get_torch_device()
+
+        self.env = create_torchrl_env(self.surfchan, self.config.train.map)
+
+        # The connection lives on the background loop, so weights arrive while collecting
+        reader, self.writer = run_async(asyncio.open_connection(self.dist_conf.host, self.dist_conf.port))
+        run_async(write_frame(self.writer, FRAME_TYPE.HELLO, 0, {}, {"worker_id": self.worker_id}))
+        print(f"Connected to learner {self.dist_conf.host}:{self.dist_conf.port} as {self.worker_id}")
+
+        policy_server_conf = self.dist_conf.policy_server
+        if policy_server_conf.enabled:
+            check_policy_server_support(self.config)
+            # Actions come from the learner's batched actor, so there are no local weights to keep in sync
+            self.remote_policy = SCRemotePolicy(policy_server_conf.host, policy_server_conf.port)
+            policy = self.remote_policy
+        else:
+            self.models = create_models(self.env.observation_spec, self.env.action_spec, self.device)
+            add_model_transforms(self.env, self.models)
+            if self.dist_conf.shared_weights:
+                # Workers on the learner's host copy new versions straight from shared memory
+                self.shared_weights = SCSharedWeightsReader(get_shared_weights_name(self.config), self.models.actor.state_dict())
+                self.policy_version = self.shared_weights.read_into(self.models.actor.state_dict()) or 0
+            else:
+                self.load_weights(run_async(read_frame(reader)))
+            policy = self.models.actor
+        self.receive_future = run_async_nowait(self.receive_weights(reader))
+
+        self.collector = SyncDataCollector(
+            create_env_fn=self.env,
+            policy=policy,
+            frames_per_batch=self.dist_conf.frames_per_chunk,
+            total_frames=-1,
+            device=self.device,
+            max_frames_per_traj=-1,
+            trust_policy=self.remote_policy is not None,
+        )
+
+        # Episodes are cut like the trainer cuts them, once per batch. The learner bootstraps GAE at
+        # chunk ends, so episodes carry on across the chunks in between.
+        chunks_per_batch = max(self.config.train.collector.frames_per_batch // self.dist_conf.frames_per_chunk, 1)
+        for i, data in enumerate(self.collector):
+            await asyncio.sleep(0)
+
+            sc_timer.start("send", "dist")
+            arrays = tensordict_to_arrays(data)
+            meta = {"worker_id": self.worker_id, "frames": data.numel()}
+            if self.remote_policy is not None:
+                self.policy_version = self.remote_policy.version
+            run_async(write_frame(self.writer, FRAME_TYPE.TRAJECTORY, self.policy_version, arrays, meta))
+            sc_timer.stop("send", "dist")
+
+            if (i + 1) % chunks_per_batch == 0:
+                self.collector.reset()
+
+            if self.shared_weights is not None:
+                version = self.shared_weights.read_into(self.models.actor.state_dict())
+                if version is not None:
+                    self.policy_version = version
+                    self.collector.update_policy_weights_()
+
+            latest_weights = self.latest_weights
+            if latest_weights is not None and latest_weights.version != self.policy_version:
+                self.load_weights(latest_weights)
+                self.collector.update_policy_weights_()
+
+            if self.receive_future.done():
+                print("Learner closed the connection")
+                break
+
+    async def receive_weights(self, reader):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame.type == FRAME_TYPE.WEIGHTS:
+                    self.latest_weights = frame
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def load_weights(self, frame):
+        self.models.actor.load_state_dict(arrays_to_state_dict(frame.arrays))
+        self.policy_version = frame.version
+
+    def close(self):
+        if self.receive_future is not None:
+            self.receive_future.cancel()
+
+        if self.writer is not None:
+            self.writer.close()
+
+        if self.remote_policy is not None:
+            self.remote_policy.close()
+
+        if self.shared_weights is not None:
+            self.shared_weights.close()
+
+        if self.collector is not None:
+            self.collector.shutdown()
@@ -1,40 +1,50 @@
 import time
 import gymnasium as gym
 import numpy as np
-from torchrl.envs import (
-    TransformedEnv,
-    StepCounter,
-    RenameTransform,
-    ToTensorImage,
-    DoubleToFloat,
-    VecNorm,
-    RewardSum
-)
-from torchrl.envs.libs.gym import GymEnv
-from sc_utils import run_async, write_to_log
-from sc_model_utils import get_torch_device
+from sc_utils import run_async, run_async_nowait
+from sc_log import LOG_LEVEL, is_log_enabled, log_record
 from sc_config import get_config
 from SCGame import SCGame
+from SCSnapshotArchive import SCSnapshotArchive
+from SCSpeedTuner import SCSpeedTuner
 from SCTimer import sc_timer
+from SCTelemetry import sc_telemetry
 
 class SCEnv(gym.Env):
     target_step_time = None
+    snapshot_archive = None
+    speed_tuner = None
+    curriculum = None
+    last_step_end_time = None
     button_count = 6
     mouse_count = 2
     button_model_to_game = ["f", "b", "l", "r", "j", "c"]
     dist_milestone_step = 5
+    is_closed = False
 
-    def __init__(self):
+    def __init__(self, game_class=SCGame):
         super(SCEnv, self).__init__()
 
         self.config = get_config()
         self.output_count = self.button_count + self.mouse_count
 
-        self.truncate_time = self.config.env.seconds_to_finish / self.config.env.game_speed
+        # Episode time is measured in server ticks, so stalls and game_speed don't change the task
+        self.seconds_to_finish = self.config.env.seconds_to_finish
+        self.tickrate = self.config.server.tickrate
 
         self._clear_attributes()
 
-        self.game = SCGame(self)
+        self.game = game_class(self)
+
+        self.snapshot_conf = self.config.env.snapshots
+        if self.snapshot_conf.enabled:
+            self.snapshot_archive = SCSnapshotArchive(self.snapshot_conf.cell_size)
+        # Archives of the other maps, when a curriculum switches between them
+        self.snapshot_archives = {}
+
+        speed_tuner_conf = self.config.env.speed_tuner
+        if speed_tuner_conf.enabled:
+            self.speed_tuner = SCSpeedTuner(speed_tuner_conf, self.config.env.game_speed, speed_tuner_conf.lockstep_ticks)
 
         self.size = self.config.model.img_size
 
@@ -49,18 +59,34 @@ class SCEnv(gym.Env):
     def _clear_attributes(self):
         self.terminated = False
         self.truncated = False
-        self.time_till_truncate = None
+        self.start_tick = None
+        self.last_tick = None
         self.last_dist_milestone = None
+        self.episode_step = 0
+        self.episode_start_time = time.perf_counter()
     
-    async def init(self, surfchan, map_name, should_run_ai):
+    async def init(self, surfchan, map_name, should_run_ai, curriculum=None):
+        """With a curriculum, the episodes start on the map it picks instead of map_name."""
         self.surfchan = surfchan
+        self.curriculum = curriculum
+        if self.curriculum is not None:
+            map_name = self.curriculum.current_map
         await self.game.init(surfchan, map_name, should_run_ai)
+
+        if sc_telemetry.is_running:
+            sc_telemetry.add_source("messages/", lambda prefix: self.game.message_queue.get_metrics(prefix))
+            sc_telemetry.add_source("capture/", self.game.get_capture_metrics)
+            if self.speed_tuner is not None:
+                sc_telemetry.add_source("speed/", self.speed_tuner.get_metrics)
+            if self.curriculum is not None:
+                sc_telemetry.add_source("curriculum/", self.curriculum.get_metrics)
     
     def set_target_step_time(self, avg_step_time):
         # Steps are never shorter than target_step_time but occasionally longer. This balances it out.
         self.target_step_time = avg_step_time * 0.95
 
     def step(self, action):
+        step_start_time = time.perf_counter()
         if self.target_step_time is not None:
             step_time = sc_timer.stop("real_step")
             if step_time:
@@ -74,45 +100,81 @@ class SCEnv(gym.Env):
         if self.target_step_time is not None:
             sc_timer.start("real_step")
         
-        if self.time_till_truncate is None:
-            self.time_till_truncate = time.perf_counter()
-        elif self.game.should_run_ai and time.perf_counter() - self.time_till_truncate >= self.truncate_time:
-                self.truncated = True
-                obs, _ = self.reset()
-                return obs, 0.0, self.terminated, True, {}
+        if self.game.should_run_ai and self.start_tick is not None and self._get_episode_time() >= self.seconds_to_finish:
+            self.truncated = True
+            obs, _ = self.reset()
+            if sc_telemetry.is_running:
+                sc_telemetry.record_step(time.perf_counter() - step_start_time, 0.0, True, obs)
+            return obs, 0.0, self.terminated, True, {}
 
         game_action = self._action_to_game(action)
-        obs, player_pos, total_velocity = self._game_step(game_action)
-        reward = self._calc_reward(game_action, player_pos, total_velocity)
+        service_time = time.perf_counter() - self.last_step_end_time if self.last_step_end_time else 0.0
+        obs, player_state, is_duplicate = self._game_step(game_action)
+        if self.start_tick is None:
+            self.start_tick = player_state.tick
+        elif self.speed_tuner is not None and self.game.should_run_ai:
+            self._tune_speed(player_state.tick - self.last_tick, service_time)
+        self.last_tick = player_state.tick
+        reward = self._calc_reward(game_action, player_state.pos, player_state.total_velocity)
+
+        self.episode_step += 1
+        if self.snapshot_archive is not None and self.game.should_run_ai and not self.terminated \
+                and self.episode_step % self.snapshot_conf.interval == 0:
+            self._add_snapshot(player_state)
+
+        if is_log_enabled(LOG_LEVEL.TRACE):
+            log_record(LOG_LEVEL.TRACE, "step", step=self.episode_step, tick=player_state.tick, pos=player_state.pos,
+                velocity=player_state.total_velocity, buttons=game_action["buttons"], reward=reward,
+                terminated=self.terminated, duplicate=is_duplicate)
 
-        # print(obs)
-        # print(reward)
+        if sc_telemetry.is_running:
+            sc_telemetry.record_step(time.perf_counter() - step_start_time, reward, self.terminated, obs)
 
-        return obs, reward, self.terminated, self.truncated, {}
+        info = {"is_duplicate": np.float32(is_duplicate), "progress": np.float32(self.get_progress(player_state.pos))}
+        return obs, reward, self.terminated, self.truncated, info
     
     def _action_to_game(self, action):
-        game_action = {
-            "buttons": "",
-            "mouse_h": 0.0,
-            "mouse_v": 0.0
-        }
-
-        for i in range(self.button_count):
-            game_action["buttons"] += self.button_model_to_game[i] if action[i] > 0.5 else ""
-        
-        game_action["mouse_h"] = action[self.button_count] * 3.6 - 1.8
-        game_action["mouse_v"] = action[self.button_count + 1] * 1.8 - 0.9
-
-        return game_action
+        buttons, mouse_h, mouse_v = decode_actions(action)
+        return {"buttons": int(buttons), "mouse_h": mouse_h, "mouse_v": mouse_v}
     
     def _game_step(self, game_action):
-        pixels, player_pos, total_velocity = run_async(self.game.step(game_action))
+        pixels, player_state, is_duplicate = run_async(self.game.step(game_action))
+        self.last_step_end_time = time.perf_counter()
 
-        # write_to_log(pixels[0][0])
+        # log_trace("%s", pixels[0][0])
         pixels = np.transpose(pixels, (2, 0, 1)).astype(np.float32) / 255.0
         obs = {"pixels": pixels}
 
-        return obs, player_pos, total_velocity
+        return obs, player_state, is_duplicate
+
+    def _tune_speed(self, tick_delta, service_time):
+        self.speed_tuner.record(tick_delta, service_time)
+        if not self.speed_tuner.should_update():
+            return
+
+        game_speed = self.speed_tuner.update()
+        if game_speed is not None:
+            run_async(self.game.set_game_speed(game_speed))
+
+    def _get_episode_time(self):
+        return (self.last_tick - self.start_tick) / self.tickrate
+
+    def _get_dist_to_finish(self, player_pos):
+        map = self.game.map
+        return abs(player_pos[map.axis] - map.finish_pos[map.axis])
+
+    def get_progress(self, player_pos):
+        """Share of the map's length covered, 1.0 at the finish."""
+        map = self.game.map
+        map_length = abs(map.start_pos[map.axis] - map.finish_pos[map.axis])
+        return 1.0 - self._get_dist_to_finish(player_pos) / map_length
+
+    def _add_snapshot(self, player_state):
+        # Falling to the ground ends the useful part of a run
+        if player_state.pos[2] <= self.game.map.ground:
+            return
+
+        self.snapshot_archive.add(player_state, self._get_dist_to_finish(player_state.pos))
 
     def _calc_reward(self, game_action, player_pos, total_velocity):
         reward = 0.0
@@ -124,25 +186,69 @@ class SCEnv(gym.Env):
             map_length = abs(map.start_pos[axis] - map.finish_pos[axis])
             self.last_dist_milestone = map_length - (map_length % self.dist_milestone_step)
 
-        player_dist = abs(player_pos[axis] - map.finish_pos[axis])
+        player_dist = self._get_dist_to_finish(player_pos)
         while self.last_dist_milestone - player_dist > self.dist_milestone_step:
             reward += 0.5
             self.last_dist_milestone -= self.dist_milestone_step
 
         if player_dist < 25.0:
             self.terminated = True
-            time_multiplier = 1 + (1 - ((time.perf_counter() - self.time_till_truncate) / self.truncate_time))
+            time_multiplier = 1 + (1 - (self._get_episode_time() / self.seconds_to_finish))
             reward += 15.0 * time_multiplier
 
         return reward
 
     def reset(self, seed=None, options=None):
-        run_async(self.game.reset())
+        """options["player_state"] starts the episode from that state instead of the map start."""
+        # Seeds np_random, which picks snapshot starts
+        super().reset(seed=seed)
+        if self.curriculum is not None:
+            self._update_curriculum()
+
+        player_state = None
+        if options is not None and "player_state" in options:
+            player_state = options["player_state"]
+        elif self.snapshot_archive is not None and self.np_random.random() < self.snapshot_conf.start_probability:
+            player_state = self.snapshot_archive.sample(self.np_random)
+
+        run_async(self.game.reset(player_state))
         self._clear_attributes()
         game_action = self._action_to_game(self._fake_action())
-        obs, player_pos, total_velocity = self._game_step(game_action)
+        obs, start_state, _ = self._game_step(game_action)
+        self.start_tick = start_state.tick
+        self.last_tick = start_state.tick
+
+        if player_state is not None:
+            # Only progress from the restored state is rewarded
+            player_dist = self._get_dist_to_finish(start_state.pos)
+            self.last_dist_milestone = player_dist - (player_dist % self.dist_milestone_step)
+
         return obs, {}
     
+    def _update_curriculum(self):
+        # Resets in the middle of an episode, like between batches, don't count as a result
+        if self.terminated or self.truncated:
+            self.curriculum.record_episode(self.terminated, self.episode_step, time.perf_counter() - self.episode_start_time)
+
+        prefetch_map = self.curriculum.pop_prefetch()
+        if prefetch_map is not None:
+            run_async_nowait(self.game.prefetch_map(prefetch_map))
+
+        if self.curriculum.should_switch():
+            map_name = self.curriculum.switch()
+            if map_name != self.game.map.name:
+                self._switch_map(map_name)
+
+    def _switch_map(self, map_name):
+        if self.snapshot_archive is not None:
+            # States only restore on the map they were saved on
+            self.snapshot_archives[self.game.map.name] = self.snapshot_archive
+            self.snapshot_archive = self.snapshot_archives.get(map_name) or SCSnapshotArchive(self.snapshot_conf.cell_size)
+
+        start_time = time.perf_counter()
+        run_async(self.game.switch_map(map_name))
+        self.curriculum.record_switch_time(time.perf_counter() - start_time)
+
     def _fake_action(self):
         action = np.zeros((self.output_count,), dtype=np.float32)
         action[self.button_count] = 0.5
@@ -153,21 +259,74 @@ class SCEnv(gym.Env):
         await self.game.change_map(map_name)
     
     def close(self):
+        self.is_closed = True
         if self.game:
             self.game.close()
 
-config = get_config()
-def create_torchrl_env(surfchan, map, base_only=False, should_run_ai=True):
-    global config
+# Bit i of a button mask is button_model_to_game[i]
+_BUTTON_BITS = 1 << np.arange(SCEnv.button_count)
+
+def decode_actions(actions):
+    """Turns model actions of shape (..., 8) into button masks and mouse_h and mouse_v of shape (...).
+
+    A button is pressed when its output is over 0.5. Works on single actions and whole batches alike.
+    """
+    actions = np.asarray(actions)
+    buttons = np.dot(actions[..., :SCEnv.button_count] > 0.5, _BUTTON_BITS)
+    mouse_h = actions[..., SCEnv.button_count] * 3.6 - 1.8
+    mouse_v = actions[..., SCEnv.button_count + 1] * 1.8 - 0.9
+    return buttons, mouse_h, mouse_v
 
-    env = GymEnv(config.env.name)
-    env = TransformedEnv(env).to(get_torch_device())
+def create_env(surfchan, map, should_run_ai=True, game_class=SCGame):
+    """Plain gym env for modes that don't step it through torchrl, which then never import torch."""
+    env = SCEnv(game_class)
+    run_async(env.init(surfchan, map, should_run_ai))
+
+    return env
+
+def create_torchrl_env(surfchan, map, base_only=False, should_run_ai=True, env_name=None, device=None, curriculum=None):
+    # The torchrl stack is only imported by modes that run a model
+    from torchrl.envs import TransformedEnv, RewardSum
+    from torchrl.envs.libs.gym import GymEnv
+    from torchrl.envs.gym_like import default_info_dict_reader
+    from sc_model_utils import get_torch_device
+    from sc_preprocess import create_preprocess_transform
+
+    config = get_config()
+    device = device or get_torch_device()
+    env = GymEnv(env_name or config.env.name)
+    # Repeated frames are flagged, so training can leave them out
+    env.set_info_dict_reader(default_info_dict_reader(["is_duplicate"]))
+    env = TransformedEnv(env).to(device)
+    # Right after the observations are moved to the device, so everything after sees the model's input
+    preprocess_transform = create_preprocess_transform(env.observation_spec["pixels"].shape, device)
+    if preprocess_transform is not None:
+        env.append_transform(preprocess_transform)
     if not base_only:
         env.append_transform(RewardSum())
         # env.append_transform(DoubleToFloat())
         # When using VecNorm, change the observation_space low=-np.inf, high=np.inf
         # env.append_transform(VecNorm(in_keys=["pixels"]))
     
-    run_async(env.env.init(surfchan, map, should_run_ai))
+    run_async(env.env.init(surfchan, map, should_run_ai, curriculum))
     
     return env
+
+def create_specs(device):
+    import torch
+    from torchrl.data.tensor_specs import Bounded, Composite
+
+    from sc_preprocess import get_preprocessed_shape
+
+    config = get_config()
+    size = config.model.img_size
+    # What the model sees, after model.preprocess
+    pixels_shape = get_preprocessed_shape((3, size, size))
+    observation_spec = Composite(
+        pixels=Bounded(low=0.0, high=1.0, shape=pixels_shape, dtype=torch.float32, device=device),
+        device=device,
+    )
+    action_spec = Bounded(low=0.0, high=1.0, shape=(SCEnv.button_count + SCEnv.mouse_count, ),
+        dtype=torch.float32, device=device)
+
+    return observation_spec, action_spec
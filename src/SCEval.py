@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from tensordict import TensorDict
+from torchrl.envs.utils import ExplorationType, set_exploration_type
+from sc_config import get_config
+from sc_assets import hash_file
+from sc_model_utils import get_torch_device, get_checkpoint_paths, load_models
+from sc_preprocess import create_preprocess
+from sc_utils import run_async
+from SCEnv import create_env, create_specs
+from SCGame import SCGame
+from SCFakeGame import SCFakeGame
+
+GAME_CLASSES = {"game": SCGame, "fake": SCFakeGame}
+
+def get_progress_curve(times, progress, seconds_to_finish, points):
+    """Furthest progress reached by each of points evenly spaced episode times."""
+    curve_times = np.linspace(0.0, seconds_to_finish, points)
+    if not times:
+        return [0.0] * points
+
+    best_progress = np.maximum.accumulate(np.array(progress))
+    indices = np.searchsorted(np.array(times), curve_times, side="right") - 1
+    return [float(best_progress[i]) if i >= 0 else 0.0 for i in indices]
+
+def summarize_episodes(episodes):
+    finish_times = [episode["finish_time"] for episode in episodes if episode["success"]]
+    return {
+        "episodes": len(episodes),
+        "success_rate": sum(episode["success"] for episode in episodes) / len(episodes),
+        "finish_time": float(np.mean(finish_times)) if finish_times else None,
+        "progress": float(np.mean([episode["progress"] for episode in episodes])),
+        "curve": np.mean([episode["curve"] for episode in episodes], axis=0).tolist(),
+    }
+
+class SCEval():
+    """Runs the deterministic policy of the checkpoints in model.results_dir for eval.episodes episodes on
+    every eval map.
+
+    The envs are stepped side by side with one batched policy forward per step. The policy is
+    deterministic and episodes start at the map start, so nothing is seeded. Results are cached by
+    checkpoint hash, map, env settings, episode count and backend, so a re-run only plays checkpoints
+    it hasn't seen and doesn't start the game if there are none.
+    """
+
+    envs = None
+    executor = None
+
+    def __init__(self, surfchan):
+        self.surfchan = surfchan
+
+    async def run(self):
+        self.config = get_config()
+        self.conf = self.config.eval
+        self.results_dir = self.config.model.results_dir
+        self.cache_dir = os.path.join(self.results_dir, "eval_cache")
+
+        torch.set_float32_matmul_precision("high")
+        self.device = get_torch_device()
+        self.observation_spec, self.action_spec = create_specs(self.device)
+        # The envs are stepped without torchrl, so model.preprocess runs here instead of as their transform
+        img_size = self.config.model.img_size
+        self.preprocess, _ = create_preprocess(self.config.model.preprocess, (3, img_size, img_size), self.device)
+
+        checkpoint_paths = self.get_selected_checkpoint_paths()
+        if not checkpoint_paths:
+            print(f"No checkpoints to evaluate in {self.results_dir}")
+            return
+
+        results = {}
+        for checkpoint_path in checkpoint_paths:
+            checkpoint_name = os.path.basename(checkpoint_path).removesuffix("_checkpoint.pth")
+            checkpoint_hash = hash_file(checkpoint_path)
+            models = None
+            for map_name in self.conf.maps:
+                cache_path = os.path.join(self.cache_dir,
+                    f"{checkpoint_hash}_{map_name}_{self.get_settings_hash(map_name)}_{self.conf.episodes}_{self.conf.backend}.json")
+                episodes = self.load_cached(cache_path)
+                if episodes is None:
+                    if models is None:
+                        models, _ = load_models(checkpoint_path, self.observation_spec, self.action_spec, self.device)
+                    print(f"Evaluating {checkpoint_name} on {map_name}...")
+                    episodes = self.evaluate(models, map_name)
+                    self.save_cached(cache_path, episodes)
+
+                results[(checkpoint_name, map_name)] = summarize_episodes(episodes)
+
+        self.report(results)
+
+    def get_selected_checkpoint_paths(self):
+        # Names to select can also be passed after the mode, e.g. eval.bat 19-10_16-35
+        name_filters = sys.argv[2:] or self.conf.checkpoints
+        checkpoint_paths = sorted(get_checkpoint_paths(self.results_dir), key=os.path.getctime)
+        if name_filters:
+            checkpoint_paths = [path for path in checkpoint_paths
+                if any(name_filter in os.path.basename(path) for name_filter in name_filters)]
+
+        return checkpoint_paths
+
+    def get_settings_hash(self, map_name):
+        """Hash of the settings besides the checkpoint that change results, like env.seconds_to_finish."""
+        settings = {
+            "env": self.config.env.to_dict(),
+            "tickrate": self.config.server.tickrate,
+            "map": self.config.maps[map_name].to_dict(),
+            "curve_points": self.conf.curve_points,
+        }
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:8]
+
+    def load_cached(self, cache_path):
+        if not os.path.exists(cache_path):
+            return None
+
+        with open(cache_path, "r") as file:
+            return json.load(file)
+
+    def save_cached(self, cache_path, episodes):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(cache_path, "w") as file:
+            json.dump(episodes, file)
+
+    def get_envs(self):
+        # Only created once something isn't cached, so fully cached runs never start the game
+        if self.envs is None:
+            env_count = self.conf.envs or self.config.supervisor.instances
+            game_class = GAME_CLASSES[self.conf.backend]
+            self.envs = [create_env(self.surfchan, self.conf.maps[0], game_class=game_class) for _ in range(env_count)]
+            for env in self.envs:
+                # Episodes always start at the map start
+                env.snapshot_archive = None
+            self.executor = ThreadPoolExecutor(max_workers=env_count)
+
+        return self.envs
+
+    def evaluate(self, models, map_name):
+        envs = self.get_envs()
+        for env in envs:
+            if env.game.map.name != map_name:
+                run_async(env.game.switch_map(map_name))
+
+        episode_count = self.conf.episodes
+        episodes = [None] * episode_count
+        next_episode = 0
+        # Per env: index of its episode, its observation and what the episode recorded so far
+        slots = [None] * len(envs)
+
+        def start_episode(env_index):
+            nonlocal next_episode
+            if next_episode >= episode_count:
+                slots[env_index] = None
+                return
+
+            obs, _ = envs[env_index].reset()
+            slots[env_index] = {"episode": next_episode, "obs": obs, "times": [], "progress": [], "is_init": True}
+            next_episode += 1
+
+        for env_index in range(len(envs)):
+            start_episode(env_index)
+
+        recurrent_state = None
+        if models.is_recurrent():
+            recurrent_state = models.primer.primers.zero((len(envs),)).to(self.device)["recurrent_state"]
+
+        while any(slot is not None for slot in slots):
+            active = [env_index for env_index, slot in enumerate(slots) if slot is not None]
+            actions = self.act(models, [slots[env_index] for env_index in active], recurrent_state, active)
+
+            step_results = self.executor.map(lambda args: envs[args[0]].step(args[1]), zip(active, actions))
+            for env_index, (obs, _, terminated, truncated, info) in zip(active, step_results):
+                slot = slots[env_index]
+                slot["obs"] = obs
+                slot["is_init"] = False
+                if "progress" in info:
+                    slot["times"].append(envs[env_index]._get_episode_time())
+                    slot["progress"].append(float(info["progress"]))
+
+                if terminated or truncated:
+                    episodes[slot["episode"]] = self.finish_episode(slot, terminated)
+                    start_episode(env_index)
+
+        return episodes
+
+    def act(self, models, active_slots, recurrent_state, active):
+        pixels = torch.from_numpy(np.stack([slot["obs"]["pixels"] for slot in active_slots])).to(self.device)
+        if self.preprocess is not None:
+            pixels = self.preprocess(pixels)
+        td = TensorDict({"pixels": pixels}, batch_size=[len(active_slots)], device=self.device)
+        if recurrent_state is not None:
+            td["is_init"] = torch.tensor([[slot["is_init"]] for slot in active_slots], device=self.device)
+            td["recurrent_state"] = recurrent_state[active]
+
+        with torch.no_grad(), set_exploration_type(ExplorationType.DETERMINISTIC):
+            td = models.actor(td)
+
+        if recurrent_state is not None:
+            recurrent_state[active] = td["next", "recurrent_state"]
+
+        return td["action"].cpu().numpy()
+
+    def finish_episode(self, slot, success):
+        times, progress = slot["times"], slot["progress"]
+        return {
+            "success": bool(success),
+            "finish_time": times[-1] if success and times else None,
+            "progress": max(progress) if progress else 0.0,
+            "steps": len(times),
+            "curve": get_progress_curve(times, progress, self.config.env.seconds_to_finish, self.conf.curve_points),
+        }
+
+    def report(self, results):
+        print("checkpoint | map | success rate | finish time | progress")
+        for (checkpoint_name, map_name), summary in results.items():
+            finish_time = f"{summary['finish_time']:.2f}s" if summary["finish_time"] is not None else "-"
+            print(f"{checkpoint_name} | {map_name} | {summary['success_rate'] * 100:.0f}% | {finish_time} | " \
+                f"{summary['progress'] * 100:.1f}%")
+
+        eval_dir = os.path.join(self.results_dir, "eval")
+        os.makedirs(eval_dir, exist_ok=True)
+        date_str = datetime.now().strftime("%d-%m_%H-%M")
+        results_path = os.path.join(eval_dir, f"{date_str}_eval.json")
+        with open(results_path, "w") as file:
+            json.dump([{"checkpoint": checkpoint_name, "map": map_name, **summary}
+                for (checkpoint_name, map_name), summary in results.items()], file, indent=1)
+
+        self.plot_curves(results, eval_dir, date_str)
+        print(f"Saved results to {results_path}")
+
+    def plot_curves(self, results, eval_dir, date_str):
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        curve_times = np.linspace(0.0, self.config.env.seconds_to_finish, self.conf.curve_points)
+        for map_name in self.conf.maps:
+            figure, axes = plt.subplots()
+            for (checkpoint_name, result_map_name), summary in results.items():
+                if result_map_name == map_name:
+                    axes.plot(curve_times, summary["curve"], label=checkpoint_name)
+            axes.set_title(f"Progress on {map_name}")
+            axes.set_xlabel("Episode time (s)")
+            axes.set_ylabel("Furthest progress")
+            axes.legend()
+            figure.savefig(os.path.join(eval_dir, f"{date_str}_{map_name}.png"))
+            plt.close(figure)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+        if self.envs is not None:
+            for env in self.envs:
+                env.close()
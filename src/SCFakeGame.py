@@ -0,0 +1,137 @@
+import asyncio
+import contextlib
+import numpy as np
+from SCGame import SCGame, Map, Message, MESSAGE_TYPE
+from SCMessageQueue import SCMessageQueue
+
+_FAKE_FRAME_COUNT = 8
+
+class SCFakePlugin():
+    """Stand-in for the SourceMod plugin. Answers STEP, RESET and MAP like the plugin does, with a
+    player that moves towards the finish at a fixed speed."""
+
+    def __init__(self, map, speed=15.0, lockstep_ticks=2):
+        self.speed = speed
+        self.lockstep_ticks = lockstep_ticks
+
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.tick = 0
+        self._set_map(map)
+
+    def _set_map(self, map):
+        self.map = map
+        direction = self.map.finish_pos - self.map.start_pos
+        self.velocity = direction / np.linalg.norm(direction) * self.speed
+        self._reset_player()
+
+    def _reset_player(self):
+        self.pos = self.map.start_pos.astype(np.float64)
+        self.yaw = self.map.start_angle
+        self.pitch = 0.0
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        buffer = ""
+        try:
+            while True:
+                data = await self.reader.read(8000)
+                if not data:
+                    break
+
+                buffer += data.decode()
+                *message_strs, buffer = buffer.split("\n")
+                for message_str in message_strs:
+                    if not message_str.strip():
+                        continue
+
+                    message = Message.decode(message_str)
+                    if message:
+                        self._handle_message(message)
+
+                await self.writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+
+    def _handle_message(self, message):
+        if message.type == MESSAGE_TYPE.STEP:
+            self.tick += self.lockstep_ticks
+            self.pos += self.velocity
+            self.writer.write(Message(MESSAGE_TYPE.STEP, self._get_step_data()).encode())
+        elif message.type == MESSAGE_TYPE.RESET:
+            self._reset_player()
+            if message.data:
+                state = [float(x) for x in message.data.split(",")]
+                self.pos = np.array(state[0:3])
+                self.pitch = state[3]
+                self.yaw = state[4]
+        elif message.type == MESSAGE_TYPE.MAP:
+            self._set_map(Map.load(message.data.removeprefix("surf_")))
+
+    def _get_step_data(self):
+        total_velocity = np.linalg.norm(self.velocity)
+        return f"{self.pos[0]:.2f},{self.pos[1]:.2f},{self.pos[2]:.2f},{self.yaw:.2f}," \
+            f"{self.velocity[0]:.2f},{self.velocity[1]:.2f},{self.velocity[2]:.2f},{total_velocity:.2f}," \
+            f"0,{self.pitch:.2f},{self.tick}"
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+class SCFakeGame(SCGame):
+    """SCGame that talks to an SCFakePlugin over a local socket and captures generated frames
+    instead of the CSS window. Runs without server, CSS or supervisor."""
+
+    plugin = None
+    frames = None
+    frame_index = 0
+
+    async def init(self, surfchan, map_name, should_run_ai):
+        self.surfchan = surfchan
+        self.should_run_ai = should_run_ai
+        self.message_queue = SCMessageQueue([MESSAGE_TYPE.STEP], self.config.server.message_queue_size)
+        self.connected_event = asyncio.Event()
+        self.ready_event = asyncio.Event()
+        await self.change_map(map_name)
+
+        self.socket = await asyncio.start_server(self.handle_client, "127.0.0.1", 0)
+        port = self.socket.sockets[0].getsockname()[1]
+
+        self.plugin = SCFakePlugin(self.map)
+        await self.plugin.connect(port)
+        await self.connected_event.wait()
+
+        # Same window size rules as init_css
+        img_size = self.config.model.img_size
+        self.should_downscale_pixels = img_size < 500
+        window_size = max(img_size, 500)
+        rng = np.random.default_rng(0)
+        self.frames = [rng.integers(0, 256, (window_size, window_size, 4), dtype=np.uint8)
+            for _ in range(_FAKE_FRAME_COUNT)]
+
+        self.ready_event.set()
+
+    async def switch_map(self, map_name):
+        # The fake plugin switches right away and there's no player to spawn
+        await self.change_map(map_name)
+        await self.send_message(MESSAGE_TYPE.MAP, self.map.full_name())
+
+    def open_capture(self):
+        return contextlib.nullcontext()
+
+    def grab(self, sct):
+        self.frame_index = (self.frame_index + 1) % len(self.frames)
+        # mss hands out a new array for every grab
+        return self.frames[self.frame_index].copy()
+
+    def close(self):
+        if self.plugin is not None:
+            self.plugin.close()
+
+        super().close()
@@ -1,20 +1,28 @@
-import subprocess
 import asyncio
-import shutil
-import os
 import sys
+import zlib
 import numpy as np
 import win32gui
 import mss
 import cv2
 from enum import Enum
 from sc_config import get_config
+from SCSupervisor import get_supervisor
+from SCMessageQueue import SCMessageQueue
+from sc_assets import get_map_file_paths, prefetch_files
+from sc_log import log_trace, log_debug, log_error
 
 class MESSAGE_TYPE(Enum):
     INIT = 1
     START = 2
     STEP = 3
     RESET = 4
+    READY = 5
+    SPEED = 6
+    MAP = 7
+
+# Messages the plugin sends on its own instead of as a reply
+CONTROL_MESSAGE_TYPES = [MESSAGE_TYPE.INIT, MESSAGE_TYPE.READY]
 
 class Message:
     def __init__(self, type, data):
@@ -26,24 +34,56 @@ class Message:
         message_str = message_str.strip()
         
         if not message_str:
-            print("Empty message received")
+            log_error("Empty message received")
             return None
 
         message_parts = message_str.split(":")
         if len(message_parts) != 2:
-            print(f"Message has invalid format: {message_str}")
+            log_error("Message has invalid format: %s", message_str)
             return None
         
         try:
             message_type = int(message_parts[0])
         except Exception:
-            print(f"Invalid message type: {message_parts[0]}")
+            log_error("Invalid message type: %s", message_parts[0])
             return None
         
         return Message(MESSAGE_TYPE(message_type), message_parts[1])
     
     def __str__(self):
         return f"{self.type.value}:{self.data}"
+    
+    def encode(self):
+        # Messages are newline terminated, several can arrive in one read
+        return f"{self}\n".encode()
+
+class PlayerState:
+    def __init__(self, pos, pitch, yaw, velocity, total_velocity, is_crouch, tick=None):
+        self.pos = pos
+        self.pitch = pitch
+        self.yaw = yaw
+        self.velocity = velocity
+        self.total_velocity = total_velocity
+        self.is_crouch = is_crouch
+        # Server tick the state was read at. Not part of the restorable state.
+        self.tick = tick
+
+    @staticmethod
+    def decode(step_data):
+        sep_data = step_data.split(",")
+        return PlayerState(
+            np.array([float(sep_data[0]), float(sep_data[1]), float(sep_data[2])]),
+            float(sep_data[9]),
+            float(sep_data[3]),
+            np.array([float(sep_data[4]), float(sep_data[5]), float(sep_data[6])]),
+            float(sep_data[7]),
+            sep_data[8] == "1",
+            int(sep_data[10]))
+
+    def encode(self):
+        # Format of a RESET message that restores this state
+        return f"{self.pos[0]:.2f},{self.pos[1]:.2f},{self.pos[2]:.2f},{self.pitch:.2f},{self.yaw:.2f}," \
+            f"{self.velocity[0]:.2f},{self.velocity[1]:.2f},{self.velocity[2]:.2f},{int(self.is_crouch)}"
 
 class Map:
     def __init__(self, name, start_angle, start_pos, finish_pos, ground):
@@ -55,94 +95,105 @@ class Map:
 
         self.axis = np.argmax(np.abs(self.finish_pos - self.start_pos))
 
+    @staticmethod
+    def load(map_name):
+        map_config = get_config().maps[map_name]
+        return Map(map_name,
+            map_config.start_angle,
+            np.array(map_config.start),
+            np.array(map_config.finish),
+            map_config.ground)
+
     def full_name(self):
         return f"surf_{self.name}"
 
 class SCGame:
+    _WAIT_LOG_INTERVAL = 10.0
+
     env = None
     config = None
     map = None
-    server_process = None
+    supervisor = None
+    instance = None
     socket = None
     socket_writer = None
     message_queue = None
-    css_process = None
-    last_message = None
+    connected_event = None
+    ready_event = None
+    # READYs received, a restarted instance sends another one
+    ready_count = 0
     should_run_ai = None
     css_window_size = None
     should_downscale_pixels = False
+    last_fingerprint = None
 
     def __init__(self, env):
         self.env = env
         self.config = get_config()
+        self.game_speed = self.config.env.game_speed
+        self.capture_conf = self.config.capture
+        self.capture_stats = {"captures": 0, "duplicates": 0, "recaptures": 0}
 
     async def init(self, surfchan, map_name, should_run_ai):
         print(f"Initializing game...")
         try:
             self.surfchan = surfchan
             self.should_run_ai = should_run_ai
+            # A STEP reply is only useful if it's the newest one
+            self.message_queue = SCMessageQueue([MESSAGE_TYPE.STEP], self.config.server.message_queue_size)
+            self.connected_event = asyncio.Event()
+            self.ready_event = asyncio.Event()
             await self.change_map(map_name)
 
-            await self.init_server()
-            await self.init_socket()
-
-            while not self.socket_writer:
-                await asyncio.sleep(0.1)
+            self.supervisor = get_supervisor()
+            self.instance = await self.supervisor.acquire(self)
 
             asyncio.create_task(self.process_messages())
-
-            await self.send_message(MESSAGE_TYPE.INIT, f"{self.config.env.game_speed}")
-
-            while not self.css_process:
-                await asyncio.sleep(0.1)
+            await self.init_socket()
+            await self.init_server()
 
             await self.wait_for_start()
         except asyncio.CancelledError:
             pass
     
     async def change_map(self, map_name):
-        map_config = self.config.maps[map_name]
-        self.map = Map(map_name,
-            map_config.start_angle,
-            np.array(map_config.start),
-            np.array(map_config.finish),
-            map_config.ground)
+        self.map = Map.load(map_name)
+
+    async def switch_map(self, map_name):
+        """Changes the running server's map instead of relaunching it. The plugin sends READY again once
+        the player spawned on the new map, which answers with START at the new start."""
+        await self.change_map(map_name)
+        self.ready_event.clear()
+        self.supervisor.switch_map(self.instance, self.map.full_name())
+        await self.send_message(MESSAGE_TYPE.MAP, self.map.full_name())
+        await self.wait_for_start()
+
+    async def prefetch_map(self, map_name):
+        # The server and CSS then load the map from the OS file cache when switching to it
+        map_full_name = Map.load(map_name).full_name()
+        total_bytes = await asyncio.to_thread(prefetch_files, get_map_file_paths(self.config, map_full_name))
+        log_debug("Prefetched %s (%.1fMB)", map_full_name, total_bytes / 2**20)
 
     async def init_server(self):
-        # Copy mapcycle
-        server_path = os.path.join("css_server", "server")
-        server_cfg_dir_path = os.path.join(server_path, "cstrike", "cfg")
-        shutil.copy2(os.path.join("assets", "mapcycle.txt"), os.path.join(server_cfg_dir_path, "mapcycle.txt"))
-
-        # Copy server config
-        shutil.copy2(os.path.join("assets", "server.cfg"), os.path.join(server_cfg_dir_path, "server.cfg"))
-
-        # Copy autoexec
-        shutil.copy2(os.path.join("assets", "autoexec_server.cfg"), os.path.join(server_cfg_dir_path, "autoexec.cfg"))
-
-        # Copy maps
-        maps_dir_path = os.path.join("assets", "maps")
-        for map_path in os.listdir(maps_dir_path):
-            dst = os.path.join(server_path, "cstrike", "maps", map_path)
-            if not os.path.exists(dst):
-                shutil.copy2(os.path.join(maps_dir_path, map_path), dst)
-
-        print("Initializing server...")
-        self.server_process = subprocess.Popen(["css_server/server/srcds.exe", "-console", "-game", "cstrike", "-insecure", "-tickrate", "66", \
-            "+maxplayers", "2", "+map", self.map.full_name()])
+        # Assets are synced once by the supervisor for all instances
+        # A warm instance from the pool is reused, its plugin reconnects on its own
+        self.supervisor.ensure_server(self.instance, self.map.full_name())
 
     async def init_socket(self):
         print("Initializing socket...")
-        self.socket = await asyncio.start_server(self.handle_client, self.config.server.host, self.config.server.port)
+        self.socket = await asyncio.start_server(self.handle_client, self.config.server.host, self.instance.port)
 
     async def handle_client(self, reader, writer):
         try:
             addr = writer.get_extra_info('peername')
-            print(f"Connected by css server {addr}")
+            log_debug("Connected by css server %s", addr)
 
             self.socket_writer = writer
+            self.connected_event.set()
+
+            await self.send_message(MESSAGE_TYPE.INIT, f"{self.game_speed}")
 
-            self.message_queue = asyncio.Queue()
+            buffer = ""
             while reader is not None:
                 try:
                     data = await reader.read(8000)
@@ -150,19 +201,28 @@ class SCGame:
                     break
 
                 if not data:
-                    print(f"Connection closed by css server {addr}")
+                    log_debug("Connection closed by css server %s", addr)
                     break
 
-                message_str = data.decode()
-                message = Message.decode(message_str)
-                if not message:
-                    continue
+                buffer += data.decode()
+                *message_strs, buffer = buffer.split("\n")
+                for message_str in message_strs:
+                    if not message_str.strip():
+                        continue
+
+                    message = Message.decode(message_str)
+                    if not message:
+                        continue
 
-                await self.message_queue.put(message)
+                    log_trace("Received %s", message_str)
+
+                    await self.message_queue.put(message)
         except asyncio.CancelledError:
             pass
         finally:
             self.socket_writer = None
+            self.connected_event.clear()
+            self.ready_event.clear()
             if writer is not None:
                 writer.close()
 
@@ -171,92 +231,125 @@ class SCGame:
             return
 
         message = Message(type, data)
-        message_str = str(message)
-        self.socket_writer.write(message_str.encode())
+        log_trace("Sending %s:%s", type.name, data)
+        self.socket_writer.write(message.encode())
         await self.socket_writer.drain()
 
     async def process_messages(self):
         while True:
-            message = await self.message_queue.get()
-            
-            if not self.message_queue.empty():
-                print(f"MESSAGES ARE STACKING! QUEUE SIZE: {self.message_queue.qsize()}")
-            
+            message = await self.message_queue.get(CONTROL_MESSAGE_TYPES)
             await self.handle_message(message)
 
     async def handle_message(self, message):
-        self.last_message = message
-
         if message.type == MESSAGE_TYPE.INIT:
             server_ip = message.data
             await self.init_css(server_ip)
+        elif message.type == MESSAGE_TYPE.READY:
+            await self.handle_ready()
     
-    async def wait_for_message(self, message_type):
-        while not self.last_message or self.last_message.type != message_type:
-            await asyncio.sleep(0.01)
-        
-        data = self.last_message.data
-        self.last_message = None
-        
-        return data
+    async def wait_for_message(self, message_type, timeout=None):
+        message = await self.message_queue.get([message_type], timeout)
+        return message.data if message else None
 
     async def init_css(self, server_ip):
-        # Copy autoexec
-        css_path = self.config.css.path
-        shutil.copy2(os.path.join("assets", "autoexec_css.cfg"), os.path.join(css_path, "cstrike", "cfg", "autoexec.cfg"))
-
-        # Copy maps
-        maps_dir_path = os.path.join("assets", "maps")
-        for map_path in os.listdir(maps_dir_path):
-            dst = os.path.join(css_path, "cstrike", "maps", map_path)
-            if not os.path.exists(dst):
-                shutil.copy2(os.path.join(maps_dir_path, map_path), dst)
-        
         window_size = self.config.model.img_size
         if window_size < 500:
             self.should_downscale_pixels = True
             window_size = 500
-        window_size = str(window_size)
 
-        css_exe_path = os.path.join(css_path, "hl2.exe")
-        print("Initializing CSS...")
-        self.css_process = subprocess.Popen([css_exe_path, "-game", "cstrike", "-windowed", "-novid", \
-            "-exec", "autoexec", "+connect", server_ip, "-w", window_size, "-h", window_size])
+        # A warm CSS is still connected to the server
+        if not self.instance.is_css_alive():
+            self.instance.launch_css(server_ip, window_size)
     
     async def step(self, game_action):
         message_data = '0'
         if self.should_run_ai:
             message_data = f'1,{game_action["buttons"]},{game_action["mouse_h"]},{game_action["mouse_v"]}'
         
+        # Replies still queued belong to earlier steps
+        self.message_queue.clear(MESSAGE_TYPE.STEP)
         await self.send_message(MESSAGE_TYPE.STEP, message_data)
 
-        data = await self.wait_for_message(MESSAGE_TYPE.STEP)
-        sep_data = data.split(",")
+        ready_count = self.ready_count
+        data = await self.wait_for_message(MESSAGE_TYPE.STEP, self.config.supervisor.step_timeout)
+        while data is None:
+            # The step is only lost if the instance restarted, otherwise its reply is just slow and
+            # resending would apply the action twice
+            await self.ready_event.wait()
+            if self.ready_count != ready_count:
+                ready_count = self.ready_count
+                self.message_queue.clear(MESSAGE_TYPE.STEP)
+                await self.send_message(MESSAGE_TYPE.STEP, message_data)
+            else:
+                log_debug("Waiting for step reply...")
+            data = await self.wait_for_message(MESSAGE_TYPE.STEP, self.config.supervisor.step_timeout)
+
+        player_state = PlayerState.decode(data)
+
+        pixels, is_duplicate = await self.capture()
+        pixels = self.preprocess(pixels)
+        
+        return pixels, player_state, is_duplicate
+
+    async def capture(self):
+        with self.open_capture() as sct:
+            pixels = self.grab(sct)
+            fingerprint = self.get_fingerprint(pixels)
 
-        player_pos = np.array([float(sep_data[0]), float(sep_data[1]), float(sep_data[2])])
-        angle = float(sep_data[3])
-        velocity = [float(sep_data[4]), float(sep_data[5]), float(sep_data[6])]
-        total_velocity = float(sep_data[7])
-        is_crouch = sep_data[8]
+            # The client may not have rendered a new frame since the last step yet
+            recaptures = 0
+            while fingerprint == self.last_fingerprint and recaptures < self.capture_conf.max_recaptures:
+                await asyncio.sleep(self.capture_conf.recapture_wait)
+                pixels = self.grab(sct)
+                fingerprint = self.get_fingerprint(pixels)
+                recaptures += 1
 
-        with mss.mss() as sct:
-            pixels = np.array(sct.grab(self.css_window_size))
-        
+        is_duplicate = fingerprint == self.last_fingerprint
+        self.last_fingerprint = fingerprint
+
+        self.capture_stats["captures"] += 1
+        self.capture_stats["recaptures"] += recaptures
+        if is_duplicate:
+            self.capture_stats["duplicates"] += 1
+
+        return pixels, is_duplicate
+
+    def open_capture(self):
+        return mss.mss()
+
+    def grab(self, sct):
+        return np.array(sct.grab(self.css_window_size))
+
+    def preprocess(self, pixels):
         if self.should_downscale_pixels:
             pixels = cv2.resize(pixels, (self.config.model.img_size, self.config.model.img_size), interpolation=cv2.INTER_LINEAR)
-        pixels = cv2.cvtColor(pixels, cv2.COLOR_BGRA2RGB)
-        
-        return pixels, player_pos, total_velocity
+        return cv2.cvtColor(pixels, cv2.COLOR_BGRA2RGB)
+
+    def get_fingerprint(self, pixels):
+        step = self.capture_conf.fingerprint_step
+        return zlib.crc32(np.ascontiguousarray(pixels[::step, ::step]))
+
+    def get_capture_metrics(self, prefix=""):
+        captures = max(self.capture_stats["captures"], 1)
+        return {
+            f"{prefix}duplicate_rate": self.capture_stats["duplicates"] / captures,
+            f"{prefix}recaptures_per_step": self.capture_stats["recaptures"] / captures,
+        }
 
     async def wait_for_start(self):
-        print("Press enter to start...")
-        # Runs input() in a separate thread
-        await asyncio.to_thread(input)
+        # The plugin sends READY once the player has spawned
+        while True:
+            try:
+                await asyncio.wait_for(self.ready_event.wait(), self._WAIT_LOG_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                log_debug("Waiting for game instance to be ready...")
 
+    async def handle_ready(self):
         await self.send_message(MESSAGE_TYPE.START, \
             f"{self.map.start_pos[0]},{self.map.start_pos[1]},{self.map.start_pos[2]},{self.map.start_angle}")
         
-        hwnd = win32gui.FindWindow(None, "Counter-Strike Source")
+        hwnd = self.instance.get_css_window() or win32gui.FindWindow(None, "Counter-Strike Source")
         if hwnd:
             left, top, right, bottom = win32gui.GetWindowRect(hwnd)
 
@@ -265,16 +358,26 @@ class SCGame:
             top += 26
             img_size = self.config.model.img_size
             self.css_window_size = { "left": left, "top": top, "width": img_size, "height": img_size }
+
+        self.supervisor.mark_ready(self.instance)
+        self.ready_count += 1
+        self.ready_event.set()
+
+    def on_instance_crashed(self):
+        log_error("Game instance crashed, waiting for restart...")
+        self.ready_event.clear()
     
-    async def reset(self):
-        await self.send_message(MESSAGE_TYPE.RESET, "")
+    async def set_game_speed(self, game_speed):
+        self.game_speed = game_speed
+        await self.send_message(MESSAGE_TYPE.SPEED, f"{game_speed}")
+
+    async def reset(self, player_state=None):
+        # Without a state the plugin resets to the map start
+        await self.send_message(MESSAGE_TYPE.RESET, player_state.encode() if player_state else "")
     
     def close(self):
         if self.socket:
             self.socket.close()
 
-        if self.css_process and self.config.css.close_on_script_close:
-            self.css_process.kill()
-        
-        if self.server_process and self.config.server.close_on_script_close:
-            self.server_process.kill()
+        if self.instance is not None:
+            self.supervisor.release(self.instance)
@@ -30,9 +30,10 @@ class SCInfer():
         
         self.env = create_torchrl_env(self.surfchan, self.config.infer.map)
         
-        self.models, self.stats = get_models(self.env, self.device)
+        self.models, self.stats = get_models(self.env.observation_spec, self.env.action_spec, self.device)
 
-        avg_step_time = sum(self.stats.step_times) / len(self.stats.step_times) * self.stats.game_speed
+        # Step times are stored scaled by the game speed they were collected at
+        avg_step_time = sum(self.stats.step_times) / len(self.stats.step_times)
         self.env.set_target_step_time(avg_step_time)
     
     def close(self):
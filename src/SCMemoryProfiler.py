@@ -0,0 +1,173 @@
+import os
+import tracemalloc
+import torch
+from SCTimer import sc_timer
+
+_MB = 1024 * 1024
+
+def get_rss():
+    """Returns (current, peak) resident memory of this process in bytes."""
+    if os.name == "nt":
+        import win32api
+        import win32process
+
+        info = win32process.GetProcessMemoryInfo(win32api.GetCurrentProcess())
+        return info["WorkingSetSize"], info["PeakWorkingSetSize"]
+
+    import resource
+
+    with open("/proc/self/statm", "r") as file:
+        current = int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return current, max(current, peak)
+
+class SCMemoryProfiler():
+    """Measures memory around sc_timer phases: process RSS, Python allocations traced by tracemalloc
+    and the torch CUDA allocator.
+
+    Per phase it records how much each grew from the phase start to its end, and the highest Python
+    and CUDA usage above the start in between. Peaks are reset at every phase start, so the profiled
+    phases shouldn't nest. The OS only keeps the peak RSS of the whole process, so that one is logged
+    once by get_metrics and not per phase. get_metrics sums the growth and keeps the highest peak of
+    every phase run since its last call.
+
+    With leak_report, the Python allocations after the first batch are the baseline and report_leaks
+    lists the source lines whose allocations grew most since then.
+    """
+
+    def __init__(self, conf, device):
+        self.conf = conf
+        self.phases = set(conf.phases)
+        self.device = device
+        self.is_cuda = device.type == "cuda"
+
+        self.is_tracing = conf.tracemalloc
+        if self.is_tracing and not tracemalloc.is_tracing():
+            tracemalloc.start(conf.tracemalloc_frames)
+
+        self.starts = {}
+        self.stats = {}
+        self.baseline = None
+        self.baseline_rss = None
+
+        sc_timer.add_listener(self)
+
+    def on_start(self, name, category):
+        if name not in self.phases:
+            return
+
+        start = {"rss": get_rss()[0]}
+        if self.is_tracing:
+            tracemalloc.reset_peak()
+            start["py"] = tracemalloc.get_traced_memory()[0]
+        if self.is_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            start["cuda"] = torch.cuda.memory_allocated(self.device)
+        self.starts[name] = start
+
+    def on_stop(self, name, category):
+        start = self.starts.pop(name, None)
+        if start is None:
+            return
+
+        measured = {"rss_delta_mb": (get_rss()[0] - start["rss"]) / _MB}
+        if self.is_tracing:
+            py_current, py_peak = tracemalloc.get_traced_memory()
+            measured["py_delta_mb"] = (py_current - start["py"]) / _MB
+            measured["py_peak_mb"] = (py_peak - start["py"]) / _MB
+        if self.is_cuda:
+            measured["cuda_delta_mb"] = (torch.cuda.memory_allocated(self.device) - start["cuda"]) / _MB
+            measured["cuda_peak_mb"] = (torch.cuda.max_memory_allocated(self.device) - start["cuda"]) / _MB
+
+        stats = self.stats.setdefault(name, {})
+        for key, value in measured.items():
+            if key.endswith("delta_mb"):
+                stats[key] = stats.get(key, 0.0) + value
+            else:
+                stats[key] = max(stats.get(key, value), value)
+
+    def get_metrics(self, prefix=""):
+        rss, peak_rss = get_rss()
+        metrics = {
+            f"{prefix}rss_mb": rss / _MB,
+            f"{prefix}peak_rss_mb": peak_rss / _MB,
+            f"{prefix}timer_entries": sum(sc_timer.get_counts().values()),
+        }
+        if self.is_tracing:
+            metrics[f"{prefix}py_traced_mb"] = tracemalloc.get_traced_memory()[0] / _MB
+        if self.is_cuda:
+            metrics[f"{prefix}cuda_allocated_mb"] = torch.cuda.memory_allocated(self.device) / _MB
+            metrics[f"{prefix}cuda_reserved_mb"] = torch.cuda.memory_reserved(self.device) / _MB
+
+        for name, stats in self.stats.items():
+            for key, value in stats.items():
+                metrics[f"{prefix}{name}/{key}"] = value
+        self.stats = {}
+
+        return metrics
+
+    def take_snapshot(self):
+        # Without tracemalloc's own allocations for the snapshots
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def mark_baseline(self):
+        self.baseline_rss = get_rss()[0]
+        if self.is_tracing and self.conf.leak_report:
+            self.baseline = self.take_snapshot()
+
+    def report_leaks(self, path=None):
+        """Prints, and writes to path if given, what grew since mark_baseline."""
+        if self.baseline_rss is None:
+            return
+
+        lines = [f"RSS growth since the first batch: {(get_rss()[0] - self.baseline_rss) / _MB:.1f}MB"]
+
+        if self.baseline is not None:
+            snapshot = self.take_snapshot()
+            diffs = [diff for diff in snapshot.compare_to(self.baseline, "lineno") if diff.size_diff > 0]
+            lines.append(f"Python allocations grown most since the first batch ({len(diffs)} lines grew):")
+            for diff in diffs[:self.conf.leak_report_lines]:
+                frame = diff.traceback[0]
+                lines.append(f"  {diff.size_diff / _MB:+.2f}MB in {diff.count_diff:+d} blocks: {frame.filename}:{frame.lineno}")
+
+        timer_counts = sorted(sc_timer.get_counts().items(), key=lambda item: item[1], reverse=True)
+        lines.append("Most kept timer entries:")
+        for name, count in timer_counts[:5]:
+            lines.append(f"  {count}: {name}")
+
+        report = "\n".join(lines)
+        print(report)
+        if path is not None:
+            with open(path, "w") as file:
+                file.write(report + "\n")
+
+    def close(self):
+        sc_timer.remove_listener(self)
+        if self.is_tracing:
+            tracemalloc.stop()
+
+if __name__ == "__main__":
+    from types import SimpleNamespace
+
+    # "grow" keeps what it allocates, "temp" frees it. Only grow should show up in the leak report.
+    conf = SimpleNamespace(phases=["grow", "temp"], tracemalloc=True, tracemalloc_frames=1, leak_report=True,
+        leak_report_lines=3)
+    profiler = SCMemoryProfiler(conf, torch.device("cpu"))
+    kept = []
+    for i in range(5):
+        sc_timer.start("grow", "tb")
+        kept.append([0] * 1000000)
+        sc_timer.stop("grow", "tb")
+
+        sc_timer.start("temp", "tb")
+        temp = [0] * 2000000
+        del temp
+        sc_timer.stop("temp", "tb")
+
+        print({key: round(value, 1) for key, value in profiler.get_metrics().items()})
+        if i == 0:
+            profiler.mark_baseline()
+
+    profiler.report_leaks()
+    profiler.close()
@@ -0,0 +1,95 @@
+import asyncio
+from collections import Counter, deque
+from time import perf_counter
+import numpy as np
+
+class SCMessageQueue():
+    """Receive queue with one bounded queue per message type.
+
+    Coalesced types only keep their newest message. Other types are never dropped, a full queue
+    makes put wait instead, which pushes back on the socket reader.
+    """
+
+    _LATENCY_WINDOW = 10000
+
+    def __init__(self, coalesce_types, maxsize):
+        self.coalesce_types = set(coalesce_types)
+        self.maxsize = maxsize
+
+        self.queues = {}
+        self.condition = asyncio.Condition()
+        self.received = Counter()
+        self.drops = Counter()
+        self.max_depths = Counter()
+        self.latencies = {}
+
+    def _get_queue(self, message_type):
+        return self.queues.setdefault(message_type, deque())
+
+    async def put(self, message):
+        message.receive_time = perf_counter()
+
+        async with self.condition:
+            queue = self._get_queue(message.type)
+            if message.type in self.coalesce_types:
+                self.drops[message.type] += len(queue)
+                queue.clear()
+            else:
+                await self.condition.wait_for(lambda: len(queue) < self.maxsize)
+
+            queue.append(message)
+            self.received[message.type] += 1
+            self.max_depths[message.type] = max(self.max_depths[message.type], len(queue))
+            self.condition.notify_all()
+
+    async def get(self, message_types, timeout=None):
+        """Returns the oldest message of one of message_types, or None after timeout seconds."""
+        queues = [self._get_queue(message_type) for message_type in message_types]
+
+        async with self.condition:
+            try:
+                await asyncio.wait_for(self.condition.wait_for(lambda: any(queues)), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+            queue = min((queue for queue in queues if queue), key=lambda queue: queue[0].receive_time)
+            message = queue.popleft()
+            self.condition.notify_all()
+
+        latencies = self.latencies.setdefault(message.type, deque(maxlen=self._LATENCY_WINDOW))
+        latencies.append(perf_counter() - message.receive_time)
+        return message
+
+    def clear(self, message_type):
+        """Drops queued messages of message_type, e.g. replies that belong to an earlier request."""
+        queue = self._get_queue(message_type)
+        self.drops[message_type] += len(queue)
+        queue.clear()
+
+    def get_metrics(self, prefix=""):
+        metrics = {}
+        for message_type, queue in self.queues.items():
+            name = message_type.name.lower()
+            metrics[f"{prefix}{name}_received"] = self.received[message_type]
+            metrics[f"{prefix}{name}_drops"] = self.drops[message_type]
+            metrics[f"{prefix}{name}_depth"] = len(queue)
+            metrics[f"{prefix}{name}_depth_max"] = self.max_depths[message_type]
+
+        return metrics
+
+    def get_latency_metrics(self, prefix=""):
+        """Mean and p95 of the time messages waited in the queue since the last call, which starts over."""
+        metrics = {}
+        for message_type in list(self.latencies):
+            # Swapped instead of cleared, so latencies appended meanwhile end up in the next window
+            latencies = self.latencies[message_type]
+            self.latencies[message_type] = deque(maxlen=self._LATENCY_WINDOW)
+            if len(latencies) == 0:
+                continue
+
+            latencies = np.array(latencies)
+            name = message_type.name.lower()
+            metrics[f"{prefix}{name}_latency_mean"] = float(latencies.mean())
+            metrics[f"{prefix}{name}_latency_p95"] = float(np.percentile(latencies, 95))
+
+        return metrics
@@ -0,0 +1,113 @@
+import queue
+import threading
+import torch
+
+class SCMetrics():
+    """Averages scalars over log_interval calls of log and writes them to the logger on a background thread.
+
+    Tensor values stay on their device until a flush, where each device's values are copied to the
+    host in one transfer. The writer thread waits for that copy, so the training loop never syncs
+    for logging.
+    """
+
+    def __init__(self, logger, log_interval):
+        self.logger = logger
+        self.log_interval = log_interval
+
+        self.sums = {}
+        self.counts = {}
+        self.log_count = 0
+        self.last_step = None
+
+        self.write_queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def add(self, key, value):
+        if value is None:
+            return
+
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float()
+            if value.numel() != 1:
+                value = value.mean()
+            value = value.reshape(())
+
+        if key in self.sums:
+            self.sums[key] = self.sums[key] + value
+            self.counts[key] += 1
+        else:
+            self.sums[key] = value
+            self.counts[key] = 1
+
+    def log(self, metrics, step):
+        for key, value in metrics.items():
+            self.add(key, value)
+
+        self.log_count += 1
+        self.last_step = step
+        if self.log_count >= self.log_interval:
+            self.flush(step)
+
+    def flush(self, step):
+        self.log_count = 0
+        if not self.sums:
+            return
+
+        scalars = {}
+        device_keys = {}
+        for key, value in self.sums.items():
+            if isinstance(value, torch.Tensor):
+                device_keys.setdefault(value.device, []).append(key)
+            else:
+                scalars[key] = value / self.counts[key]
+
+        transfers = []
+        for device, keys in device_keys.items():
+            values = torch.stack([self.sums[key] / self.counts[key] for key in keys])
+            if device.type == "cuda":
+                host_values = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+                host_values.copy_(values, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                host_values = values
+                event = None
+            transfers.append((keys, host_values, event))
+
+        self.sums = {}
+        self.counts = {}
+        self.write_queue.put((step, scalars, transfers))
+
+    def _write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+
+            step, scalars, transfers = item
+            for keys, host_values, event in transfers:
+                if event is not None:
+                    event.synchronize()
+                scalars.update(zip(keys, host_values.tolist()))
+
+            for key, value in scalars.items():
+                self.logger.log_scalar(key, value, step)
+
+    def close(self):
+        # Whatever was logged since the last flush is written at the last step
+        if self.last_step is not None:
+            self.flush(self.last_step)
+
+        self.write_queue.put(None)
+        self.writer_thread.join()
+
+if __name__ == "__main__":
+    class PrintLogger():
+        def log_scalar(self, key, value, step):
+            print(f"{step} {key}: {value:.3f}")
+
+    metrics = SCMetrics(PrintLogger(), 2)
+    for step in range(4):
+        metrics.log({"train/loss": torch.tensor(float(step)), "time/speed": step * 10.0, "time/none": None}, step)
+    metrics.close()
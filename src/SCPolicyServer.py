@@ -0,0 +1,202 @@
+import copy
+import asyncio
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from time import perf_counter
+import numpy as np
+import torch
+from tensordict import TensorDict
+from tensordict.nn import TensorDictModuleBase
+from sc_transport import FRAME_TYPE, read_frame, write_frame
+from sc_utils import run_async
+
+class SCPolicyServer():
+    _LATENCY_WINDOW = 10000
+    _STOP = None
+
+    server = None
+    thread = None
+    version = 0
+
+    def __init__(self, actor, device, max_batch_size, max_latency):
+        # Its own copy, so forwards never see the learner's weights halfway through an optimizer step
+        self.actor = copy.deepcopy(actor)
+        self.weights_lock = threading.Lock()
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.request_queue = queue.Queue()
+        self.batch_sizes = Counter()
+        self.queue_latencies = deque(maxlen=self._LATENCY_WINDOW)
+        self.forward_times = deque(maxlen=self._LATENCY_WINDOW)
+
+    def start(self, host=None, port=None):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        if host is not None:
+            self.server = run_async(asyncio.start_server(self.handle_client, host, port))
+            print(f"Policy server listening on {host}:{port}")
+
+    def update_weights(self, actor, version):
+        """Copies the weights of actor, which are used for every forward after this returns."""
+        with self.weights_lock:
+            self.actor.load_state_dict(actor.state_dict())
+            self.version = version
+
+    def submit(self, pixels):
+        """Queues one uint8 observation of shape (C, H, W). Resolves to (action, log_prob, version)."""
+        future = Future()
+        self.request_queue.put((pixels, perf_counter(), future))
+        return future
+
+    def _run(self):
+        while True:
+            request = self.request_queue.get()
+            if request is self._STOP:
+                break
+
+            # The first request sets the deadline, everything arriving before it shares the forward
+            requests = [request]
+            deadline = request[1] + self.max_latency
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - perf_counter()
+                if timeout <= 0.0:
+                    break
+
+                try:
+                    request = self.request_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if request is self._STOP:
+                    self.request_queue.put(request)
+                    break
+                requests.append(request)
+
+            self._forward(requests)
+
+    def _forward(self, requests):
+        start_time = perf_counter()
+        try:
+            pixels = torch.from_numpy(np.stack([request[0] for request in requests]))
+            pixels = pixels.to(self.device, non_blocking=True).float().div_(255.0)
+            td = TensorDict({"pixels": pixels}, batch_size=[len(requests)], device=self.device)
+
+            with self.weights_lock, torch.no_grad():
+                # Read with the weights, so actions are labelled with the version that computed them
+                version = self.version
+                td = self.actor(td)
+            actions = td["action"].cpu().numpy()
+            log_probs = td["sample_log_prob"].cpu().numpy()
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+
+        self.forward_times.append(perf_counter() - start_time)
+        self.batch_sizes[len(requests)] += 1
+
+        for i, (_, enqueue_time, future) in enumerate(requests):
+            self.queue_latencies.append(start_time - enqueue_time)
+            future.set_result((actions[i], log_probs[i], version))
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame.type != FRAME_TYPE.OBSERVATION:
+                    continue
+
+                futures = [asyncio.wrap_future(self.submit(pixels)) for pixels in frame.arrays["pixels"]]
+                results = await asyncio.gather(*futures)
+
+                arrays = {
+                    "action": np.stack([result[0] for result in results]),
+                    "sample_log_prob": np.stack([result[1] for result in results]),
+                }
+                await write_frame(writer, FRAME_TYPE.ACTION, min(result[2] for result in results), arrays)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f"Policy client {addr} disconnected")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            writer.close()
+
+    def get_metrics(self, prefix="policy_server/"):
+        metrics = {}
+
+        batch_count = sum(self.batch_sizes.values())
+        if batch_count > 0:
+            request_count = sum(size * count for size, count in self.batch_sizes.items())
+            metrics[f"{prefix}batch_size_mean"] = request_count / batch_count
+            metrics[f"{prefix}batch_size_max"] = max(self.batch_sizes)
+
+        if len(self.queue_latencies) > 0:
+            latencies = np.array(self.queue_latencies)
+            for percentile in (50, 95, 99):
+                metrics[f"{prefix}queue_latency_p{percentile}"] = float(np.percentile(latencies, percentile))
+
+        if len(self.forward_times) > 0:
+            metrics[f"{prefix}forward_time_mean"] = float(np.mean(self.forward_times))
+
+        return metrics
+
+    def print_stats(self):
+        print("Policy server batch sizes:")
+        for size in sorted(self.batch_sizes):
+            print(f"  {size}: {self.batch_sizes[size]}")
+
+        for key, value in self.get_metrics("").items():
+            print(f"  {key}: {value:.4f}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+        if self.thread is not None:
+            self.request_queue.put(self._STOP)
+            self.thread.join()
+            self.print_stats()
+
+class SCRemotePolicy(TensorDictModuleBase):
+    """Collector policy that gets its actions from a SCPolicyServer instead of a local actor."""
+
+    in_keys = ["pixels"]
+    out_keys = ["action", "sample_log_prob"]
+
+    def __init__(self, host, port):
+        super().__init__()
+        self.version = 0
+        self.reader, self.writer = run_async(asyncio.open_connection(host, port))
+
+    def forward(self, td):
+        pixels = td["pixels"]
+        is_batched = pixels.dim() == 4
+        if not is_batched:
+            pixels = pixels.unsqueeze(0)
+
+        arrays = {"pixels": (pixels * 255.0).round().to(torch.uint8).cpu().numpy()}
+        frame = run_async(self._request(arrays))
+        self.version = frame.version
+
+        action = torch.from_numpy(frame.arrays["action"]).to(td.device)
+        log_prob = torch.from_numpy(frame.arrays["sample_log_prob"]).to(td.device)
+        if not is_batched:
+            action = action.squeeze(0)
+            log_prob = log_prob.squeeze(0)
+
+        td["action"] = action
+        td["sample_log_prob"] = log_prob
+        return td
+
+    async def _request(self, arrays):
+        await write_frame(self.writer, FRAME_TYPE.OBSERVATION, self.version, arrays)
+        return await read_frame(self.reader)
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,36 @@
+import numpy as np
+
+class SCSnapshotArchive():
+    """Go-explore style archive of player states to start episodes from.
+
+    States are grouped into cells by their distance to the finish. Every cell keeps one state, the
+    fastest one seen, and cells that were started from less often are sampled more.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def add(self, player_state, dist_to_finish):
+        cell = int(dist_to_finish // self.cell_size)
+
+        entry = self.cells.get(cell)
+        if entry is None:
+            self.cells[cell] = {"state": player_state, "starts": 0}
+        elif player_state.total_velocity > entry["state"].total_velocity:
+            # More speed means more of the map is reachable from here
+            entry["state"] = player_state
+
+    def sample(self, rng):
+        if len(self.cells) == 0:
+            return None
+
+        cells = list(self.cells.values())
+        weights = np.array([1.0 / np.sqrt(entry["starts"] + 1) for entry in cells])
+        entry = cells[rng.choice(len(cells), p=weights / weights.sum())]
+        entry["starts"] += 1
+
+        return entry["state"]
+
+    def __len__(self):
+        return len(self.cells)
@@ -0,0 +1,61 @@
+class SCSpeedTuner():
+    """Finds the highest game speed at which the game doesn't run ahead of the agent.
+
+    Every step should take lockstep_ticks server ticks. Ticks beyond that passed while the agent
+    was still busy, so the game played them with a stale action. Speed goes up while the average
+    of those missed ticks stays well below max_missed_ticks and down when it goes above.
+    """
+
+    def __init__(self, conf, game_speed, lockstep_ticks):
+        self.conf = conf
+        self.game_speed = game_speed
+        self.lockstep_ticks = lockstep_ticks
+
+        self.tick_deltas = []
+        self.service_times = []
+        self.last_missed_ticks = 0.0
+        self.last_service_time = 0.0
+
+    def record(self, tick_delta, service_time):
+        # Resets and restarts make the tick jump, those are not the agent's fault
+        if tick_delta < 0 or tick_delta > self.conf.max_tick_delta:
+            return
+
+        self.tick_deltas.append(tick_delta)
+        self.service_times.append(service_time)
+
+    def should_update(self):
+        return len(self.tick_deltas) >= self.conf.interval
+
+    def update(self):
+        """Returns the new game speed, or None if it didn't change."""
+        self.last_missed_ticks = sum(max(delta - self.lockstep_ticks, 0) for delta in self.tick_deltas) / len(self.tick_deltas)
+        self.last_service_time = sum(self.service_times) / len(self.service_times)
+        self.tick_deltas = []
+        self.service_times = []
+
+        game_speed = self.game_speed
+        if self.last_missed_ticks > self.conf.max_missed_ticks:
+            game_speed /= self.conf.step_factor
+        elif self.last_missed_ticks < self.conf.max_missed_ticks / 2:
+            game_speed *= self.conf.step_factor
+        game_speed = min(max(game_speed, self.conf.min_speed), self.conf.max_speed)
+
+        if abs(game_speed - self.game_speed) < 1e-6:
+            return None
+
+        print(f"Game speed {self.game_speed:.2f} -> {game_speed:.2f} (missed ticks per step: {self.last_missed_ticks:.2f}, " \
+            f"headroom: {self.get_headroom():.2f})")
+        self.game_speed = game_speed
+        return game_speed
+
+    def get_headroom(self):
+        return self.conf.max_missed_ticks - self.last_missed_ticks
+
+    def get_metrics(self, prefix=""):
+        return {
+            f"{prefix}game_speed": self.game_speed,
+            f"{prefix}missed_ticks": self.last_missed_ticks,
+            f"{prefix}headroom": self.get_headroom(),
+            f"{prefix}service_time": self.last_service_time,
+        }
@@ -0,0 +1,299 @@
+import os
+import json
+import asyncio
+import subprocess
+from enum import Enum
+from time import perf_counter
+import pywintypes
+import win32api
+import win32con
+import win32gui
+import win32process
+from sc_config import get_config
+from sc_assets import sync_game_assets
+
+SERVER_EXE_PATH = os.path.join("css_server", "server", "srcds.exe")
+_STILL_ACTIVE = 259
+
+_supervisor = None
+
+def get_instances_file_path(port):
+    # One per server port, so runs on different ports never adopt each other's instances
+    return os.path.join("css_server", f"instances_{port}.json")
+
+class INSTANCE_STATE(Enum):
+    STOPPED = 1
+    STARTING = 2
+    READY = 3
+    CRASHED = 4
+
+def is_process_alive(pid, exe_name):
+    try:
+        handle = win32api.OpenProcess(win32con.PROCESS_QUERY_INFORMATION | win32con.PROCESS_VM_READ, False, pid)
+    except pywintypes.error:
+        return False
+
+    try:
+        if win32process.GetExitCodeProcess(handle) != _STILL_ACTIVE:
+            return False
+        # Pids get reused, so also check it's still the same program
+        return os.path.basename(win32process.GetModuleFileNameEx(handle, 0)).lower() == exe_name.lower()
+    except pywintypes.error:
+        return False
+    finally:
+        win32api.CloseHandle(handle)
+
+class SCAdoptedProcess():
+    """A game process left running by an earlier run. Has the parts of Popen the supervisor uses."""
+
+    def __init__(self, pid, exe_name):
+        self.pid = pid
+        self.exe_name = exe_name
+
+    def poll(self):
+        return None if is_process_alive(self.pid, self.exe_name) else 1
+
+    def kill(self):
+        try:
+            handle = win32api.OpenProcess(win32con.PROCESS_TERMINATE, False, self.pid)
+            win32api.TerminateProcess(handle, 1)
+            win32api.CloseHandle(handle)
+        except pywintypes.error:
+            pass
+
+class SCGameInstance():
+    server_process = None
+    css_process = None
+    map_name = None
+    owner = None
+    launch_time = None
+    ready_time = None
+    next_restart_time = None
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.state = INSTANCE_STATE.STOPPED
+        self.restarts = 0
+
+    def launch_server(self, map_name):
+        print(f"Initializing server {self.index}...")
+        self.map_name = map_name
+        self.server_process = subprocess.Popen([SERVER_EXE_PATH, "-console", "-game", "cstrike", "-insecure",
+            "-tickrate", str(get_config().server.tickrate), "-port", str(self.port), "+maxplayers", "2", "+map", map_name])
+        self.state = INSTANCE_STATE.STARTING
+        self.launch_time = perf_counter()
+
+    def launch_css(self, server_ip, window_size):
+        print(f"Initializing CSS {self.index}...")
+        css_exe_path = os.path.join(get_config().css.path, "hl2.exe")
+        self.css_process = subprocess.Popen([css_exe_path, "-game", "cstrike", "-windowed", "-novid", \
+            "-exec", "autoexec", "+connect", f"{server_ip}:{self.port}", "-w", str(window_size), "-h", str(window_size)])
+
+    def is_server_alive(self):
+        return self.server_process is not None and self.server_process.poll() is None
+
+    def is_css_alive(self):
+        return self.css_process is not None and self.css_process.poll() is None
+
+    def get_css_window(self):
+        if self.css_process is None:
+            return None
+
+        hwnds = []
+        def collect_window(hwnd, _):
+            if win32gui.IsWindowVisible(hwnd) and win32process.GetWindowThreadProcessId(hwnd)[1] == self.css_process.pid:
+                hwnds.append(hwnd)
+            return True
+        win32gui.EnumWindows(collect_window, None)
+
+        return hwnds[0] if hwnds else None
+
+    def kill(self, should_kill_server=True, should_kill_css=True):
+        if should_kill_css and self.css_process is not None:
+            self.css_process.kill()
+            self.css_process = None
+
+        if should_kill_server and self.server_process is not None:
+            self.server_process.kill()
+            self.server_process = None
+
+        if self.server_process is None:
+            self.state = INSTANCE_STATE.STOPPED
+
+    def to_dict(self):
+        return {
+            "server_pid": self.server_process.pid if self.is_server_alive() else None,
+            "css_pid": self.css_process.pid if self.is_css_alive() else None,
+            "map_name": self.map_name,
+        }
+
+    def adopt(self, instance_dict):
+        server_pid = instance_dict.get("server_pid")
+        if server_pid and is_process_alive(server_pid, "srcds.exe"):
+            self.server_process = SCAdoptedProcess(server_pid, "srcds.exe")
+            self.map_name = instance_dict.get("map_name")
+            self.state = INSTANCE_STATE.STARTING
+            self.launch_time = perf_counter()
+
+            css_pid = instance_dict.get("css_pid")
+            if css_pid and is_process_alive(css_pid, "hl2.exe"):
+                self.css_process = SCAdoptedProcess(css_pid, "hl2.exe")
+
+            print(f"Adopted warm game instance {self.index} ({self.map_name})")
+
+class SCSupervisor():
+    """Keeps a pool of server + CSS instances alive, restarts crashed ones and hands them to games."""
+
+    loop = None
+    monitor_task = None
+    released_event = None
+
+    def __init__(self):
+        self.config = get_config()
+        self.conf = self.config.supervisor
+
+        self.instances = [SCGameInstance(i, self.config.server.port + i * self.conf.port_step)
+            for i in range(self.conf.instances)]
+        self._load_state()
+
+        # Server and CSS dirs are shared by all instances
+        sync_game_assets(self.config)
+
+    def _load_state(self):
+        instances_file_path = get_instances_file_path(self.config.server.port)
+        if not os.path.exists(instances_file_path):
+            return
+
+        with open(instances_file_path, "r") as file:
+            instance_dicts = json.load(file)
+
+        for instance, instance_dict in zip(self.instances, instance_dicts):
+            instance.adopt(instance_dict)
+
+    def _save_state(self):
+        instances_file_path = get_instances_file_path(self.config.server.port)
+        instance_dicts = [instance.to_dict() for instance in self.instances]
+        if not any(instance_dict["server_pid"] for instance_dict in instance_dicts):
+            if os.path.exists(instances_file_path):
+                os.remove(instances_file_path)
+            return
+
+        with open(instances_file_path, "w") as file:
+            json.dump(instance_dicts, file)
+
+    async def acquire(self, owner):
+        if self.monitor_task is None:
+            self.loop = asyncio.get_running_loop()
+            self.released_event = asyncio.Event()
+            self.monitor_task = asyncio.create_task(self._monitor())
+
+        while True:
+            for instance in self.instances:
+                if instance.owner is None:
+                    instance.owner = owner
+                    return instance
+
+            self.released_event.clear()
+            await self.released_event.wait()
+
+    def release(self, instance):
+        instance.owner = None
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.released_event.set)
+
+    def ensure_server(self, instance, map_name):
+        if instance.is_server_alive() and instance.map_name == map_name:
+            return
+
+        instance.kill()
+        instance.launch_server(map_name)
+
+    def switch_map(self, instance, map_name):
+        # The server changes level on its own, the instance only has to get ready again
+        instance.map_name = map_name
+        instance.state = INSTANCE_STATE.STARTING
+        instance.launch_time = perf_counter()
+
+    def mark_ready(self, instance):
+        if instance.state != INSTANCE_STATE.READY:
+            startup_time = perf_counter() - instance.launch_time if instance.launch_time else 0.0
+            print(f"Game instance {instance.index} ready ({startup_time:.1f}s)")
+
+        instance.state = INSTANCE_STATE.READY
+        instance.ready_time = perf_counter()
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.conf.health_interval)
+
+            now = perf_counter()
+            for instance in self.instances:
+                if instance.state == INSTANCE_STATE.STOPPED:
+                    continue
+
+                if instance.state == INSTANCE_STATE.CRASHED:
+                    if now >= instance.next_restart_time:
+                        instance.launch_server(instance.map_name)
+                    continue
+
+                problem = None
+                if not instance.is_server_alive():
+                    problem = "server exited"
+                elif instance.css_process is not None and not instance.is_css_alive():
+                    problem = "CSS exited"
+                elif instance.state == INSTANCE_STATE.STARTING and now - instance.launch_time > self.conf.ready_timeout:
+                    problem = "not ready in time"
+
+                if problem is not None:
+                    self._restart_later(instance, problem)
+                elif instance.state == INSTANCE_STATE.READY and now - instance.ready_time > self.conf.healthy_after:
+                    instance.restarts = 0
+
+    def _restart_later(self, instance, problem):
+        delay = min(self.conf.restart_backoff * 2 ** instance.restarts, self.conf.restart_backoff_max)
+        print(f"Game instance {instance.index} {problem}, restarting in {delay:.0f}s")
+
+        instance.kill()
+        instance.state = INSTANCE_STATE.CRASHED
+        instance.restarts += 1
+        instance.next_restart_time = perf_counter() + delay
+
+        if instance.owner is not None:
+            instance.owner.on_instance_crashed()
+
+    def close(self):
+        if self.monitor_task is not None:
+            self.loop.call_soon_threadsafe(self.monitor_task.cancel)
+
+        # Instances that are kept alive are adopted by the next run
+        for instance in self.instances:
+            instance.kill(self.config.server.close_on_script_close, self.config.css.close_on_script_close)
+        self._save_state()
+
+def kill_saved_instances(port):
+    """Kills the instances a run on port kept alive for the next one."""
+    instances_file_path = get_instances_file_path(port)
+    if not os.path.exists(instances_file_path):
+        return
+
+    with open(instances_file_path, "r") as file:
+        instance_dicts = json.load(file)
+
+    for index, instance_dict in enumerate(instance_dicts):
+        instance = SCGameInstance(index, port)
+        instance.adopt(instance_dict)
+        instance.kill()
+    os.remove(instances_file_path)
+
+def get_supervisor():
+    global _supervisor
+
+    if _supervisor is None:
+        _supervisor = SCSupervisor()
+
+    return _supervisor
+
+def close_supervisor():
+    if _supervisor is not None:
+        _supervisor.close()
@@ -0,0 +1,227 @@
+import os
+import sys
+import csv
+import asyncio
+import itertools
+import argparse
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+import yaml
+from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+from sc_config import get_config, to_overrides_dict, CONFIG_OVERRIDES_ENV
+from SCSupervisor import kill_saved_instances
+
+REWARD_TAG = "train/reward"
+
+def get_params(params_conf):
+    return {key: val for key, val in params_conf.__dict__.items() if key != "_depth"}
+
+def expand_grid(params):
+    """Every combination of the listed values."""
+    ranges = [key for key, values in params.items() if not isinstance(values, list)]
+    if ranges:
+        raise ValueError(f"Grid search needs lists of values, ranges given for: {', '.join(ranges)}")
+
+    keys = list(params)
+    return [dict(zip(keys, values)) for values in itertools.product(*params.values())]
+
+def sample_random(params, count, rng):
+    """Lists are sampled uniformly, {min, max, log} ranges uniformly or log-uniformly."""
+    samples = []
+    for _ in range(count):
+        sample = {}
+        for key, values in params.items():
+            if isinstance(values, list):
+                sample[key] = values[rng.integers(len(values))]
+            elif getattr(values, "log", False):
+                sample[key] = float(np.exp(rng.uniform(np.log(values.min), np.log(values.max))))
+            else:
+                sample[key] = float(rng.uniform(values.min, values.max))
+        samples.append(sample)
+
+    return samples
+
+def read_reward(log_dir, window):
+    """Mean of the last window rewards the newest run in log_dir logged, or None."""
+    event_paths = [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(log_dir)
+        for file_name in file_names if file_name.startswith("events.out.tfevents")]
+    if not event_paths:
+        return None
+
+    events = EventAccumulator(max(event_paths, key=os.path.getmtime), size_guidance={"scalars": 0})
+    events.Reload()
+    if REWARD_TAG not in events.Tags()["scalars"]:
+        return None
+
+    rewards = [event.value for event in events.Scalars(REWARD_TAG)][-window:]
+    return float(np.mean(rewards)) if rewards else None
+
+class SCTrial():
+    def __init__(self, index, overrides, trial_dir):
+        self.index = index
+        self.overrides = overrides
+        self.dir = trial_dir
+        self.status = "pending"
+        self.rung = -1
+        self.batches = 0
+        self.score = None
+        self.run_time = 0.0
+
+class SCSweep():
+    """Trains every trial of config overrides and keeps the best with successive halving.
+
+    All trials train min_batches in the first rung. After each rung the best 1/eta by logged reward
+    go on and train up to eta times as many batches, resumed from their checkpoint. Trials run as
+    train mode processes, up to parallel at once. Each slot has its own server port and keeps its game
+    instance alive for the next trial in that slot.
+    """
+
+    def __init__(self):
+        self.config = get_config()
+        self.conf = self.config.sweep
+        self.rng = np.random.default_rng(self.conf.seed)
+
+        self.date_str = datetime.now().strftime("%d-%m_%H-%M")
+        self.dir = os.path.join(self.conf.results_dir, self.date_str)
+        self.threads_per_trial = self.conf.threads_per_trial or max((os.cpu_count() or 1) // self.conf.parallel, 1)
+        self.max_batches = self.get_rung_batches(self.conf.rungs - 1)
+        self.trials = self.create_trials()
+
+    def create_trials(self):
+        params = get_params(self.conf.params)
+        if self.conf.method == "grid":
+            overrides_list = expand_grid(params)
+        elif self.conf.method == "random":
+            overrides_list = sample_random(params, self.conf.trials, self.rng)
+        else:
+            raise ValueError(f"Unknown sweep method {self.conf.method}, use grid or random")
+
+        return [SCTrial(i, overrides, os.path.join(self.dir, f"trial_{i}")) for i, overrides in enumerate(overrides_list)]
+
+    def get_rung_batches(self, rung):
+        return self.conf.min_batches * self.conf.eta ** rung
+
+    def get_slot_port(self, slot):
+        return self.config.server.port + slot * self.config.supervisor.port_step
+
+    async def run(self):
+        print(f"Sweep: {len(self.trials)} trials, {self.conf.rungs} rungs, {self.conf.parallel} at once, " \
+            f"{self.threads_per_trial} threads each")
+        start_time = perf_counter()
+
+        self.slots = asyncio.Queue()
+        for slot in range(self.conf.parallel):
+            self.slots.put_nowait(slot)
+
+        try:
+            trials = self.trials
+            for rung in range(self.conf.rungs):
+                await asyncio.gather(*[self.run_trial(trial, rung) for trial in trials])
+
+                trials = [trial for trial in trials if trial.status != "failed"]
+                trials.sort(key=lambda trial: trial.score if trial.score is not None else -np.inf, reverse=True)
+                if rung == self.conf.rungs - 1:
+                    break
+
+                keep_count = max(len(trials) // self.conf.eta, 1)
+                for trial in trials[keep_count:]:
+                    trial.status = "stopped"
+                trials = trials[:keep_count]
+                print(f"Rung {rung}: {keep_count} trials continue ({', '.join(str(trial.index) for trial in trials)})")
+
+            for trial in trials:
+                trial.status = "finished"
+        finally:
+            for slot in range(self.conf.parallel):
+                kill_saved_instances(self.get_slot_port(slot))
+
+            self.write_results(perf_counter() - start_time)
+
+    async def run_trial(self, trial, rung):
+        slot = await self.slots.get()
+        try:
+            os.makedirs(trial.dir, exist_ok=True)
+            overrides_path = os.path.join(trial.dir, f"overrides_{rung}.yml")
+            with open(overrides_path, "w") as file:
+                yaml.safe_dump(to_overrides_dict(self.get_run_overrides(trial, rung, slot)), file)
+
+            env = os.environ.copy()
+            env[CONFIG_OVERRIDES_ENV] = overrides_path
+            env["OMP_NUM_THREADS"] = str(self.threads_per_trial)
+
+            print(f"Trial {trial.index} rung {rung} started (slot {slot})")
+            trial.status = "running"
+            start_time = perf_counter()
+            with open(os.path.join(trial.dir, f"output_{rung}.txt"), "w") as output_file:
+                process = await asyncio.create_subprocess_exec(sys.executable, os.path.join("src", "SurfChan.py"), "t",
+                    env=env, stdout=output_file, stderr=asyncio.subprocess.STDOUT)
+                return_code = await process.wait()
+            trial.run_time += perf_counter() - start_time
+        finally:
+            self.slots.put_nowait(slot)
+
+        trial.rung = rung
+        trial.batches = self.get_rung_batches(rung)
+        trial.score = read_reward(os.path.join(trial.dir, "logs"), self.conf.score_window)
+        if return_code != 0 or trial.score is None:
+            trial.status = "failed"
+        print(f"Trial {trial.index} rung {rung} {trial.status if trial.status == 'failed' else 'done'}: " \
+            f"score={trial.score}, {trial.run_time:.0f}s")
+
+    def get_run_overrides(self, trial, rung, slot):
+        overrides = dict(trial.overrides)
+        overrides.update({
+            "model.results_dir": trial.dir,
+            "logging.path": os.path.join(trial.dir, "log.txt"),
+            "train.should_save": True,
+            "train.should_resume": rung > 0,
+            "train.collector.batches": self.get_rung_batches(rung) - trial.batches,
+            # The lr decays over the longest trial, so a trial's lr doesn't depend on the rung it stops at
+            "train.collector.anneal_batches": self.max_batches,
+            "server.port": self.get_slot_port(slot),
+            "server.close_on_script_close": False,
+            "css.close_on_script_close": False,
+            "supervisor.instances": 1,
+        })
+        return overrides
+
+    def write_results(self, sweep_time):
+        trials = sorted(self.trials, key=lambda trial: (trial.rung, trial.score if trial.score is not None else -np.inf),
+            reverse=True)
+        param_keys = list(get_params(self.conf.params))
+
+        os.makedirs(self.dir, exist_ok=True)
+        results_path = os.path.join(self.dir, "results.csv")
+        with open(results_path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["trial", "status", "rung", "batches", "score", "time"] + param_keys)
+            for trial in trials:
+                writer.writerow([trial.index, trial.status, trial.rung, trial.batches, trial.score, f"{trial.run_time:.0f}"] +
+                    [trial.overrides[key] for key in param_keys])
+
+        print(f"Sweep took {sweep_time / 60:.1f}min, results in {results_path}:")
+        for trial in trials:
+            score = f"{trial.score:.3f}" if trial.score is not None else "-"
+            params = ", ".join(f"{key}={trial.overrides[key]}" for key in param_keys)
+            print(f"  {trial.index}: {trial.status}, rung {trial.rung}, score {score}, {params}")
+
+        best_trial = trials[0] if trials and trials[0].status == "finished" else None
+        if best_trial is not None:
+            best_path = os.path.join(self.dir, "best.yml")
+            with open(best_path, "w") as file:
+                yaml.safe_dump(to_overrides_dict(best_trial.overrides), file)
+            print(f"Best overrides in {best_path}, run with {CONFIG_OVERRIDES_ENV} set to it or merge into config.yml")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SurfChan hyperparameter sweep")
+    parser.add_argument("--list", action="store_true", help="Only print the trials.")
+    args = parser.parse_args()
+
+    sweep = SCSweep()
+    if args.list:
+        for trial in sweep.trials:
+            print(f"{trial.index}: {trial.overrides}")
+        sys.exit(0)
+
+    asyncio.run(sweep.run())
@@ -0,0 +1,208 @@
+import json
+import asyncio
+import traceback
+from collections import deque
+from time import perf_counter
+import numpy as np
+from sc_transport import FRAME_TYPE, encode_frame
+from sc_utils import run_async
+from sc_log import log_error
+
+_LATENCY_SAMPLES = 4096
+
+class SCTelemetry():
+    """Streams live values of a run to any client connected to gui.host:gui.port.
+
+    Every interval seconds the server publishes step rate, step latency percentiles and reward of the
+    steps since the last publish, the latest values of the added sources and set values, and, in
+    binary format, the latest observation downscaled to observation_size. Binary frames are
+    sc_transport frames with the values in meta. JSON frames are one line of values each.
+
+    record_step only stores numbers and a reference to the observation, all the work happens on the
+    background loop. Clients that fall more than max_buffer_kb behind skip frames instead of slowing
+    down the publisher.
+    """
+
+    is_running = False
+
+    def __init__(self):
+        self.server = None
+        self.publish_task = None
+        self.clients = set()
+        self.sources = {}
+        self.values = {}
+
+        self.steps = 0
+        self.latencies = deque(maxlen=_LATENCY_SAMPLES)
+        self.window_reward = 0.0
+        self.episode_reward = 0.0
+        self.last_episode_reward = None
+        self.episodes = 0
+        self.last_obs = None
+
+        self.last_publish_time = None
+        self.last_publish_steps = 0
+        self.last_publish_reward = 0.0
+        self.dropped_frames = 0
+
+    def start(self, conf):
+        self.conf = conf
+        self.max_buffer_size = conf.max_buffer_kb * 1024
+        run_async(self._start())
+        self.is_running = True
+        print(f"Telemetry on {conf.host}:{conf.port}")
+
+    async def _start(self):
+        self.server = await asyncio.start_server(self._handle_client, self.conf.host, self.conf.port)
+        self.last_publish_time = perf_counter()
+        self.publish_task = asyncio.create_task(self._publish_loop())
+
+    def record_step(self, latency, reward, done, obs):
+        # Runs on the step path, so nothing here formats, copies or waits
+        self.steps += 1
+        self.latencies.append(latency)
+        self.window_reward += reward
+        self.episode_reward += reward
+        self.last_obs = obs
+        if done:
+            self.last_episode_reward = self.episode_reward
+            self.episode_reward = 0.0
+            self.episodes += 1
+
+    def add_source(self, prefix, get_metrics):
+        """get_metrics(prefix) is called on every publish, like the get_metrics of the queues and tuners."""
+        self.sources[prefix] = get_metrics
+
+    def set_values(self, values):
+        self.values.update(values)
+
+    def get_values(self):
+        now = perf_counter()
+        elapsed_time = now - self.last_publish_time
+        steps = self.steps - self.last_publish_steps
+        reward = self.window_reward - self.last_publish_reward
+        self.last_publish_time = now
+        self.last_publish_steps = self.steps
+        self.last_publish_reward = self.window_reward
+
+        # Swapped instead of cleared, so latencies record_step appends meanwhile end up in the next window
+        latencies, self.latencies = self.latencies, deque(maxlen=_LATENCY_SAMPLES)
+        latencies = np.array(latencies)
+        values = {
+            "steps": self.steps,
+            "step_rate": steps / elapsed_time if elapsed_time > 0.0 else 0.0,
+            "reward": reward / steps if steps > 0 else None,
+            "episode_reward": self.last_episode_reward,
+            "episodes": self.episodes,
+            "dropped_frames": self.dropped_frames,
+        }
+        if len(latencies) > 0:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000.0
+            values.update({"step_latency_p50_ms": p50, "step_latency_p90_ms": p90, "step_latency_p99_ms": p99})
+
+        for prefix, get_metrics in list(self.sources.items()):
+            values.update(get_metrics(prefix))
+        values.update(self.values)
+
+        return {key: value.item() if isinstance(value, np.generic) else value for key, value in values.items()}
+
+    def get_observation(self):
+        if self.last_obs is None:
+            return None
+
+        # CHW floats in [0, 1] to a small HWC uint8 image
+        pixels = self.last_obs["pixels"]
+        stride = max(pixels.shape[-1] // self.conf.observation_size, 1)
+        return (pixels[:, ::stride, ::stride] * 255.0).astype(np.uint8).transpose(1, 2, 0)
+
+    def encode(self, values):
+        if self.conf.format == "json":
+            return [json.dumps(values).encode() + b"\n"]
+
+        observation = self.get_observation()
+        arrays = {"observation": observation} if observation is not None else {}
+        return encode_frame(FRAME_TYPE.TELEMETRY, self.steps, arrays, values)
+
+    async def _publish_loop(self):
+        while True:
+            await asyncio.sleep(self.conf.interval)
+            try:
+                values = self.get_values()
+                if not self.clients:
+                    continue
+
+                buffers = self.encode(values)
+                for writer in list(self.clients):
+                    if writer.is_closing():
+                        self.clients.discard(writer)
+                    elif writer.transport.get_write_buffer_size() > self.max_buffer_size:
+                        self.dropped_frames += 1
+                    else:
+                        writer.writelines(buffers)
+            except Exception:
+                # A failing source skips one publish instead of ending telemetry for the run
+                log_error("Telemetry publish failed: %s", traceback.format_exc())
+
+    async def _handle_client(self, reader, writer):
+        print(f"Telemetry client connected: {writer.get_extra_info('peername')}")
+        self.clients.add(writer)
+        try:
+            # Clients only listen, anything they send is ignored until they disconnect
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def _close(self):
+        if self.publish_task is not None:
+            self.publish_task.cancel()
+        for writer in list(self.clients):
+            writer.close()
+        self.clients.clear()
+        if self.server is not None:
+            self.server.close()
+
+    def close(self):
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        run_async(self._close())
+
+sc_telemetry = SCTelemetry()
+
+if __name__ == "__main__":
+    import threading
+    import time
+    from types import SimpleNamespace
+    from sc_transport import read_frame
+
+    # Steps a fake env in a thread and prints what a client receives
+    conf = SimpleNamespace(host="127.0.0.1", port=27016, interval=0.25, observation_size=64, format="binary",
+        max_buffer_kb=1024)
+    sc_telemetry.start(conf)
+    sc_telemetry.add_source("fake/", lambda prefix: {f"{prefix}queue_depth": 3})
+    sc_telemetry.set_values({"distributed/policy_lag": 1.0})
+
+    def step_loop():
+        for i in range(200):
+            latency = np.random.uniform(0.005, 0.02)
+            time.sleep(latency)
+            obs = {"pixels": np.random.rand(3, 512, 512).astype(np.float32)}
+            sc_telemetry.record_step(latency, 0.1, i % 50 == 49, obs)
+
+    threading.Thread(target=step_loop, daemon=True).start()
+
+    async def listen():
+        reader, writer = await asyncio.open_connection(conf.host, conf.port)
+        for _ in range(4):
+            frame = await read_frame(reader)
+            print({key: round(value, 2) if isinstance(value, float) else value for key, value in frame.meta.items()})
+            print(f"observation: {frame.arrays['observation'].shape}")
+        writer.close()
+
+    run_async(listen())
+    sc_telemetry.close()
@@ -5,11 +5,23 @@ class SCTimer():
     _BASE_CATEGORY = "_base"
     _PRINT_TOP_HIGHEST_COUNT = 5
     _timers = {}
+    # Objects with on_start(name, category) and on_stop(name, category), called outside the timed span
+    _listeners = []
 
     def __init__(self):
         self._timers[self._BASE_CATEGORY] = {}
 
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
     def start(self, name, category=_BASE_CATEGORY):
+        for listener in self._listeners:
+            listener.on_start(name, category)
+
         category_timers = self._timers.setdefault(category, {})
         timer = category_timers.setdefault(name, {"current": 0, "times": []})
         timer["current"] = perf_counter()
@@ -23,11 +35,19 @@ class SCTimer():
         timer["times"].append(elapsed_time)
         timer["current"] = 0
 
+        for listener in self._listeners:
+            listener.on_stop(name, category)
+
         if should_print:
             print(f"{name}: {elapsed_time:.4f}s")
         
         return elapsed_time
     
+    def add(self, name, elapsed_time, category=_BASE_CATEGORY):
+        category_timers = self._timers.setdefault(category, {})
+        timer = category_timers.setdefault(name, {"current": 0, "times": []})
+        timer["times"].append(elapsed_time)
+    
     def get_current(self, name, category=_BASE_CATEGORY):
         if category not in self._timers or name not in self._timers[category]:
             return None
@@ -50,6 +70,14 @@ class SCTimer():
     def clear(self, name, category=_BASE_CATEGORY):
         self._timers[category][name]["times"] = []
 
+    def get_counts(self):
+        """Recorded times per category/name. Times are kept until cleared, so these only grow."""
+        return {
+            f"{category}/{name}": len(timer["times"])
+            for category, timers in self._timers.items()
+            for name, timer in timers.items()
+        }
+
     def to_dict(self, category=None, prefix=None):
         if category is None:
             timers = {
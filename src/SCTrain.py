@@ -2,6 +2,8 @@ import os
 import shutil
 import time
 import asyncio
+import threading
+import traceback
 from datetime import datetime
 import tqdm
 import torch
@@ -10,18 +12,35 @@ from torchrl.collectors import SyncDataCollector
 from torchrl.data import LazyTensorStorage, TensorDictReplayBuffer
 from torchrl.data.replay_buffers.samplers import SamplerWithoutReplacement
 from torchrl.objectives.value import GAE
+from torchrl.modules import set_recurrent_mode
 from torchrl.record.loggers.tensorboard import TensorboardLogger
 from torchrl._utils import compile_with_warmup
 from sc_config import get_config, CONFIG_FILE_NAME
-from sc_model_utils import get_torch_device, get_models
-from SCEnv import create_torchrl_env
+from sc_model_utils import get_torch_device, get_models, get_architecture, add_model_transforms, create_fake_observation, create_fake_rollout
+from sc_compile_cache import get_compile_cache_key, init_compile_cache, get_cache_counts, get_cache_hit_rate
+from sc_log import log_error
+from SCEnv import create_torchrl_env, create_specs
 from SCTimer import sc_timer
+from SCMetrics import SCMetrics
+from SCMemoryProfiler import SCMemoryProfiler
+from SCDataParallel import SCDataParallel
+from SCCurriculum import SCCurriculum
 
 class SCTrain():
+    models = None
+    stats = None
+    env = None
+    collector = None
+    logger = None
+    metrics = None
+    memory_profiler = None
+    data_parallel = None
+    date_str = None
+
     def __init__(self, surfchan):
         self.surfchan = surfchan
 
-    async def train(self):
+    def init_config(self):
         self.config = get_config()
         self.collector_conf = self.config.train.collector
         self.optimizer_conf = self.config.train.optimizer
@@ -31,15 +50,37 @@ class SCTrain():
 
         self.device = get_torch_device()
 
+        self.should_compile = self.config.train.should_compile
+        self.compile_mode = "reduce-overhead" if self.should_compile else None
+        self.compile_cache_conf = self.config.train.compile_cache
+
+        self.recurrent_conf = self.config.model.recurrent
+
+    async def train(self):
+        self.init_config()
+
         frames_per_batch = self.collector_conf.frames_per_batch
         total_frames = frames_per_batch * self.collector_conf.batches
 
-        should_compile = self.config.train.should_compile
-        compile_mode = "reduce-overhead" if should_compile else None
-        
-        self.env = create_torchrl_env(self.surfchan, self.config.train.map)
-        
-        self.models, self.stats = get_models(self.env, self.device)
+        # The models only need the specs, so they're built and compiled while the game boots
+        observation_spec, action_spec = create_specs(self.device)
+        self.models, self.stats = get_models(observation_spec, action_spec, self.device)
+        self.init_learner(frames_per_batch, total_frames)
+
+        warmup_thread = None
+        if self.should_compile and self.compile_cache_conf.background_warmup:
+            warmup_thread = threading.Thread(target=self.warmup_compile, args=(observation_spec, frames_per_batch),
+                daemon=True)
+            warmup_thread.start()
+
+        curriculum = None
+        if self.config.train.curriculum.enabled:
+            curriculum = SCCurriculum(self.config.train.curriculum, self.config.maps, self.config.train.map)
+        self.env = create_torchrl_env(self.surfchan, self.config.train.map, curriculum=curriculum)
+        add_model_transforms(self.env, self.models)
+
+        if warmup_thread is not None:
+            warmup_thread.join()
 
         self.collector = SyncDataCollector(
             create_env_fn=self.env,
@@ -48,47 +89,11 @@ class SCTrain():
             total_frames=total_frames,
             device=self.device,
             max_frames_per_traj=-1,
-            compile_policy={"mode": compile_mode, "warmup": 1} if compile_mode else False
-        )
-
-        mini_batch_size = frames_per_batch // self.loss_conf.mini_batches_per_batch
-        sampler = SamplerWithoutReplacement()
-        data_buffer = TensorDictReplayBuffer(
-            storage=LazyTensorStorage(
-                frames_per_batch, compilable=should_compile, device=self.device
-            ),
-            sampler=sampler,
-            batch_size=mini_batch_size,
-            compilable=should_compile,
-        )
-
-        advantage_module = GAE(
-            gamma=self.loss_conf.gamma,
-            lmbda=self.loss_conf.gae_lambda,
-            value_network=self.models.critic,
-            average_gae=False,
-            device=self.device,
-            vectorized=not should_compile,
+            compile_policy={"mode": self.compile_mode, "warmup": 1} if self.compile_mode else False
         )
 
-        self.date_str = datetime.now().strftime("%d-%m_%H-%M")
-        logger = None
-        if self.config.train.should_save:
-            logger = TensorboardLogger(exp_name=self.date_str, log_dir=f"{self.config.model.results_dir}/logs")
-
         collected_frames = 0
         pbar = tqdm.tqdm(total=total_frames)
-        self.total_network_updates = (
-            (total_frames // frames_per_batch) *
-            self.loss_conf.ppo_epochs *
-            self.loss_conf.mini_batches_per_batch
-        )
-
-        if should_compile:
-            self.update = compile_with_warmup(self.update, mode=compile_mode, warmup=1)
-            advantage_module = compile_with_warmup(advantage_module, mode=compile_mode, warmup=1)
-        
-        losses = TensorDict(batch_size=[self.loss_conf.ppo_epochs, self.loss_conf.mini_batches_per_batch])
 
         sc_timer.start("training")
 
@@ -102,69 +107,285 @@ class SCTrain():
             sc_timer.stop("collecting", "tb")
 
             if i != total_iter - 1:
-                self.env.env.reset()
+                # Through the collector, so its next step starts from the reset observation and hidden state
+                self.collector.reset()
 
-            metrics_to_log = {}
             frames_in_batch = data.numel()
             collected_frames += frames_in_batch
             pbar.update(frames_in_batch)
 
-            if len(data["next", "episode_reward"]) > 0:
-                metrics_to_log.update({"train/reward": data["next", "episode_reward"].mean().item()})
+            metrics_to_log = self.train_batch(data)
 
-            sc_timer.start("training", "tb")
-            for j in range(self.loss_conf.ppo_epochs):
-                with torch.no_grad():
-                    sc_timer.start("advantage", "tb")
-                    data = advantage_module(data)
-                    if compile_mode:
-                        data = data.clone()
-                    sc_timer.stop("advantage", "tb")
-                
-                sc_timer.start("rb extend", "tb")
-                data_reshape = data.reshape(-1)
-                data_buffer.extend(data_reshape)
-                sc_timer.stop("rb extend", "tb")
-
-                for k, batch in enumerate(data_buffer):
-                    if k >= self.loss_conf.mini_batches_per_batch:
-                        break
-                    
-                    sc_timer.start("update", "tb")
-                    loss = self.update(batch)
-                    sc_timer.stop("update", "tb")
-
-                    loss = loss.clone()
-                    losses[j, k] = loss.select(
-                        "loss_critic", "loss_entropy", "loss_objective"
-                    )
-            sc_timer.stop("training", "tb")
-
-            losses_mean = losses.apply(lambda x: x.float().mean(), batch_size=[])
-            for key, value in losses_mean.items():
-                metrics_to_log.update({f"train/{key}": value.item()})
-            metrics_to_log.update(
-                {
-                    "train/lr": loss["alpha"] * self.optimizer_conf.lr,
-                    "train/clip_epsilon": loss["alpha"] * self.loss_conf.clip_epsilon,
-                }
-            )
-
-            if logger:
+            if self.logger:
                 avg_batch_step_time = self.get_avg_batch_step_time()
-                self.stats.step_times.append(avg_batch_step_time)
+                # Scaled by the speed the batch ran at, which the speed tuner can change between batches
+                self.stats.step_times.append(avg_batch_step_time * self.get_game_speed())
 
                 time_dict = sc_timer.to_dict("tb", "time/")
                 time_dict["time/avg_step"] = avg_batch_step_time
                 metrics_to_log.update(time_dict)
+                metrics_to_log.update(self.env.env.game.message_queue.get_latency_metrics("time/messages/"))
+                metrics_to_log.update(self.env.env.game.message_queue.get_metrics("messages/"))
+                metrics_to_log.update(self.env.env.game.get_capture_metrics("capture/"))
+                if self.env.env.speed_tuner is not None:
+                    metrics_to_log.update(self.env.env.speed_tuner.get_metrics("speed/"))
+                if self.env.env.curriculum is not None:
+                    metrics_to_log.update(self.env.env.curriculum.get_metrics("curriculum/"))
                 metrics_to_log["time/speed"] = pbar.format_dict["rate"]
-                for key, value in metrics_to_log.items():
-                    logger.log_scalar(key, value, collected_frames)
+                self.log_metrics(metrics_to_log, collected_frames)
 
             self.collector.update_policy_weights_()
         
         pbar.close()
 
+    def init_learner(self, frames_per_batch, total_frames, row_length=None):
+        """row_length is the frames of each trajectory in a batch, all of them by default."""
+        # Recurrent models are trained on sequences, which are the buffer's items then
+        buffer_size = frames_per_batch
+        if self.models.is_recurrent():
+            row_length = row_length or frames_per_batch
+            buffer_size = frames_per_batch // row_length * len(self.get_sequence_starts(row_length))
+            if self.config.capture.drop_duplicates:
+                print("capture.drop_duplicates is ignored for recurrent models, which train on every frame of a sequence")
+        mini_batch_size = max(buffer_size // self.loss_conf.mini_batches_per_batch, 1)
+        self.mini_batch_size = mini_batch_size
+        sampler = SamplerWithoutReplacement()
+        self.data_buffer = TensorDictReplayBuffer(
+            storage=LazyTensorStorage(
+                buffer_size, compilable=self.should_compile, device=self.device
+            ),
+            sampler=sampler,
+            batch_size=mini_batch_size,
+            compilable=self.should_compile,
+        )
+
+        self.advantage_module = GAE(
+            gamma=self.loss_conf.gamma,
+            lmbda=self.loss_conf.gae_lambda,
+            value_network=self.models.critic,
+            average_gae=False,
+            device=self.device,
+            vectorized=not self.should_compile,
+            # The GRU can't run under vmap, so values are computed in one call over the shifted sequence
+            shifted=self.models.is_recurrent(),
+        )
+
+        self.date_str = datetime.now().strftime("%d-%m_%H-%M")
+        if self.config.train.should_save:
+            self.logger = TensorboardLogger(exp_name=self.date_str, log_dir=f"{self.config.model.results_dir}/logs")
+            self.metrics = SCMetrics(self.logger, self.config.train.log_interval)
+
+        # Annealing can span several runs that resume each other, update_count carries over
+        anneal_batches = self.collector_conf.anneal_batches or total_frames // frames_per_batch
+        self.total_network_updates = (
+            anneal_batches *
+            self.loss_conf.ppo_epochs *
+            self.loss_conf.mini_batches_per_batch
+        )
+
+        if self.should_compile:
+            if self.compile_cache_conf.enabled:
+                self.init_compile_cache(frames_per_batch, mini_batch_size)
+            self.update = compile_with_warmup(self.update, mode=self.compile_mode, warmup=1)
+            self.advantage_module = compile_with_warmup(self.advantage_module, mode=self.compile_mode, warmup=1)
+        
+        self.losses = TensorDict(batch_size=[self.loss_conf.ppo_epochs, self.loss_conf.mini_batches_per_batch])
+
+        if self.config.train.memory_profiler.enabled:
+            self.memory_profiler = SCMemoryProfiler(self.config.train.memory_profiler, self.device)
+
+        if self.config.train.data_parallel.enabled:
+            if self.should_compile:
+                raise ValueError("train.data_parallel doesn't support should_compile")
+            self.data_parallel = SCDataParallel(self.models, self.config.train.data_parallel, self.device)
+
+    def init_compile_cache(self, frames_per_batch, mini_batch_size):
+        key = get_compile_cache_key(self.config.model, self.device, self.compile_mode, (frames_per_batch, mini_batch_size))
+        cache_dir = os.path.join(self.config.model.results_dir, "compile_cache", key)
+        init_compile_cache(cache_dir)
+        print(f"Compile cache: {cache_dir}")
+
+    def warmup_compile(self, observation_spec, frames_per_batch):
+        """Compiles the policy, the advantage module and update on a fake rollout, so the first batch
+        doesn't wait for it. Runs on its own thread while the game boots and leaves the weights,
+        optimizer state and update count as they were.
+
+        CUDA graphs are recorded per thread, so the training thread still records its own on the
+        first call, but the compiled graphs and kernels are shared.
+        """
+        start_counts = get_cache_counts()
+        start_time = time.perf_counter()
+        state = self.get_warmup_state()
+        try:
+            data = create_fake_rollout(self.models, observation_spec, frames_per_batch, self.device)
+            # Unbatched, like the collector steps the env
+            observation = create_fake_observation(self.models, observation_spec, 1, self.device)[0]
+            policy = compile_with_warmup(self.models.actor, mode=self.compile_mode, warmup=1)
+
+            # compile_with_warmup runs the first call eagerly
+            for _ in range(2):
+                with torch.no_grad():
+                    policy(observation.clone())
+                self.warmup_batch(data.clone())
+        except Exception:
+            # The compile then just happens during the first batch
+            log_error("Compile warmup failed: %s", traceback.format_exc())
+            return
+        finally:
+            self.restore_warmup_state(state)
+
+        warmup_time = time.perf_counter() - start_time
+        hit_rate = get_cache_hit_rate(start_counts, get_cache_counts())
+        print(f"Compile warmup: {warmup_time:.1f}s, cache hit rate: {hit_rate * 100:.0f}%")
+        if self.metrics is not None:
+            self.metrics.add("compile/warmup_time", warmup_time)
+            self.metrics.add("compile/cache_hit_rate", hit_rate)
+
+    def warmup_batch(self, data):
+        # train_batch without the replay buffer, timers and metrics, on a mini batch of the same shape
+        with torch.no_grad(), set_recurrent_mode(self.models.is_recurrent() or None):
+            data = self.advantage_module(data)
+        if self.models.is_recurrent():
+            data = self.split_sequences(data)
+        else:
+            data = data.reshape(-1)
+        self.update(data[:self.mini_batch_size].clone())
+
+    def get_warmup_state(self):
+        return {
+            "actor": {key: value.clone() for key, value in self.models.actor.state_dict().items()},
+            "critic": {key: value.clone() for key, value in self.models.critic.state_dict().items()},
+            "optimizer": {param: {key: value.clone() for key, value in param_state.items()
+                if isinstance(value, torch.Tensor)} for param, param_state in self.models.optimizer.state.items()},
+            "update_count": self.stats.update_count.clone(),
+        }
+
+    def restore_warmup_state(self, state):
+        # Everything is copied in place, so the compiled update keeps using the same tensors
+        self.models.actor.load_state_dict(state["actor"])
+        self.models.critic.load_state_dict(state["critic"])
+        for param, param_state in self.models.optimizer.state.items():
+            saved_state = state["optimizer"].get(param)
+            for key, value in param_state.items():
+                if not isinstance(value, torch.Tensor):
+                    continue
+                if saved_state is None:
+                    # Adam with zeroed moments and step is the same as a fresh one
+                    value.zero_()
+                else:
+                    value.copy_(saved_state[key])
+        self.stats.update_count.copy_(state["update_count"])
+
+    def train_batch(self, data):
+        metrics_to_log = {}
+
+        # Metrics stay tensors on the device, SCMetrics copies them to the host in one go
+        if len(data["next", "episode_reward"]) > 0:
+            metrics_to_log.update({"train/reward": data["next", "episode_reward"].mean()})
+
+        sc_timer.start("training", "tb")
+        for j in range(self.loss_conf.ppo_epochs):
+            with torch.no_grad(), set_recurrent_mode(self.models.is_recurrent() or None):
+                sc_timer.start("advantage", "tb")
+                data = self.advantage_module(data)
+                if self.compile_mode:
+                    data = data.clone()
+                sc_timer.stop("advantage", "tb")
+            
+            sc_timer.start("rb extend", "tb")
+            if self.models.is_recurrent():
+                # Flattening would break recurrence, so the buffer holds sequences instead of frames
+                data_reshape = self.split_sequences(data)
+                self.data_buffer.empty()
+            else:
+                data_reshape = data.reshape(-1)
+            if self.config.capture.drop_duplicates and not self.models.is_recurrent() \
+                    and ("next", "is_duplicate") in data_reshape.keys(True):
+                data_reshape = data_reshape[data_reshape["next", "is_duplicate"] == 0]
+                # Fewer frames than the storage holds, so the previous batch has to go explicitly
+                self.data_buffer.empty()
+            self.data_buffer.extend(data_reshape)
+            sc_timer.stop("rb extend", "tb")
+
+            for k, batch in enumerate(self.data_buffer):
+                if k >= self.loss_conf.mini_batches_per_batch:
+                    break
+                
+                if self.data_parallel is not None and self.data_parallel.should_check:
+                    metrics_to_log["data_parallel/max_weight_diff"] = self.data_parallel.check(self, batch)
+
+                sc_timer.start("update", "tb")
+                loss = self.update(batch)
+                sc_timer.stop("update", "tb")
+
+                loss = loss.clone()
+                self.losses[j, k] = loss.select(
+                    "loss_critic", "loss_entropy", "loss_objective"
+                )
+        sc_timer.stop("training", "tb")
+
+        losses_mean = self.losses.apply(lambda x: x.float().mean(), batch_size=[])
+        for key, value in losses_mean.items():
+            metrics_to_log.update({f"train/{key}": value})
+        metrics_to_log.update(
+            {
+                "train/lr": loss["alpha"] * self.optimizer_conf.lr,
+                "train/clip_epsilon": loss["alpha"] * self.loss_conf.clip_epsilon,
+            }
+        )
+
+        if self.memory_profiler is not None:
+            metrics_to_log.update(self.memory_profiler.get_metrics("memory/"))
+            # What the first batch allocates is expected, growth after it is what the leak report shows
+            if self.memory_profiler.baseline_rss is None:
+                self.memory_profiler.mark_baseline()
+
+        return metrics_to_log
+
+    def split_sequences(self, data):
+        """Splits [..., T] data into [N, burn_in + sequence_length] sequences.
+
+        Sequences start every sequence_length frames and the burn_in frames before each are shared
+        with the previous sequence. The last sequence ends at the end of the row, so the frames after
+        the last full step are trained on too, some of them twice. The first burn_in frames of every
+        row are only used for burn-in. Episode ends inside a sequence are handled by the GRU, which
+        starts over at is_init.
+        """
+        window = self.recurrent_conf.burn_in + self.recurrent_conf.sequence_length
+        rows = data.reshape(-1, data.shape[-1])
+        starts = torch.tensor(self.get_sequence_starts(rows.shape[-1]), device=rows.device)
+        indices = starts.unsqueeze(-1) + torch.arange(window, device=rows.device)
+        return rows[:, indices].reshape(-1, window)
+
+    def get_sequence_starts(self, row_length):
+        sequence_length = self.recurrent_conf.sequence_length
+        window = self.recurrent_conf.burn_in + sequence_length
+        if row_length < window:
+            raise ValueError(f"Rows of {row_length} frames are shorter than burn_in + sequence_length ({window})")
+
+        starts = list(range(0, row_length - window + 1, sequence_length))
+        if starts[-1] + window < row_length:
+            starts.append(row_length - window)
+        return starts
+
+    def burn_in(self, batch):
+        """Recomputes the hidden state at the start of the trained part of each sequence with the
+        current weights, so the loss isn't computed from a state the old weights produced."""
+        burn_in = self.recurrent_conf.burn_in
+        if burn_in == 0:
+            return batch
+
+        with torch.no_grad(), set_recurrent_mode(True):
+            warmup = self.models.common(batch[:, :burn_in].select(*self.models.common.in_keys).clone())
+
+        batch = batch[:, burn_in:]
+        recurrent_state = batch["recurrent_state"].clone()
+        recurrent_state[:, 0] = warmup["next", "recurrent_state"][:, -1]
+        return batch.set("recurrent_state", recurrent_state)
+
+    def log_metrics(self, metrics_to_log, step):
+        self.metrics.log(metrics_to_log, step)
+
     def update(self, batch):
         self.models.optimizer.zero_grad(set_to_none=True)
 
@@ -178,14 +399,20 @@ class SCTrain():
         self.stats.update_count += 1
         
         batch = batch.to(self.device, non_blocking=True)
+        if self.models.is_recurrent():
+            batch = self.burn_in(batch)
 
         if "sample_log_prob" in batch:
             batch["sample_log_prob"] = batch["sample_log_prob"].clamp(-10, 10)
 
-        loss = self.models.loss_module(batch)
-        loss_sum = loss["loss_critic"] + loss["loss_objective"] + loss["loss_entropy"]
-        
-        loss_sum.backward()
+        if self.data_parallel is not None:
+            loss = self.data_parallel.backward(batch, self.mini_batch_size)
+        else:
+            with set_recurrent_mode(self.models.is_recurrent() or None):
+                loss = self.models.loss_module(batch)
+            loss_sum = loss["loss_critic"] + loss["loss_objective"] + loss["loss_entropy"]
+
+            loss_sum.backward()
         torch.nn.utils.clip_grad_norm_(
             self.models.loss_module.parameters(), max_norm=self.loss_conf.max_gradient_norm
         )
@@ -205,9 +432,31 @@ class SCTrain():
         step_times = [time for time in step_times if time < treshold]
         return sum(step_times) / len(step_times)
 
+    def get_game_speed(self):
+        # The speed tuner may have moved away from the configured speed
+        if self.env is not None:
+            return self.env.env.game.game_speed
+        return self.config.env.game_speed
+
     def close(self):
         self.save()
 
+        if self.data_parallel is not None:
+            self.data_parallel.close()
+
+        if self.memory_profiler is not None:
+            report_path = None
+            if self.config.train.should_save and self.date_str is not None:
+                os.makedirs(self.config.model.results_dir, exist_ok=True)
+                report_path = os.path.join(self.config.model.results_dir, f"{self.date_str}_memory.txt")
+            self.memory_profiler.report_leaks(report_path)
+            self.memory_profiler.close()
+
+        if self.metrics is not None:
+            self.metrics.close()
+            # Whatever reads the logs after the run sees every point
+            self.logger.experiment.flush()
+
         if not self.collector is None:
             self.collector.shutdown()
 
@@ -215,8 +464,8 @@ class SCTrain():
         if not self.config.train.should_save:
             return
 
-        if self.models.actor is None or self.models.critic is None or self.models.optimizer is None \
-                or self.stats.update_count is None or self.date_str is None \
+        if self.models is None or self.models.actor is None or self.models.critic is None \
+                or self.models.optimizer is None or self.stats.update_count is None or self.date_str is None \
                 or self.stats.step_times is None:
             return
 
@@ -235,8 +484,9 @@ class SCTrain():
             },
             "stats": {
                 "update_count": self.stats.update_count.item(),
-                "step_times": self.stats.step_times,
-                "game_speed": self.config.env.game_speed,
+                "scaled_step_times": self.stats.step_times,
+                "game_speed": self.get_game_speed(),
+                "architecture": get_architecture(self.config.model),
             },
         }
         torch.save(checkpoint, os.path.join(results_dir, f"{self.date_str}_checkpoint.pth"))
@@ -1,35 +1,53 @@
 import sys
 import asyncio
+import importlib
 import traceback
-import subprocess
-import time
-import os
 from enum import Enum
-import numpy as np
 import gymnasium as gym
 from sc_config import get_config
-from SCEnv import SCEnv, create_torchrl_env
-from SCTrain import SCTrain
-from SCInfer import SCInfer
+from SCEnv import SCEnv, create_env
 from SCTimer import sc_timer
+from SCSupervisor import close_supervisor
+from SCTelemetry import sc_telemetry
+from sc_log import init_log, close_log, log_error
 
 class MODE(Enum):
     PLAY = 1
     TRAIN = 2
     INFER = 3
     FAKE_INFER = 4
+    LEARNER = 5
+    WORKER = 6
+    EVAL = 7
+
+# (module, class) of the modes that run a model. They pull in torch and torchrl, so they are only
+# imported once their mode is picked and PLAY and the tools start without them.
+MODE_CLASSES = {
+    MODE.TRAIN: ("SCTrain", "SCTrain"),
+    MODE.INFER: ("SCInfer", "SCInfer"),
+    MODE.LEARNER: ("SCDistributed", "SCLearner"),
+    MODE.WORKER: ("SCDistributed", "SCRolloutWorker"),
+    MODE.EVAL: ("SCEval", "SCEval"),
+}
+
+def load_mode_class(mode):
+    module_name, class_name = MODE_CLASSES[mode]
+    return getattr(importlib.import_module(module_name), class_name)
 
 class SurfChan():
     env = None
     train = None
     infer = None
+    worker = None
+    eval = None
 
     async def run(self):
         try:
             self.config = get_config()
 
-            if os.path.exists("log.txt"):
-                os.remove("log.txt")
+            init_log(self.config)
+            if self.config.gui.enabled:
+                sc_telemetry.start(self.config.gui)
 
             gym.register(self.config.env.name, lambda: SCEnv())
 
@@ -42,6 +60,12 @@ class SurfChan():
                     self.mode = MODE.INFER
                 elif mode_str.startswith("f"):
                     self.mode = MODE.FAKE_INFER
+                elif mode_str.startswith("l"):
+                    self.mode = MODE.LEARNER
+                elif mode_str.startswith("w"):
+                    self.mode = MODE.WORKER
+                elif mode_str.startswith("e"):
+                    self.mode = MODE.EVAL
 
             if self.mode == MODE.PLAY:
                 await self._create_play()
@@ -51,12 +75,18 @@ class SurfChan():
                 await self._create_infer()
             elif self.mode == MODE.FAKE_INFER:
                 await self._create_fake_infer()
+            elif self.mode == MODE.LEARNER:
+                await self._create_learner()
+            elif self.mode == MODE.WORKER:
+                await self._create_worker()
+            elif self.mode == MODE.EVAL:
+                await self._create_eval()
         except KeyboardInterrupt:
             pass
         except asyncio.CancelledError:
             pass
         except Exception:
-            traceback.print_exc()
+            log_error("%s", traceback.format_exc())
         finally:
             sc_timer.print()
 
@@ -65,8 +95,15 @@ class SurfChan():
                 self.train.close()
             if self.infer is not None:
                 self.infer.close()
+            if self.worker is not None:
+                self.worker.close()
+            if self.eval is not None:
+                self.eval.close()
             if self.env is not None:
                 self.env.close()
+            sc_telemetry.close()
+            close_supervisor()
+            close_log()
             
             tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
             if tasks:
@@ -75,28 +112,43 @@ class SurfChan():
     
     async def _create_play(self):
         print("Mode: Play")
-        self.env = create_torchrl_env(self, self.config.infer.map, base_only=True, should_run_ai=False)
+        self.env = create_env(self, self.config.infer.map, should_run_ai=False)
         while not self.env.is_closed:
             await asyncio.sleep(0.2)
-            obs, reward, terminated, truncated, _ = self.env.env.step(self.env.env._fake_action())
+            obs, reward, terminated, truncated, _ = self.env.step(self.env._fake_action())
     
     async def _create_train(self):
         print("Mode: Train")
-        self.train = SCTrain(self)
+        self.train = load_mode_class(MODE.TRAIN)(self)
         await self.train.train()
     
     async def _create_infer(self):
         print("Mode: Infer")
-        self.infer = SCInfer(self)
+        self.infer = load_mode_class(MODE.INFER)(self)
         await self.infer.infer()
     
+    async def _create_learner(self):
+        print("Mode: Learner")
+        self.train = load_mode_class(MODE.LEARNER)(self)
+        await self.train.train()
+    
+    async def _create_worker(self):
+        print("Mode: Worker")
+        self.worker = load_mode_class(MODE.WORKER)(self)
+        await self.worker.run()
+    
+    async def _create_eval(self):
+        print("Mode: Eval")
+        self.eval = load_mode_class(MODE.EVAL)(self)
+        await self.eval.run()
+    
     async def _create_fake_infer(self):
         print("Mode: Fake Infer")
-        self.env = create_torchrl_env(self, self.config.infer.map, True)
+        self.env = create_env(self, self.config.infer.map)
 
-        action = self.env.env._fake_action()
-        action[self.env.env.button_count] = 0.7 # look right
-        action[self.env.env.button_count + 1] = 0.5 # vertical center
+        action = self.env._fake_action()
+        action[self.env.button_count] = 0.7 # look right
+        action[self.env.button_count + 1] = 0.5 # vertical center
         i = 0
         while not self.env.is_closed:
             i += 1
@@ -108,7 +160,7 @@ class SurfChan():
                 action[0] = 0.0
                 action[1] = 1.0
             
-            self.env.env.step(action)
+            self.env.step(action)
             await asyncio.sleep(0.034) # 30 fps
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+ASSETS_DIR_PATH = "assets"
+MANIFEST_FILE_NAME = "surfchan_assets.json"
+_HASH_CHUNK_SIZE = 1 << 20
+_MAX_WORKERS = 8
+
+def get_game_asset_targets(config, assets_dir_path=ASSETS_DIR_PATH):
+    """Returns {destination cstrike dir: [(asset path, path relative to the cstrike dir)]}."""
+    maps_dir_path = os.path.join(assets_dir_path, "maps")
+    maps = [(os.path.join(maps_dir_path, map_file_name), os.path.join("maps", map_file_name))
+        for map_file_name in sorted(os.listdir(maps_dir_path))]
+
+    server_assets = [
+        (os.path.join(assets_dir_path, "mapcycle.txt"), os.path.join("cfg", "mapcycle.txt")),
+        (os.path.join(assets_dir_path, "server.cfg"), os.path.join("cfg", "server.cfg")),
+        (os.path.join(assets_dir_path, "autoexec_server.cfg"), os.path.join("cfg", "autoexec.cfg")),
+    ]
+    css_assets = [
+        (os.path.join(assets_dir_path, "autoexec_css.cfg"), os.path.join("cfg", "autoexec.cfg")),
+    ]
+
+    return {
+        os.path.join("css_server", "server", "cstrike"): server_assets + maps,
+        os.path.join(config.css.path, "cstrike"): css_assets + maps,
+    }
+
+def get_map_file_paths(config, map_full_name):
+    """Paths of the map's .bsp in every cstrike dir it's loaded from."""
+    return [os.path.join(cstrike_dir_path, "maps", f"{map_full_name}.bsp") for cstrike_dir_path in get_game_asset_targets(config)]
+
+def prefetch_files(paths):
+    """Reads the files once, so they're in the OS file cache for the next open. Returns the bytes read."""
+    total_bytes = 0
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+
+        with open(path, "rb") as file:
+            while chunk := file.read(_HASH_CHUNK_SIZE):
+                total_bytes += len(chunk)
+
+    return total_bytes
+
+def hash_file(path):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while chunk := file.read(_HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+def _get_stat_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+
+    try:
+        with open(manifest_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _install_file(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    # Hardlink when on the same drive, replace atomically so a running game never sees half a file
+    tmp_dst = f"{dst}.surfchan_tmp"
+    if os.path.exists(tmp_dst):
+        os.remove(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+        is_linked = True
+    except OSError:
+        shutil.copy2(src, tmp_dst)
+        is_linked = False
+    os.replace(tmp_dst, dst)
+
+    return is_linked
+
+def sync_assets(targets, max_workers=_MAX_WORKERS):
+    """Copies assets whose content changed since the last sync. Returns a dict with sync stats.
+
+    Every destination dir keeps a manifest with the hash of each installed asset and the size and
+    mtime it had after installing. Sources are only hashed once per sync, even when used by several
+    destinations.
+    """
+    start_time = perf_counter()
+    stats = {"checked": 0, "copied": 0, "linked": 0, "skipped": 0}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        src_paths = sorted({src for assets in targets.values() for src, _ in assets})
+        src_hashes = dict(zip(src_paths, executor.map(hash_file, src_paths)))
+
+        for dst_dir_path, assets in targets.items():
+            if not os.path.isdir(dst_dir_path):
+                print(f"Asset destination {dst_dir_path} does not exist, skipping")
+                continue
+
+            manifest_path = os.path.join(dst_dir_path, MANIFEST_FILE_NAME)
+            manifest = _load_manifest(manifest_path)
+
+            to_install = []
+            for src, rel_dst in assets:
+                stats["checked"] += 1
+                dst = os.path.join(dst_dir_path, rel_dst)
+                entry = manifest.get(rel_dst)
+
+                # The stat check catches destinations that were changed or removed by something else
+                if entry is not None and entry["hash"] == src_hashes[src] and os.path.exists(dst) \
+                        and _get_stat_key(dst) == entry["stat"]:
+                    stats["skipped"] += 1
+                    continue
+
+                to_install.append((src, rel_dst, dst))
+
+            results = executor.map(lambda asset: _install_file(asset[0], asset[2]), to_install)
+            for (src, rel_dst, dst), is_linked in zip(to_install, results):
+                stats["linked" if is_linked else "copied"] += 1
+                manifest[rel_dst] = {"hash": src_hashes[src], "stat": _get_stat_key(dst)}
+
+            with open(manifest_path, "w") as file:
+                json.dump(manifest, file, indent=1)
+
+    stats["time"] = perf_counter() - start_time
+    return stats
+
+def sync_game_assets(config):
+    stats = sync_assets(get_game_asset_targets(config))
+    print(f"Synced assets: {stats['copied']} copied, {stats['linked']} linked, {stats['skipped']} unchanged " \
+        f"({stats['time']:.2f}s)")
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        src_dir_path = os.path.join(tmp_dir_path, "assets")
+        dst_dir_path = os.path.join(tmp_dir_path, "cstrike")
+        os.makedirs(src_dir_path)
+        os.makedirs(dst_dir_path)
+
+        for name in ["a.cfg", "b.bsp"]:
+            with open(os.path.join(src_dir_path, name), "w") as file:
+                file.write(name)
+        targets = {dst_dir_path: [(os.path.join(src_dir_path, name), os.path.join("cfg", name)) for name in ["a.cfg", "b.bsp"]]}
+
+        print(f"first: {sync_assets(targets)}")
+        print(f"unchanged: {sync_assets(targets)}")
+
+        # Replace instead of writing in place, a hardlinked destination would change with it
+        os.remove(os.path.join(src_dir_path, "b.bsp"))
+        with open(os.path.join(src_dir_path, "b.bsp"), "w") as file:
+            file.write("changed")
+        print(f"changed: {sync_assets(targets)}")
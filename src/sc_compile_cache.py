@@ -0,0 +1,66 @@
+import os
+import json
+import hashlib
+import platform
+import torch
+import torch._inductor.config
+import torch._functorch.config
+from torch._dynamo.utils import counters
+
+# (counter group, counter prefix) of the caches a compile can hit
+_CACHES = [("inductor", "fxgraph_cache"), ("aot_autograd", "autograd_cache")]
+
+def get_compile_cache_key(model_conf, device, compile_mode, shapes):
+    """Hash of everything the compiled graphs depend on. A run with the same key can reuse the graphs
+    of an earlier one."""
+    if device.type == "cuda":
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = platform.processor() or platform.machine()
+
+    # Sorted JSON, since str of a config shows the addresses of configs in lists, like preprocess ops
+    model_str = json.dumps(model_conf.to_dict(), sort_keys=True)
+    key_str = "\n".join([model_str, device_name, compile_mode, torch.__version__, str(shapes)])
+    return hashlib.sha1(key_str.encode()).hexdigest()[:16]
+
+def init_compile_cache(cache_dir):
+    """Points inductor's on-disk caches (FX graphs, AOT autograd, kernels) at cache_dir. Has to run
+    before the first compile."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    torch._functorch.config.enable_autograd_cache = True
+
+def get_cache_counts():
+    """Returns (hits, misses) of the compile caches so far."""
+    hits = sum(counters[group][f"{prefix}_hit"] for group, prefix in _CACHES)
+    misses = sum(counters[group][f"{prefix}_miss"] for group, prefix in _CACHES)
+    return hits, misses
+
+def get_cache_hit_rate(start_counts, end_counts):
+    hits = end_counts[0] - start_counts[0]
+    misses = end_counts[1] - start_counts[1]
+    return hits / (hits + misses) if hits + misses > 0 else 0.0
+
+if __name__ == "__main__":
+    import sys
+    import shutil
+    import tempfile
+    from time import perf_counter
+
+    # Compiles the same function in two fresh processes. The second should hit the cache.
+    if len(sys.argv) > 1:
+        init_compile_cache(sys.argv[1])
+        fn = torch.compile(lambda x: torch.nn.functional.gelu(x @ x.T).sum(-1))
+        start_counts = get_cache_counts()
+        start_time = perf_counter()
+        fn(torch.rand((64, 64)))
+        print(f"Compile: {perf_counter() - start_time:.2f}s, " \
+            f"cache hit rate: {get_cache_hit_rate(start_counts, get_cache_counts()) * 100:.0f}%")
+    else:
+        import subprocess
+
+        cache_dir = tempfile.mkdtemp()
+        for _ in range(2):
+            subprocess.run([sys.executable, __file__, cache_dir], check=True)
+        shutil.rmtree(cache_dir)
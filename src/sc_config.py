@@ -1,7 +1,10 @@
+import os
 import yaml
 
 CONFIG_FILE_NAME = "config.yml"
 CONFIG_USER_FILE_NAME = "config_user.yml"
+# Path of a yml merged over both config files, so a run can be started with changed values
+CONFIG_OVERRIDES_ENV = "SC_CONFIG_OVERRIDES"
 
 _config = None
 
@@ -17,6 +20,9 @@ class _Config:
     
     def __getitem__(self, key):
         return getattr(self, key)
+
+    def to_dict(self):
+        return {key: _to_plain(val) for key, val in self.__dict__.items() if key != "_depth"}
     
     def __str__(self):
         str = "\n"
@@ -38,10 +44,35 @@ def get_config():
             config_user_dict = yaml.safe_load(file)
         
         config_dict = _merge_dicts(config_dict, config_user_dict)
+
+        overrides_path = os.environ.get(CONFIG_OVERRIDES_ENV)
+        if overrides_path:
+            with open(overrides_path, "r") as file:
+                config_dict = _merge_dicts(config_dict, yaml.safe_load(file))
+
         _config = _Config(config_dict)
 
     return _config
 
+def to_overrides_dict(overrides):
+    """Turns {"train.optimizer.lr": 0.001} into the nested dict a config overrides file holds."""
+    overrides_dict = {}
+    for key, val in overrides.items():
+        *parent_keys, last_key = key.split(".")
+        parent_dict = overrides_dict
+        for parent_key in parent_keys:
+            parent_dict = parent_dict.setdefault(parent_key, {})
+        parent_dict[last_key] = val
+
+    return overrides_dict
+
+def _to_plain(val):
+    if isinstance(val, _Config):
+        return val.to_dict()
+    if isinstance(val, list):
+        return [_to_plain(x) for x in val]
+    return val
+
 def _merge_dicts(dict1, dict2):
     for key, val in dict2.items():
         if key in dict1 and isinstance(val, dict) and isinstance(dict1[key], dict):
@@ -0,0 +1,60 @@
+import torch
+from torchrl.modules import TanhNormal, NormalParamExtractor
+
+class SCFactoredParamExtractor(torch.nn.Module):
+    """Splits the policy net output into button logits and the loc and scale of the mouse axes."""
+
+    def __init__(self, button_count):
+        super().__init__()
+        self.button_count = button_count
+        self.normal_extractor = NormalParamExtractor(scale_mapping="biased_softplus_1", scale_lb=0.01)
+
+    def forward(self, params):
+        loc, scale = self.normal_extractor(params[..., self.button_count:])
+        return params[..., :self.button_count], loc, scale
+
+class SCFactoredDistribution(torch.distributions.Distribution):
+    """Independent Bernoulli buttons followed by TanhNormal mouse axes, sampled as one action vector.
+
+    Buttons are 0.0 or 1.0, so the env decodes both heads' actions the same way. The log prob and
+    entropy are sums over both heads. TanhNormal has no closed form entropy, so its part is a one
+    sample estimate.
+    """
+
+    arg_constraints = {}
+    has_rsample = False
+
+    def __init__(self, logits, loc, scale, low=0.0, high=1.0):
+        self.buttons = torch.distributions.Bernoulli(logits=logits, validate_args=False)
+        self.mouse = TanhNormal(loc, scale, low=low, high=high)
+        self.button_count = logits.shape[-1]
+        super().__init__(batch_shape=logits.shape[:-1], event_shape=torch.Size([self.button_count + loc.shape[-1]]),
+            validate_args=False)
+
+    def sample(self, sample_shape=torch.Size()):
+        return torch.cat([self.buttons.sample(sample_shape), self.mouse.sample(sample_shape)], -1)
+
+    def log_prob(self, value):
+        buttons = value[..., :self.button_count]
+        mouse = value[..., self.button_count:]
+        return self.buttons.log_prob(buttons).sum(-1) + self.mouse.log_prob(mouse)
+
+    def entropy(self):
+        return self.buttons.entropy().sum(-1) - self.mouse.log_prob(self.mouse.rsample())
+
+    @property
+    def deterministic_sample(self):
+        buttons = (self.buttons.logits > 0.0).to(self.mouse.loc.dtype)
+        return torch.cat([buttons, self.mouse.deterministic_sample], -1)
+
+if __name__ == "__main__":
+    # Log probs of samples should match what the heads give separately
+    logits = torch.randn((4, 6))
+    loc, scale = torch.randn((4, 2)), torch.rand((4, 2)) + 0.1
+    dist = SCFactoredDistribution(logits, loc, scale)
+    action = dist.sample()
+    separate = torch.distributions.Bernoulli(logits=logits).log_prob(action[..., :6]).sum(-1) \
+        + TanhNormal(loc, scale, low=0.0, high=1.0).log_prob(action[..., 6:])
+    print(f"action: {action[0].tolist()}")
+    print(f"log prob matches: {torch.allclose(dist.log_prob(action), separate)}, entropy: {dist.entropy().tolist()}")
+    print(f"deterministic: {dist.deterministic_sample[0].tolist()}")
@@ -0,0 +1,207 @@
+import sys
+from time import perf_counter
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.flop_counter import FlopCounterMode
+from torchrl.modules import ConvNet
+from sc_config import get_config
+
+ENCODERS = {}
+
+def register_encoder(name):
+    """Registers builder(in_channels, device) under name. The built module maps (N, C, H, W) pixels
+    to (N, features), or takes any batch dims like torchrl's ConvNet."""
+    def decorator(builder):
+        ENCODERS[name] = builder
+        return builder
+    return decorator
+
+class SCBatchedEncoder(torch.nn.Module):
+    """Lets an encoder that expects (N, C, H, W) take pixels with any or no batch dims."""
+
+    def __init__(self, body):
+        super().__init__()
+        self.body = body
+
+    def forward(self, pixels):
+        batch_shape = pixels.shape[:-3]
+        features = self.body(pixels.reshape(-1, *pixels.shape[-3:]))
+        return features.reshape(*batch_shape, -1)
+
+class SCResize(torch.nn.Module):
+    """Area downscale to size, or to (height, width)."""
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = tuple(size) if isinstance(size, (list, tuple)) else (size, size)
+
+    def forward(self, pixels):
+        batch_shape = pixels.shape[:-3]
+        pixels = F.interpolate(pixels.reshape(-1, *pixels.shape[-3:]), size=self.size, mode="area")
+        return pixels.reshape(*batch_shape, *pixels.shape[-3:])
+
+class SCResidualBlock(torch.nn.Module):
+    def __init__(self, channels, device=None):
+        super().__init__()
+        self.conv0 = torch.nn.Conv2d(channels, channels, 3, padding=1, device=device)
+        self.conv1 = torch.nn.Conv2d(channels, channels, 3, padding=1, device=device)
+
+    def forward(self, x):
+        return x + self.conv1(F.relu(self.conv0(F.relu(x))))
+
+@register_encoder("nature")
+def create_nature_encoder(in_channels, device):
+    # Nature DQN. Big first kernel, few channels.
+    return ConvNet(
+        activation_class=torch.nn.ReLU,
+        num_cells=[32, 64, 64],
+        kernel_sizes=[8, 4, 3],
+        strides=[4, 2, 1],
+        device=device,
+    )
+
+@register_encoder("impala")
+def create_impala_encoder(in_channels, device):
+    # IMPALA ResNet. Every stack halves the resolution, so it's meant for a downscaled input_size.
+    layers = []
+    for channels in [16, 32, 32]:
+        layers += [
+            torch.nn.Conv2d(in_channels, channels, 3, padding=1, device=device),
+            torch.nn.MaxPool2d(3, stride=2, padding=1),
+            SCResidualBlock(channels, device),
+            SCResidualBlock(channels, device),
+        ]
+        in_channels = channels
+    layers += [torch.nn.ReLU(), torch.nn.Flatten()]
+
+    return SCBatchedEncoder(torch.nn.Sequential(*layers))
+
+@register_encoder("strided")
+def create_strided_encoder(in_channels, device):
+    # Small non-overlapping first kernel downsamples 4x cheaply, the channels go up after it
+    layers = [torch.nn.Conv2d(in_channels, 32, 4, stride=4, device=device), torch.nn.ReLU()]
+    for in_cells, out_cells in [(32, 64), (64, 128), (128, 128)]:
+        layers += [torch.nn.Conv2d(in_cells, out_cells, 3, stride=2, padding=1, device=device), torch.nn.ReLU()]
+    layers.append(torch.nn.Flatten())
+
+    return SCBatchedEncoder(torch.nn.Sequential(*layers))
+
+@register_encoder("depthwise")
+def create_depthwise_encoder(in_channels, device):
+    # strided with depthwise separable convs after the stem, for fewer FLOPs at the same shape
+    layers = [torch.nn.Conv2d(in_channels, 32, 4, stride=4, device=device), torch.nn.ReLU()]
+    for in_cells, out_cells in [(32, 64), (64, 128), (128, 128)]:
+        layers += [
+            torch.nn.Conv2d(in_cells, in_cells, 3, stride=2, padding=1, groups=in_cells, device=device),
+            torch.nn.Conv2d(in_cells, out_cells, 1, device=device),
+            torch.nn.ReLU(),
+        ]
+    layers.append(torch.nn.Flatten())
+
+    return SCBatchedEncoder(torch.nn.Sequential(*layers))
+
+def create_encoder(name, input_shape, input_size=None, device=None):
+    """Returns the encoder registered as name for (C, H, W) input_shape pixels.
+
+    Pixels are downscaled to input_size first, if it's smaller than the input.
+    """
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder {name}, available: {', '.join(ENCODERS)}")
+
+    encoder = ENCODERS[name](input_shape[0], device)
+    if input_size is not None and input_size < input_shape[-1]:
+        encoder = torch.nn.Sequential(SCResize(input_size), encoder)
+
+    return encoder
+
+def _get_activation_bytes(encoder, pixels):
+    # Outputs of leaf modules are roughly what autograd keeps around for the backward pass
+    total_bytes = 0
+    def count_output(module, inputs, output):
+        nonlocal total_bytes
+        total_bytes += output.numel() * output.element_size()
+
+    handles = [module.register_forward_hook(count_output) for module in encoder.modules()
+        if len(list(module.children())) == 0]
+    with torch.no_grad():
+        encoder(pixels)
+    for handle in handles:
+        handle.remove()
+
+    return total_bytes
+
+def _time(fn, device, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(perf_counter() - start_time)
+
+    return float(np.median(times))
+
+def profile_encoder(name, input_shape, input_size=None, batch_size=1, device=torch.device("cpu"), repeats=20):
+    encoder = create_encoder(name, input_shape, input_size, device)
+    pixels = torch.rand((batch_size, *input_shape), device=device)
+
+    with FlopCounterMode(display=False) as flop_counter:
+        with torch.no_grad():
+            features = encoder(pixels)
+
+    def forward():
+        with torch.no_grad():
+            encoder(pixels)
+
+    def forward_backward():
+        encoder(pixels).sum().backward()
+
+    forward()
+    forward_backward()
+    forward_time = _time(forward, device, repeats)
+    backward_time = max(_time(forward_backward, device, repeats) - forward_time, 0.0)
+
+    return {
+        "name": name,
+        "params": sum(param.numel() for param in encoder.parameters()),
+        "features": features.shape[-1],
+        "flops": flop_counter.get_total_flops() / batch_size,
+        "forward_ms": forward_time * 1000,
+        "backward_ms": backward_time * 1000,
+        "activation_mb": _get_activation_bytes(encoder, pixels) / batch_size / 2**20,
+    }
+
+def select_encoder(profiles, latency_budget_ms):
+    """Returns the profile with the most FLOPs whose forward pass fits the budget, or None."""
+    fitting = [profile for profile in profiles if profile["forward_ms"] <= latency_budget_ms]
+    if not fitting:
+        return None
+
+    return max(fitting, key=lambda profile: profile["flops"])
+
+if __name__ == "__main__":
+    config = get_config()
+    encoder_conf = config.model.encoder
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+
+    img_size = config.model.img_size
+    input_shape = (3, img_size, img_size)
+    print(f"Profiling encoders on {device}, input {img_size}px -> {encoder_conf.input_size or img_size}px, " \
+        f"batch size {batch_size}")
+
+    profiles = [profile_encoder(name, input_shape, encoder_conf.input_size, batch_size, device) for name in ENCODERS]
+    for profile in profiles:
+        # The features are fed into an MLP of model.encoder.features, which often holds most params
+        head_params = profile["features"] * encoder_conf.features
+        print(f"{profile['name']}: params={profile['params'] / 1e6:.2f}M (+{head_params / 1e6:.2f}M head), " \
+            f"features={profile['features']}, GFLOPs={profile['flops'] / 1e9:.3f}, " \
+            f"forward={profile['forward_ms']:.2f}ms, backward={profile['backward_ms']:.2f}ms, " \
+            f"activations={profile['activation_mb']:.1f}MB")
+
+    selected = select_encoder(profiles, encoder_conf.latency_budget_ms)
+    if selected is None:
+        print(f"No encoder fits the {encoder_conf.latency_budget_ms}ms budget, lower model.encoder.input_size")
+    else:
+        print(f"Largest encoder within {encoder_conf.latency_budget_ms}ms: {selected['name']}")
@@ -0,0 +1,152 @@
+import json
+import threading
+from collections import deque
+from enum import IntEnum
+from time import time
+import numpy as np
+
+_DEFAULT_BUFFER_SIZE = 100000
+
+class LOG_LEVEL(IntEnum):
+    TRACE = 0
+    DEBUG = 1
+    ERROR = 2
+
+# Records are (time, level, message, args). Formatting happens on the writer thread.
+_records = deque(maxlen=_DEFAULT_BUFFER_SIZE)
+# Plain ints, comparing IntEnums is several times slower and the checks run on every call
+_level = int(LOG_LEVEL.DEBUG)
+_TRACE = int(LOG_LEVEL.TRACE)
+_DEBUG = int(LOG_LEVEL.DEBUG)
+_ERROR = int(LOG_LEVEL.ERROR)
+_console_level = _DEBUG
+_dropped = 0
+
+_log_path = None
+_flush_interval = 0.5
+_writer_thread = None
+_stop_event = threading.Event()
+_write_lock = threading.Lock()
+
+def is_log_enabled(level):
+    return level >= _level
+
+def _append(level, message, args):
+    global _dropped
+
+    if len(_records) == _records.maxlen:
+        _dropped += 1
+    _records.append((time(), level, message, args))
+
+def log(level, message, *args):
+    """Formats message % args later on the writer thread. Below the configured level this returns
+    before anything is formatted, so args should be cheap to pass."""
+    if level >= _level:
+        _append(level, message, args)
+
+def log_trace(message, *args):
+    if _level <= _TRACE:
+        _append(_TRACE, message, args)
+
+def log_debug(message, *args):
+    if _level <= _DEBUG:
+        _append(_DEBUG, message, args)
+
+def log_error(message, *args):
+    if _level <= _ERROR:
+        _append(_ERROR, message, args)
+
+def log_record(level, kind, **fields):
+    """Structured record, written as kind followed by the fields as JSON."""
+    if level >= _level:
+        _append(level, kind, fields)
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def _format_record(record):
+    record_time, level, message, args = record
+    level = LOG_LEVEL(level)
+    if isinstance(args, dict):
+        message = f"{message} {json.dumps(args, default=_to_json)}"
+    elif args:
+        message = message % args
+
+    return level, f"{record_time:.3f} {level.name} {message}"
+
+def flush_log():
+    """Writes all buffered records. Called by the writer thread, and on close so a crash leaves
+    the last records of the run in the log."""
+    global _dropped
+
+    with _write_lock:
+        lines = []
+        while _records:
+            level, line = _format_record(_records.popleft())
+            if level >= _console_level:
+                print(line.split(" ", 2)[2])
+            lines.append(line)
+
+        if _dropped:
+            lines.append(f"{time():.3f} ERROR {_dropped} log records dropped, the writer fell behind")
+            _dropped = 0
+
+        if lines and _log_path is not None:
+            with open(_log_path, "a") as file:
+                file.write("\n".join(lines) + "\n")
+
+def _write_loop():
+    while not _stop_event.wait(_flush_interval):
+        flush_log()
+
+def init_log(config):
+    global _records, _level, _console_level, _log_path, _flush_interval, _writer_thread
+
+    log_conf = config.logging
+    _level = int(config.log)
+    _console_level = int(log_conf.console_level)
+    _log_path = log_conf.path
+    _flush_interval = log_conf.flush_interval
+    _records = deque(_records, maxlen=log_conf.buffer_size)
+
+    # Every run starts with a new log
+    open(_log_path, "w").close()
+
+    _stop_event.clear()
+    _writer_thread = threading.Thread(target=_write_loop, daemon=True)
+    _writer_thread.start()
+
+def close_log():
+    global _writer_thread
+
+    if _writer_thread is not None:
+        _stop_event.set()
+        _writer_thread.join()
+        _writer_thread = None
+
+    flush_log()
+
+if __name__ == "__main__":
+    from time import perf_counter
+
+    _level = _DEBUG
+    count = 100000
+    start_time = perf_counter()
+    for i in range(count):
+        log_trace("step %d", i)
+    print(f"Filtered trace: {(perf_counter() - start_time) / count * 1e9:.0f}ns per call")
+
+    _level = _TRACE
+    _console_level = _ERROR
+    start_time = perf_counter()
+    for i in range(count):
+        log_record(LOG_LEVEL.TRACE, "step", step=i, pos=np.array([1.0, 2.0, 3.0]))
+    print(f"Buffered trace: {(perf_counter() - start_time) / count * 1e9:.0f}ns per call")
+
+    start_time = perf_counter()
+    flush_log()
+    print(f"Formatting {count} records: {perf_counter() - start_time:.2f}s")
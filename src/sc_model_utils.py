@@ -2,32 +2,44 @@ import os
 from datetime import datetime
 from sc_config import get_config
 import torch
-from tensordict.nn import TensorDictModule
+from tensordict.nn import TensorDictModule, TensorDictSequential
 from torchrl.data.tensor_specs import Bounded, Composite
+from torchrl.envs import InitTracker
 from torchrl.envs.utils import ExplorationType
 from torchrl.objectives import ClipPPOLoss
 from torchrl.modules import (
     ProbabilisticActor,
     TanhNormal,
     ValueOperator,
-    ConvNet,
     MLP,
     ActorValueOperator,
+    GRUModule,
     NormalParamExtractor
 )
-from sc_utils import write_to_log
+from sc_log import log_trace
+from sc_encoders import create_encoder
+from sc_distributions import SCFactoredParamExtractor, SCFactoredDistribution
 
 class SCModels():
     actor=None
     critic=None
     loss_module=None
     optimizer=None
+    common=None
+    primer=None
 
-    def __init__(self, actor=None, critic=None, loss_module=None, optimizer=None):
+    def __init__(self, actor=None, critic=None, loss_module=None, optimizer=None, common=None, primer=None):
         self.actor = actor
         self.critic = critic
         self.loss_module = loss_module
         self.optimizer = optimizer
+        # Encoder (and GRU) shared by actor and critic
+        self.common = common
+        # Env transform that adds the recurrent state to its tensordicts, None for feed-forward models
+        self.primer = primer
+
+    def is_recurrent(self):
+        return self.primer is not None
 
 class SCStats():
     update_count=None
@@ -39,8 +51,6 @@ class SCStats():
         self.step_times = step_times
         self.game_speed = game_speed
 
-config = get_config()
-
 torch_device = None
 def get_torch_device():
     global torch_device
@@ -50,15 +60,15 @@ def get_torch_device():
     
     return torch_device
 
-def get_models(env, device):
-    global config
+def get_models(observation_spec, action_spec, device):
+    config = get_config()
     models, stats = None, None
     if config.train.should_resume:
-        models, stats = load_latest_models(env, device)
+        models, stats = load_latest_models(observation_spec, action_spec, device)
 
     if models is None:
         print(f"Created new models")
-        models = create_models(env, device)
+        models = create_models(observation_spec, action_spec, device)
 
         stats = SCStats()
         stats.update_count = torch.zeros((), dtype=torch.int64, device=device)
@@ -67,47 +77,77 @@ def get_models(env, device):
 
     return models, stats
 
-def load_latest_models(env, device):
-    global config
-    results_dir = config.model.results_dir
+def get_checkpoint_paths(results_dir):
     if not os.path.exists(results_dir):
-        return None, None
-    
+        return []
+
     result_paths = [os.path.join(results_dir, p) for p in os.listdir(results_dir)]
-    checkpoint_paths = [p for p in result_paths if p.endswith('checkpoint.pth')]
+    return [p for p in result_paths if p.endswith('checkpoint.pth')]
+
+def load_latest_models(observation_spec, action_spec, device):
+    config = get_config()
+    checkpoint_paths = get_checkpoint_paths(config.model.results_dir)
     if len(checkpoint_paths) == 0:
         return None, None
     
     checkpoint_path = max(checkpoint_paths, key=os.path.getctime)
+    models, stats = load_models(checkpoint_path, observation_spec, action_spec, device)
+
+    models_date = datetime.fromtimestamp(os.path.getctime(checkpoint_path)).strftime("%d-%m-%y %H:%M:%S")
+    print(f"Loaded models from {models_date} (update count: {stats.update_count.item()})")
+
+    return models, stats
+
+def get_architecture(model_conf):
+    """The model options a checkpoint's weights only fit with, saved with it and compared on load."""
+    model_dict = model_conf.to_dict()
+    recurrent = model_dict["recurrent"]
+    return {
+        "action_head": model_dict["action_head"],
+        "preprocess": model_dict["preprocess"],
+        "encoder": {key: model_dict["encoder"][key] for key in ("name", "input_size", "features")},
+        "recurrent": {key: recurrent[key] for key in ("enabled", "hidden_size")} if recurrent["enabled"] else {"enabled": False},
+    }
+
+def check_architecture(checkpoint_path, checkpoint):
+    # Checkpoints from before model.action_head have the continuous one and nothing else is known of older ones
+    architecture = checkpoint["stats"].get("architecture",
+        {"action_head": checkpoint["stats"].get("action_head", "continuous")})
+    current_architecture = get_architecture(get_config().model)
+    for key, value in architecture.items():
+        if value != current_architecture[key]:
+            raise ValueError(f"{checkpoint_path} was trained with model.{key}: {value}, the config has " \
+                f"{current_architecture[key]}. Set it or move the checkpoint out of model.results_dir")
+
+def load_models(checkpoint_path, observation_spec, action_spec, device):
     checkpoint = torch.load(checkpoint_path, map_location=device)
+    check_architecture(checkpoint_path, checkpoint)
 
-    models = create_models(env, device)
+    models = create_models(observation_spec, action_spec, device)
     models.actor.load_state_dict(checkpoint["models"]["actor"])
     models.critic.load_state_dict(checkpoint["models"]["critic"])
     models.optimizer.load_state_dict(checkpoint["models"]["optimizer"])
 
     stats = SCStats()
     stats.update_count = torch.tensor(checkpoint["stats"]["update_count"], dtype=torch.int64, device=device)
-    stats.step_times = checkpoint["stats"]["step_times"]
+    # Step times multiplied by the game speed they ran at. Older checkpoints ran all batches at game_speed.
+    if "scaled_step_times" in checkpoint["stats"]:
+        stats.step_times = checkpoint["stats"]["scaled_step_times"]
+    else:
+        stats.step_times = [step_time * checkpoint["stats"]["game_speed"] for step_time in checkpoint["stats"]["step_times"]]
     stats.game_speed = checkpoint["stats"]["game_speed"]
 
-    models_date = datetime.fromtimestamp(os.path.getctime(checkpoint_path)).strftime("%d-%m-%y %H:%M:%S")
-    print(f"Loaded models from {models_date} (update count: {stats.update_count.item()})")
-
     return models, stats
 
-def create_models(env, device):
-    global config
-    input_shape = env.observation_spec["pixels"].shape
-    num_outputs = env.action_spec.shape[0]
+def create_models(observation_spec, action_spec, device):
+    from SCEnv import SCEnv
 
-    common_cnn = ConvNet(
-        activation_class=torch.nn.ReLU,
-        num_cells=[32, 64, 64],
-        kernel_sizes=[8, 4, 3],
-        strides=[4, 2, 1],
-        device=device,
-    )
+    config = get_config()
+    input_shape = observation_spec["pixels"].shape
+    num_outputs = action_spec.shape[0]
+
+    encoder_conf = config.model.encoder
+    common_cnn = create_encoder(encoder_conf.name, input_shape, encoder_conf.input_size, device)
 
     # TODO: Remove
     # class DebugCNNWrapper(torch.nn.Module):
@@ -116,7 +156,7 @@ def create_models(env, device):
     #         self.cnn = cnn
 
     #     def forward(self, x):
-    #         write_to_log(f"{x[0][0][0]}{x[1][0][0]}{x[2][0][0]}")
+    #         log_trace("%s%s%s", x[0][0][0], x[1][0][0], x[2][0][0])
     #         return self.cnn(x)
     # common_cnn = DebugCNNWrapper(common_cnn)
 
@@ -125,46 +165,93 @@ def create_models(env, device):
         in_features=common_cnn_output.shape[-1],
         activation_class=torch.nn.ReLU,
         activate_last_layer=True,
-        out_features=512,
+        out_features=encoder_conf.features,
         num_cells=[],
         device=device,
     )
     common_mlp_output = common_mlp(common_cnn_output)
 
-    common_module = TensorDictModule(
-        module=torch.nn.Sequential(common_cnn, common_mlp),
-        in_keys=["pixels"],
-        out_keys=["common_features"],
-    )
-
-    policy_net = MLP(
-        in_features=common_mlp_output.shape[-1],
-        out_features=num_outputs * 2,
-        activation_class=torch.nn.ReLU,
-        num_cells=[],
-        device=device,
-    )
-
-    policy_module = TensorDictModule(
-        module=policy_net,
-        in_keys=["common_features"],
-        out_keys=["policy_params"],
-    )
-
-    policy_module = TensorDictModule(
-        module=torch.nn.Sequential(
-            policy_module,
-            NormalParamExtractor(scale_mapping="biased_softplus_1", scale_lb=0.01)
-        ),
-        in_keys=["common_features"],
-        out_keys=["loc", "scale"],
-    )
+    features_size = common_mlp_output.shape[-1]
+    primer = None
+    recurrent_conf = config.model.recurrent
+    if recurrent_conf.enabled:
+        # The GRU replaces frame stacking. Its hidden state travels with the env's tensordicts.
+        gru_module = GRUModule(
+            input_size=features_size,
+            hidden_size=recurrent_conf.hidden_size,
+            in_keys=["embed", "recurrent_state", "is_init"],
+            out_keys=["common_features", ("next", "recurrent_state")],
+            device=device,
+        )
+        primer = gru_module.make_tensordict_primer()
+        features_size = recurrent_conf.hidden_size
+
+        common_module = TensorDictSequential(
+            TensorDictModule(
+                module=torch.nn.Sequential(common_cnn, common_mlp),
+                in_keys=["pixels"],
+                out_keys=["embed"],
+            ),
+            gru_module,
+        )
+    else:
+        common_module = TensorDictModule(
+            module=torch.nn.Sequential(common_cnn, common_mlp),
+            in_keys=["pixels"],
+            out_keys=["common_features"],
+        )
+
+    action_head = config.model.action_head
+    if action_head == "factored":
+        # Buttons are on or off, only the mouse axes are continuous
+        button_count = SCEnv.button_count
+        policy_net = MLP(
+            in_features=features_size,
+            out_features=button_count + (num_outputs - button_count) * 2,
+            activation_class=torch.nn.ReLU,
+            num_cells=[],
+            device=device,
+        )
+        policy_module = TensorDictModule(
+            module=torch.nn.Sequential(policy_net, SCFactoredParamExtractor(button_count)),
+            in_keys=["common_features"],
+            out_keys=["button_logits", "loc", "scale"],
+        )
+        dist_in_keys = {"logits": "button_logits", "loc": "loc", "scale": "scale"}
+        distribution_class = SCFactoredDistribution
+    elif action_head == "continuous":
+        policy_net = MLP(
+            in_features=features_size,
+            out_features=num_outputs * 2,
+            activation_class=torch.nn.ReLU,
+            num_cells=[],
+            device=device,
+        )
+
+        policy_module = TensorDictModule(
+            module=policy_net,
+            in_keys=["common_features"],
+            out_keys=["policy_params"],
+        )
+
+        policy_module = TensorDictModule(
+            module=torch.nn.Sequential(
+                policy_module,
+                NormalParamExtractor(scale_mapping="biased_softplus_1", scale_lb=0.01)
+            ),
+            in_keys=["common_features"],
+            out_keys=["loc", "scale"],
+        )
+        dist_in_keys = ["loc", "scale"]
+        distribution_class = TanhNormal
+    else:
+        raise ValueError(f"Unknown action head {action_head}, use factored or continuous")
 
     policy_module = ProbabilisticActor(
         policy_module,
-        in_keys=["loc", "scale"],
-        spec=env.action_spec.to(device),
-        distribution_class=TanhNormal,
+        in_keys=dist_in_keys,
+        spec=action_spec.to(device),
+        distribution_class=distribution_class,
         distribution_kwargs={
             "low": 0.0,
             "high": 1.0,
@@ -175,7 +262,7 @@ def create_models(env, device):
 
     value_net = MLP(
         activation_class=torch.nn.ReLU,
-        in_features=common_mlp_output.shape[-1],
+        in_features=features_size,
         out_features=1,
         num_cells=[],
         device=device,
@@ -192,7 +279,9 @@ def create_models(env, device):
     )
 
     with torch.no_grad():
-        td = env.fake_tensordict().expand(10)
+        td = observation_spec.to(device).zero((10,))
+        if primer is not None:
+            td["is_init"] = torch.ones((10, 1), dtype=torch.bool, device=device)
         actor_critic(td)
         del td
 
@@ -216,4 +305,42 @@ def create_models(env, device):
         eps=config.train.optimizer.epsilon,
     )
 
-    return SCModels(actor, critic, loss_module, optimizer)
+    return SCModels(actor, critic, loss_module, optimizer, common_module, primer)
+
+def add_model_transforms(env, models):
+    """Adds the env transforms a recurrent model needs to carry its hidden state through steps."""
+    if not models.is_recurrent():
+        return
+
+    # is_init marks resets, where the hidden state starts over
+    env.append_transform(InitTracker())
+    env.append_transform(models.primer.clone())
+
+def create_fake_observation(models, observation_spec, batch_size, device):
+    """Random observations with whatever the model reads besides the spec, for runs without a game."""
+    td = observation_spec.rand((batch_size,))
+    if models.is_recurrent():
+        td["is_init"] = torch.zeros((batch_size, 1), dtype=torch.bool, device=device)
+        td.update(models.primer.primers.zero((batch_size,)).to(device))
+
+    return td
+
+def create_fake_rollout(models, observation_spec, frames, device):
+    # One trajectory, like a single env collects it
+    data = create_fake_observation(models, observation_spec, frames, device)
+    if models.is_recurrent():
+        data["is_init"][0] = True
+
+    done = torch.zeros((frames, 1), dtype=torch.bool, device=device)
+    done[-1] = True
+    data["next"] = create_fake_observation(models, observation_spec, frames, device).update({
+        "reward": torch.rand((frames, 1), device=device),
+        "done": done,
+        "terminated": done.clone(),
+        "truncated": torch.zeros_like(done),
+        "episode_reward": torch.rand((frames, 1), device=device),
+    })
+    with torch.no_grad():
+        models.actor(data)
+
+    return data
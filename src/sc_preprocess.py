@@ -0,0 +1,176 @@
+import sys
+import torch
+from torchrl.envs.transforms import ObservationTransform
+from torchrl.envs.transforms.transforms import _apply_to_composite, _set_missing_tolerance
+from sc_config import get_config
+from sc_encoders import SCResize
+
+PREPROCESS_OPS = {}
+
+# ITU-R BT.601 luma
+_GRAYSCALE_WEIGHTS = [0.299, 0.587, 0.114]
+
+def register_op(name):
+    """Registers builder(op_conf, input_shape, device) under name. It returns the op's module and its
+    (C, H, W) output shape for (C, H, W) input_shape. Modules take pixels with any batch dims."""
+    def decorator(builder):
+        PREPROCESS_OPS[name] = builder
+        return builder
+    return decorator
+
+def get_rect(rect_conf, height, width):
+    """(top, bottom, left, right) pixels of a rect given as fractions of the frame, so it stays in
+    place at any img_size."""
+    top = round(getattr(rect_conf, "top", 0.0) * height)
+    bottom = round(getattr(rect_conf, "bottom", 1.0) * height)
+    left = round(getattr(rect_conf, "left", 0.0) * width)
+    right = round(getattr(rect_conf, "right", 1.0) * width)
+    if bottom <= top or right <= left:
+        raise ValueError(f"Empty rect top={top}, bottom={bottom}, left={left}, right={right} in {height}x{width} pixels")
+
+    return top, bottom, left, right
+
+class SCCrop(torch.nn.Module):
+    def __init__(self, top, bottom, left, right):
+        super().__init__()
+        self.top, self.bottom, self.left, self.right = top, bottom, left, right
+
+    def forward(self, pixels):
+        return pixels[..., self.top:self.bottom, self.left:self.right]
+
+class SCGrayscale(torch.nn.Module):
+    def __init__(self, device=None):
+        super().__init__()
+        self.register_buffer("weights", torch.tensor(_GRAYSCALE_WEIGHTS, device=device).view(3, 1, 1))
+
+    def forward(self, pixels):
+        return (pixels * self.weights).sum(-3, keepdim=True)
+
+class SCSelectChannels(torch.nn.Module):
+    def __init__(self, channels, device=None):
+        super().__init__()
+        self.register_buffer("channels", torch.tensor(channels, dtype=torch.int64, device=device))
+
+    def forward(self, pixels):
+        return pixels.index_select(-3, self.channels)
+
+class SCMask(torch.nn.Module):
+    def __init__(self, mask, value):
+        super().__init__()
+        self.register_buffer("mask", mask)
+        self.value = value
+
+    def forward(self, pixels):
+        return pixels.masked_fill(self.mask, self.value)
+
+@register_op("crop")
+def create_crop(op_conf, input_shape, device):
+    # top, bottom, left, right
+    top, bottom, left, right = get_rect(op_conf, *input_shape[-2:])
+    return SCCrop(top, bottom, left, right), (input_shape[0], bottom - top, right - left)
+
+@register_op("grayscale")
+def create_grayscale(op_conf, input_shape, device):
+    if input_shape[0] != 3:
+        raise ValueError(f"grayscale needs 3 channels, got {input_shape[0]}")
+    return SCGrayscale(device), (1, *input_shape[1:])
+
+@register_op("channels")
+def create_select_channels(op_conf, input_shape, device):
+    # channels: indices to keep, in RGB order
+    channels = list(op_conf.channels)
+    if not channels or any(channel < 0 or channel >= input_shape[0] for channel in channels):
+        raise ValueError(f"channels must be indices below {input_shape[0]}, got {channels}")
+    return SCSelectChannels(channels, device), (len(channels), *input_shape[1:])
+
+@register_op("resize")
+def create_resize(op_conf, input_shape, device):
+    # size: edge length, or [height, width]. Area interpolation, meant for downscaling.
+    size = op_conf.size
+    height, width = size if isinstance(size, list) else (size, size)
+    return SCResize((height, width)), (input_shape[0], height, width)
+
+@register_op("mask")
+def create_mask(op_conf, input_shape, device):
+    # rects: list of {top, bottom, left, right} set to value, e.g. the HUD
+    height, width = input_shape[-2:]
+    mask = torch.zeros((height, width), dtype=torch.bool, device=device)
+    for rect_conf in op_conf.rects:
+        top, bottom, left, right = get_rect(rect_conf, height, width)
+        mask[top:bottom, left:right] = True
+    return SCMask(mask, getattr(op_conf, "value", 0.0)), input_shape
+
+def create_preprocess(ops_conf, input_shape, device=None):
+    """Builds the ops of ops_conf in order. Returns the module, None for no ops, and the (C, H, W)
+    output shape."""
+    modules = []
+    shape = tuple(input_shape)
+    for op_conf in ops_conf:
+        if op_conf.op not in PREPROCESS_OPS:
+            raise ValueError(f"Unknown preprocess op {op_conf.op}, available: {', '.join(PREPROCESS_OPS)}")
+
+        module, shape = PREPROCESS_OPS[op_conf.op](op_conf, shape, device)
+        modules.append(module)
+
+    module = torch.nn.Sequential(*modules) if modules else None
+    return module, shape
+
+def get_preprocessed_shape(input_shape):
+    """Shape of the pixels the model sees with model.preprocess."""
+    return create_preprocess(get_config().model.preprocess, input_shape)[1]
+
+class SCPreprocess(ObservationTransform):
+    """Runs the model.preprocess ops on the pixels of an env's tensordicts, on the env's device. The
+    observation spec follows the output shape."""
+
+    def __init__(self, module, in_keys=None):
+        in_keys = in_keys or ["pixels"]
+        super().__init__(in_keys=in_keys, out_keys=list(in_keys))
+        self.module = module
+
+    def _apply_transform(self, observation):
+        return self.module(observation)
+
+    @_apply_to_composite
+    def transform_observation_spec(self, observation_spec):
+        space = observation_spec.space
+        space.low = self._apply_transform(space.low)
+        space.high = self._apply_transform(space.high)
+        observation_spec.shape = space.low.shape
+        return observation_spec
+
+    def _reset(self, tensordict, tensordict_reset):
+        with _set_missing_tolerance(self, True):
+            tensordict_reset = self._call(tensordict_reset)
+        return tensordict_reset
+
+def create_preprocess_transform(input_shape, device=None):
+    """SCPreprocess for model.preprocess, or None if it has no ops."""
+    module, _ = create_preprocess(get_config().model.preprocess, input_shape, device)
+    return SCPreprocess(module) if module is not None else None
+
+if __name__ == "__main__":
+    from time import perf_counter
+
+    # Throughput of the configured pipeline on a batch uploaded from the host, like a collected step
+    config = get_config()
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+    input_shape = (3, config.model.img_size, config.model.img_size)
+    module, output_shape = create_preprocess(config.model.preprocess, input_shape, device)
+    print(f"model.preprocess: {input_shape} -> {output_shape}")
+    if module is None:
+        sys.exit(0)
+
+    host_pixels = torch.rand((batch_size, *input_shape))
+    preprocess = lambda: module(host_pixels.to(device, non_blocking=True))
+    for _ in range(5):
+        preprocess()
+
+    repeats = 50
+    start_time = perf_counter()
+    for _ in range(repeats):
+        preprocess()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    print(f"{batch_size * repeats / (perf_counter() - start_time):.0f} frames/s on {device}")
@@ -0,0 +1,161 @@
+import os
+import zlib
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+
+# Header: sequence counter, layout hash. Odd sequence means a write is in progress (seqlock).
+_HEADER_SIZE = 64
+_ALIGNMENT = 64
+
+def _get_layout(state_dict):
+    layout = []
+    offset = _HEADER_SIZE
+    for key, value in state_dict.items():
+        nbytes = value.numel() * value.element_size()
+        layout.append((key, value.dtype, tuple(value.shape), offset))
+        offset += (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+    return layout, offset
+
+def _get_layout_hash(layout):
+    layout_str = ";".join(f"{key},{dtype},{shape}" for key, dtype, shape, _ in layout)
+    return zlib.crc32(layout_str.encode())
+
+class _SCSharedWeights():
+    shm = None
+    header = None
+    views = None
+
+    def _init_views(self, layout):
+        self.header = np.ndarray((2, ), dtype=np.int64, buffer=self.shm.buf)
+        self.views = {}
+        for key, dtype, shape, offset in layout:
+            count = int(np.prod(shape, dtype=np.int64))
+            view = torch.frombuffer(self.shm.buf, dtype=dtype, count=count, offset=offset)
+            self.views[key] = view.view(shape)
+
+    def close(self):
+        # Views have to be released before the block can be closed
+        self.views = None
+        self.header = None
+        if self.shm is not None:
+            self.shm.close()
+
+class SCSharedWeightsWriter(_SCSharedWeights):
+    """Publishes a state dict into shared memory. Only one writer per block."""
+
+    def __init__(self, name, state_dict):
+        layout, size = _get_layout(state_dict)
+        self.layout_hash = _get_layout_hash(layout)
+
+        try:
+            # Left behind by a crashed run
+            stale_shm = shared_memory.SharedMemory(name=name)
+            stale_shm.close()
+            stale_shm.unlink()
+        except FileNotFoundError:
+            pass
+
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._init_views(layout)
+        self.header[1] = self.layout_hash
+
+    def write(self, state_dict, version):
+        sequence = int(self.header[0])
+        self.header[0] = sequence + 1
+
+        with torch.no_grad():
+            for key, view in self.views.items():
+                view.copy_(state_dict[key])
+
+        # Even sequence encodes the version. 0 is never written.
+        self.header[0] = (version + 1) * 2
+
+    def close(self):
+        super().close()
+        if self.shm is not None:
+            self.shm.unlink()
+            self.shm = None
+
+class SCSharedWeightsReader(_SCSharedWeights):
+    """Copies new versions from a SCSharedWeightsWriter block into a state dict.
+
+    Versions are copied into a staging copy of the state dict first and only reach the state dict
+    once the sequence shows no write overlapped, so a torn copy never gets into the model.
+    """
+
+    _MAX_RETRIES = 10
+
+    last_sequence = 0
+
+    def __init__(self, name, state_dict, should_untrack=True):
+        layout, _ = _get_layout(state_dict)
+        self.layout_hash = _get_layout_hash(layout)
+
+        self.shm = shared_memory.SharedMemory(name=name)
+        if should_untrack and os.name == "posix":
+            # Readers must not unlink the writer's block when they exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self._init_views(layout)
+        if int(self.header[1]) != self.layout_hash:
+            self.close()
+            raise ValueError(f"Shared weights '{name}' have a different model layout")
+
+        self.staging = {key: value.detach().clone() for key, value in state_dict.items() if key in self.views}
+
+    def _stage(self):
+        for key, view in self.views.items():
+            self.staging[key].copy_(view)
+
+    def read_into(self, state_dict):
+        """Returns the version copied into state_dict, or None if there is no new complete version."""
+        for _ in range(self._MAX_RETRIES):
+            sequence = int(self.header[0])
+            if sequence == 0 or sequence % 2 == 1 or sequence == self.last_sequence:
+                return None
+
+            with torch.no_grad():
+                self._stage()
+
+            # A write started during the copy, the staged copy is torn
+            if int(self.header[0]) != sequence:
+                continue
+
+            with torch.no_grad():
+                for key, value in self.staging.items():
+                    state_dict[key].copy_(value)
+            self.last_sequence = sequence
+            return sequence // 2 - 1
+
+        return None
+
+if __name__ == "__main__":
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 2))
+    copy = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 2))
+
+    writer = SCSharedWeightsWriter("surfchan_weights_test", model.state_dict())
+    reader = SCSharedWeightsReader("surfchan_weights_test", copy.state_dict(), should_untrack=False)
+    print(f"before write: {reader.read_into(copy.state_dict())}")
+
+    writer.write(model.state_dict(), 3)
+    print(f"version: {reader.read_into(copy.state_dict())}, again: {reader.read_into(copy.state_dict())}")
+    print(f"equal: {all(torch.equal(a, b) for a, b in zip(model.parameters(), copy.parameters()))}")
+
+    # A write that starts during every copy leaves the copy untouched
+    before = [param.detach().clone() for param in copy.parameters()]
+    with torch.no_grad():
+        [param.add_(1.0) for param in model.parameters()]
+    writer.write(model.state_dict(), 4)
+    stage = reader._stage
+    def torn_stage():
+        stage()
+        writer.header[0] += 1
+    reader._stage = torn_stage
+    print(f"torn: {reader.read_into(copy.state_dict())}, " \
+        f"untouched: {all(torch.equal(a, b) for a, b in zip(before, copy.parameters()))}")
+
+    reader.close()
+    writer.close()
@@ -0,0 +1,96 @@
+import json
+import struct
+from enum import Enum
+import numpy as np
+
+# Frame layout: header length, body length, json header, raw array bytes back to back.
+_PREFIX = struct.Struct("!IQ")
+_READ_CHUNK_SIZE = 1 << 20
+
+class FRAME_TYPE(Enum):
+    HELLO = 1
+    TRAJECTORY = 2
+    WEIGHTS = 3
+    OBSERVATION = 4
+    ACTION = 5
+    TELEMETRY = 6
+
+class Frame:
+    def __init__(self, type, version, arrays, meta=None):
+        self.type = type
+        self.version = version
+        self.arrays = arrays
+        self.meta = meta if meta is not None else {}
+
+def encode_frame(frame_type, version, arrays, meta=None):
+    header = {
+        "type": frame_type.value,
+        "version": version,
+        "meta": meta if meta is not None else {},
+        "arrays": [],
+    }
+
+    # Buffers are views on the arrays, so nothing is copied until the socket write
+    buffers = []
+    for key, array in arrays.items():
+        array = np.require(array, requirements="C")
+        header["arrays"].append({"key": key, "dtype": array.dtype.str, "shape": list(array.shape)})
+        buffers.append(memoryview(array.reshape(-1).view(np.uint8)))
+
+    header_bytes = json.dumps(header).encode()
+    body_len = sum(buffer.nbytes for buffer in buffers)
+
+    return [_PREFIX.pack(len(header_bytes), body_len), header_bytes, *buffers]
+
+def decode_frame(header_bytes, body):
+    header = json.loads(header_bytes)
+
+    arrays = {}
+    offset = 0
+    for array_info in header["arrays"]:
+        dtype = np.dtype(array_info["dtype"])
+        shape = tuple(array_info["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        # Arrays are views on the body, no copy
+        arrays[array_info["key"]] = np.frombuffer(body, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+
+    return Frame(FRAME_TYPE(header["type"]), header["version"], arrays, header["meta"])
+
+async def write_frame(writer, frame_type, version, arrays, meta=None):
+    writer.writelines(encode_frame(frame_type, version, arrays, meta))
+    await writer.drain()
+
+async def read_frame(reader):
+    prefix = await reader.readexactly(_PREFIX.size)
+    header_len, body_len = _PREFIX.unpack(prefix)
+    header_bytes = await reader.readexactly(header_len)
+
+    # Writable buffer so the decoded arrays can be handed to torch without a copy
+    body = bytearray(body_len)
+    body_view = memoryview(body)
+    filled = 0
+    while filled < body_len:
+        chunk = await reader.read(min(body_len - filled, _READ_CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed mid frame")
+        body_view[filled:filled + len(chunk)] = chunk
+        filled += len(chunk)
+
+    return decode_frame(header_bytes, body)
+
+if __name__ == "__main__":
+    arrays = {
+        "pixels": np.random.randint(0, 256, (4, 3, 8, 8), dtype=np.uint8),
+        "reward": np.random.rand(4, 1).astype(np.float32),
+        "done": np.zeros((4, 1), dtype=bool),
+        "count": np.array(3, dtype=np.int64),
+    }
+    buffers = encode_frame(FRAME_TYPE.TRAJECTORY, 7, arrays, {"worker": 0})
+    header_len, body_len = _PREFIX.unpack(buffers[0])
+    body = bytearray(b"".join(bytes(buffer) for buffer in buffers[2:]))
+    frame = decode_frame(buffers[1], body)
+
+    print(f"type={frame.type}, version={frame.version}, meta={frame.meta}, bytes={body_len}")
+    for key, array in arrays.items():
+        print(f"{key}: {np.array_equal(array, frame.arrays[key])}")
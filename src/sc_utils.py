@@ -1,19 +1,28 @@
 import asyncio
 import threading
 
-_background_loop = asyncio.new_event_loop()
+_background_loop = None
+_background_lock = threading.Lock()
 
 def _start_background_loop(loop):
     asyncio.set_event_loop(loop)
     loop.run_forever()
 
-_background_thread = threading.Thread(target=_start_background_loop, args=(_background_loop,), daemon=True)
-_background_thread.start()
+def _get_background_loop():
+    global _background_loop
+
+    # Started on first use, so importing this module has no side effects
+    with _background_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            background_thread = threading.Thread(target=_start_background_loop, args=(_background_loop,), daemon=True)
+            background_thread.start()
+
+    return _background_loop
 
 def run_async(coro):
-    future = asyncio.run_coroutine_threadsafe(coro, _background_loop)
+    future = asyncio.run_coroutine_threadsafe(coro, _get_background_loop())
     return future.result()
 
-def write_to_log(line):
-    with open("log.txt", "a") as file:
-        file.write(f"{line}\n")
+def run_async_nowait(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_background_loop())
@@ -0,0 +1,5 @@
+@echo off
+
+call compile_plugin.bat
+
+python src/SurfChan.py w